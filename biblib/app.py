@@ -3,15 +3,28 @@
 Application
 """
 
+import os
+import json
+import time
+import tempfile
 import logging.config
+import threading
 
-from views import UserView, LibraryView, DocumentView, PermissionView, \
-    TransferView, ClassicView, TwoPointOhView
+import metrics
+from views import UserView, LibraryView, DocumentView, DocumentBulkView, \
+    PermissionView, TransferView, ClassicView, TwoPointOhView, \
+    OperationsView, ContainsView, SlowQueryView, MetricsView
 from models import db
+from views.base_view import init_write_records
+from compression import compress_response
+from log import use_queue
+from profiling import init_profiling
+from request_stats import init_request_stats
 from flask import Flask
 from flask.ext.restful import Api
 from flask.ext.discoverer import Discoverer
-from flask.ext.consulate import Consul, ConsulConnectionError
+from flask.ext.consulate import Consul, ConsulConnectionError, \
+    with_retry_connections
 
 
 def create_app():
@@ -20,6 +33,7 @@ def create_app():
     :return: application
     """
 
+    start = time.time()
     app = Flask(__name__, static_folder=None)
     app.url_map.strict_slashes = False
 
@@ -29,11 +43,19 @@ def create_app():
     logging.config.dictConfig(
         app.config['BIBLIB_LOGGING']
     )
+    if app.config.get('BIBLIB_LOG_QUEUE'):
+        use_queue(maxsize=app.config.get('BIBLIB_LOG_QUEUE_SIZE', 10000))
 
     # Register extensions
     api = Api(app)
     Discoverer(app)
     db.init_app(app)
+    init_profiling(app)
+    init_request_stats(app)
+
+    # Users read their own changes from the primary, see BaseView
+    init_write_records(app)
+    app.after_request(compress_response)
 
     # Add the end resource end points
     api.add_resource(UserView,
@@ -44,10 +66,22 @@ def create_app():
                      '/libraries/<string:library>',
                      methods=['GET'])
 
+    api.add_resource(ContainsView,
+                     '/libraries/contains',
+                     methods=['POST'])
+
+    api.add_resource(OperationsView,
+                     '/libraries/operations/<string:library>',
+                     methods=['POST'])
+
     api.add_resource(DocumentView,
                      '/documents/<string:library>',
                      methods=['POST', 'DELETE', 'PUT'])
 
+    api.add_resource(DocumentBulkView,
+                     '/documents/<string:library>/bulk',
+                     methods=['POST'])
+
     api.add_resource(PermissionView,
                      '/permissions/<string:library>',
                      methods=['GET', 'POST'])
@@ -66,6 +100,18 @@ def create_app():
                      methods=['GET']
                      )
 
+    api.add_resource(SlowQueryView,
+                     '/admin/slow_queries',
+                     methods=['GET'])
+
+    api.add_resource(MetricsView,
+                     '/admin/metrics',
+                     methods=['GET'])
+
+    elapsed = time.time() - start
+    metrics.timing('startup.create_app', elapsed)
+    app.logger.info('Application created in {0:.3f}s'.format(elapsed))
+
     return app
 
 
@@ -74,7 +120,8 @@ def load_config(app):
     Loads configuration in the following order:
         1. config.py
         2. local_config.py (ignore failures)
-        3. consul (ignore failures)
+        3. consul, or the snapshot of the last config loaded from consul if it
+           does not answer within BIBLIB_CONSUL_TIMEOUT (ignore failures)
     :param app: flask.Flask application instance
     :return: None
     """
@@ -85,11 +132,137 @@ def load_config(app):
         app.config.from_pyfile('local_config.py')
     except IOError:
         app.logger.warning('Could not load local_config.py')
+
+    start = time.time()
+    snapshot = app.config.get('BIBLIB_CONSUL_SNAPSHOT')
     try:
-        app.extensions['consul'].apply_remote_config()
+        remote_config = get_remote_config(
+            app.extensions['consul'],
+            timeout=app.config.get('BIBLIB_CONSUL_TIMEOUT', 2)
+        )
     except ConsulConnectionError as error:
         app.logger.warning('Could not apply config from consul: {}'
                            .format(error))
+        remote_config = read_config_snapshot(app, snapshot)
+    else:
+        write_config_snapshot(app, snapshot, remote_config)
+
+    app.config.update(remote_config)
+    metrics.timing('startup.load_config', time.time() - start)
+
+
+def get_remote_config(consul, timeout, namespace=None):
+    """
+    Retrieves the config values defined in consul's kv store, the way
+    Consul.apply_remote_config does, but without waiting on consul for more
+    than the timeout given
+    :param consul: flask_consulate.Consul instance
+    :param timeout: seconds to wait for consul
+    :param namespace: kv namespace/directory
+    :return: dictionary of config values
+    """
+    if namespace is None:
+        namespace = 'config/{service}/{environment}/'.format(
+            service=os.environ.get('SERVICE', 'generic_service'),
+            environment=os.environ.get('ENVIRONMENT', 'generic_environment')
+        )
+
+    @with_retry_connections()
+    def find():
+        return consul.session.kv.find(namespace)
+
+    result = {}
+
+    def fetch():
+        try:
+            result['values'] = find()
+        except Exception as error:
+            result['error'] = error
+
+    # The thread is left behind if consul hangs, it only holds a connection
+    thread = threading.Thread(target=fetch, name='biblib-consul')
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+
+    if thread.is_alive():
+        raise ConsulConnectionError('No answer within {0}s'.format(timeout))
+    if 'error' in result:
+        raise ConsulConnectionError(result['error'])
+
+    remote_config = {}
+    for key, value in result['values'].iteritems():
+        key = key.replace(namespace, '')
+        try:
+            remote_config[key] = json.loads(value)
+        except (TypeError, ValueError):
+            remote_config[key] = value
+    return remote_config
+
+
+def read_config_snapshot(app, path):
+    """
+    Reads the snapshot of the last config loaded from consul
+    :param app: flask.Flask application instance
+    :param path: path of the snapshot, or None
+    :return: dictionary of config values, empty if there is no snapshot
+    """
+    if not path:
+        return {}
+    try:
+        with open(path) as snapshot:
+            written = os.fstat(snapshot.fileno()).st_mtime
+            remote_config = json.load(snapshot)
+    except (IOError, OSError, ValueError) as error:
+        app.logger.warning('Could not read config snapshot: {0}'
+                           .format(error))
+        return {}
+
+    max_age = app.config.get('BIBLIB_CONSUL_SNAPSHOT_MAX_AGE')
+    if max_age is not None and time.time() - written > max_age:
+        app.logger.warning('Not using config snapshot: {0}, written {1}, '
+                           'more than {2}s ago'
+                           .format(path, time.ctime(written), max_age))
+        return {}
+
+    metrics.incr('startup.config_snapshot')
+    app.logger.warning('Using config snapshot: {0}, written {1}'
+                       .format(path, time.ctime(written)))
+    return remote_config
+
+
+def write_config_snapshot(app, path, remote_config):
+    """
+    Writes the config loaded from consul to the snapshot, replacing it at once
+    so that a snapshot is never read half written. The snapshot holds
+    credentials: its directory is created for the user running the
+    application only, and the file is only readable by them.
+    :param app: flask.Flask application instance
+    :param path: path of the snapshot, or None
+    :param remote_config: dictionary of config values
+    :return: None
+    """
+    if not path:
+        return
+    temporary = None
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+        # mkstemp creates a new file, readable by its owner only
+        descriptor, temporary = tempfile.mkstemp(
+            dir=directory,
+            prefix='.{0}.'.format(os.path.basename(path))
+        )
+        with os.fdopen(descriptor, 'w') as snapshot:
+            json.dump(remote_config, snapshot)
+        os.rename(temporary, path)
+    except (IOError, OSError, TypeError, ValueError) as error:
+        app.logger.warning('Could not write config snapshot: {0}'
+                           .format(error))
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
 
 if __name__ == '__main__':
     app_ = create_app()
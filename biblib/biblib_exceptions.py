@@ -31,3 +31,45 @@ class PermissionDeniedError(Exception):
         """
         super(PermissionDeniedError, self).__init__(message)
         self.errors = 'You do not have permission to do this'
+
+class PreconditionFailedError(Exception):
+    """
+    Custom exception. Is raised when a user modifies a library using a version
+    of the library that is no longer current.
+    """
+    def __init__(self, message):
+        """
+        Constructor
+        :param message: error message
+        :return: no return
+        """
+        super(PreconditionFailedError, self).__init__(message)
+        self.errors = 'The library has been modified by someone else'
+
+class CircuitOpenError(Exception):
+    """
+    Custom exception. Is raised when a call to a dependency is not attempted,
+    because the dependency failed too often recently.
+    """
+    def __init__(self, message):
+        """
+        Constructor
+        :param message: error message
+        :return: no return
+        """
+        super(CircuitOpenError, self).__init__(message)
+        self.errors = 'The service is unavailable'
+
+class TooManyBibcodesError(Exception):
+    """
+    Custom exception. Is raised when a request contains more bibcodes than
+    can be processed at once.
+    """
+    def __init__(self, message):
+        """
+        Constructor
+        :param message: error message
+        :return: no return
+        """
+        super(TooManyBibcodesError, self).__init__(message)
+        self.errors = 'Too many bibcodes were sent at once'
@@ -1,5 +1,14 @@
+import time
 import requests
+import threading
+from collections import deque
 from flask import current_app
+from . import metrics
+from .biblib_exceptions import CircuitOpenError
+from .log import get_logger
+from .request_stats import count_upstream_call
+
+logger = get_logger(__name__)
 
 client = lambda: Client(current_app.config).session
 
@@ -23,3 +32,215 @@ class Client:
             self.session.headers.update(
                 {'Authorization': 'Bearer {0}'.format(self.token)}
             )
+        if config.get('BIBLIB_REQUEST_STATS'):
+            self.session.hooks['response'].append(count_upstream_call)
+
+
+class CircuitBreaker:
+    """
+    Error rate circuit breaker for calls to a dependency. Once the rate of
+    failed calls within the window goes over the threshold, calls are refused
+    without being attempted until the cool down has passed. A single call is
+    then let through: the breaker closes if it succeeds, and opens again if it
+    fails.
+
+    The settings are read from the configuration key given, with the keys
+    window, min_calls, error_rate and cool_down.
+
+    Each change of state starts a new generation. The outcome of a call is
+    only counted in the generation it started in, so that calls still in
+    flight when the breaker opened cannot open it again when they fail.
+    """
+    CLOSED = 'closed'
+    HALF_OPEN = 'half-open'
+    OPEN = 'open'
+
+    # Value of the state metric for each state
+    STATE_METRIC = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, config_key):
+        """
+        Constructor
+
+        :param name: name of the dependency, used in the metrics
+        :param config_key: configuration key of the breaker settings
+        """
+        self.name = name
+        self.config_key = config_key
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.state = self.CLOSED
+        self.generation = 0
+        self.opened_at = 0
+        self.trial_started = False
+        metrics.gauge('breaker.{0}.state'.format(self.name),
+                      self.STATE_METRIC[self.state])
+
+    @property
+    def settings(self):
+        """
+        Settings of the breaker, with defaults for those not configured
+
+        :return: dictionary of settings
+        """
+        settings = dict(window=60, min_calls=10, error_rate=0.5, cool_down=30)
+        settings.update(current_app.config.get(self.config_key, {}))
+        return settings
+
+    def set_state(self, state):
+        """
+        Change the state of the breaker, and export it as a metric
+
+        :param state: new state
+        """
+        if state != self.state:
+            logger.warning('Circuit breaker {0}: {1} -> {2}', self.name,
+                           self.state, state)
+            self.generation += 1
+        self.state = state
+        metrics.gauge('breaker.{0}.state'.format(self.name),
+                      self.STATE_METRIC[state])
+
+    def before_call(self):
+        """
+        Check that a call can be attempted, raising CircuitOpenError if not
+
+        :return: generation the call starts in, to pass on to after_call
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.settings['cool_down']:
+                    metrics.incr('breaker.{0}.rejected'.format(self.name))
+                    raise CircuitOpenError(self.name)
+                self.set_state(self.HALF_OPEN)
+                self.trial_started = False
+
+            if self.state == self.HALF_OPEN:
+                if self.trial_started:
+                    metrics.incr('breaker.{0}.rejected'.format(self.name))
+                    raise CircuitOpenError(self.name)
+                self.trial_started = True
+
+            return self.generation
+
+    def after_call(self, success, generation=None):
+        """
+        Record the outcome of a call, opening or closing the breaker if needed.
+        Calls that started in an earlier generation are ignored.
+
+        :param success: if the call succeeded
+        :param generation: generation returned by before_call, None for the
+                           current one
+        """
+        with self.lock:
+            if self.state == self.OPEN or \
+                    generation not in (None, self.generation):
+                metrics.incr('breaker.{0}.ignored'.format(self.name))
+                return
+
+            if self.state == self.HALF_OPEN:
+                self.calls.clear()
+                if success:
+                    self.set_state(self.CLOSED)
+                else:
+                    self.open()
+                return
+
+            settings = self.settings
+            now = time.time()
+            self.calls.append((now, success))
+            while self.calls and now - self.calls[0][0] > settings['window']:
+                self.calls.popleft()
+
+            failures = len([call for call in self.calls if not call[1]])
+            if len(self.calls) >= settings['min_calls'] and \
+                    failures >= settings['error_rate'] * len(self.calls):
+                self.calls.clear()
+                self.open()
+
+    def open(self):
+        """
+        Stop letting calls through for the cool down
+        """
+        self.opened_at = time.time()
+        metrics.incr('breaker.{0}.opened'.format(self.name))
+        self.set_state(self.OPEN)
+
+    def reset(self):
+        """
+        Close the breaker and forget the calls made so far
+        """
+        with self.lock:
+            self.calls.clear()
+            self.set_state(self.CLOSED)
+            self.generation += 1
+            self.opened_at = 0
+            self.trial_started = False
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls. The first caller of a key (the
+    leader) makes the call, and those that arrive while it is in flight (the
+    followers) wait for its result, or its exception, rather than making the
+    call again. A follower that is not answered within the timeout makes the
+    call itself.
+    """
+
+    class Call:
+        """
+        A call in flight, and its outcome once the event is set
+        """
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, name):
+        """
+        Constructor
+
+        :param name: name of the call, used in the metrics
+        """
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, timeout):
+        """
+        Call the function, unless a call with the same key is in flight
+
+        :param key: hashable key of the call, identical calls share a key
+        :param function: function to call, without arguments
+        :param timeout: seconds a follower waits for the leader
+
+        :return: return value of the function
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            metrics.incr('singleflight.{0}.shared'.format(self.name))
+            if not call.event.wait(timeout):
+                logger.warning('Single flight {0}: leader did not answer in '
+                               '{1}s', self.name, timeout)
+                metrics.incr('singleflight.{0}.timeout'.format(self.name))
+                return function()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.incr('singleflight.{0}.leader'.format(self.name))
+        try:
+            call.result = function()
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
@@ -0,0 +1,160 @@
+"""
+Compression of the responses, negotiated with the Accept-Encoding header of
+the request. Supports gzip and deflate, and br if the brotli package is
+installed.
+"""
+
+import time
+import zlib
+import metrics
+from flask import request, current_app
+from werkzeug.http import quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Types of content worth compressing
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson')
+
+
+def get_encodings(streamed=False):
+    """
+    Encodings that can be used, in order of preference
+
+    :param streamed: if the response is streamed, which br is not used for
+
+    :return: list of encodings
+    """
+    encodings = ['gzip', 'deflate']
+    if brotli is not None and not streamed and \
+            current_app.config.get('BIBLIB_COMPRESSION_BROTLI'):
+        encodings.insert(0, 'br')
+    return encodings
+
+
+def get_compressor(encoding, level):
+    """
+    Incremental compressor for gzip or deflate
+
+    :param encoding: 'gzip' or 'deflate'
+    :param level: compression level, 1 (fastest) to 9 (smallest)
+
+    :return: zlib compression object
+    """
+    # HTTP deflate is the zlib format, gzip needs its own header and trailer
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def record_compression(encoding, size, compressed_size, seconds):
+    """
+    Record the metrics of a compressed response
+
+    :param encoding: encoding used
+    :param size: size before compression in bytes
+    :param compressed_size: size after compression in bytes
+    :param seconds: time spent compressing
+    """
+    metrics.incr('compression.{0}.responses'.format(encoding))
+    metrics.incr('compression.bytes_in', size)
+    metrics.incr('compression.bytes_out', compressed_size)
+    metrics.timing('compression.cpu_time', seconds)
+    if size:
+        metrics.observe('compression.ratio', float(compressed_size) / size)
+
+
+def compress_stream(chunks, encoding, level):
+    """
+    Compress a streamed response chunk by chunk. Each chunk is flushed, so
+    that the client receives the content as it is produced.
+
+    :param chunks: iterable of the chunks of the response
+    :param encoding: 'gzip' or 'deflate'
+    :param level: compression level
+
+    :return: generator of the compressed chunks
+    """
+    compressor = get_compressor(encoding, level)
+    size = compressed_size = 0
+    seconds = 0.0
+
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        start = time.time()
+        compressed = compressor.compress(chunk) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        seconds += time.time() - start
+        size += len(chunk)
+        compressed_size += len(compressed)
+        if compressed:
+            yield compressed
+
+    compressed = compressor.flush()
+    compressed_size += len(compressed)
+    record_compression(encoding, size, compressed_size, seconds)
+    yield compressed
+
+
+def compress_response(response):
+    """
+    After request hook: compress the response with the best encoding the
+    client accepts, or leave it as it is if the client accepts none of them.
+    Responses smaller than BIBLIB_COMPRESSION_THRESHOLD are
+    left as they are, whereas streamed responses are always compressed, as
+    their size is not known in advance.
+
+    The entity tag is made weak, as the bytes sent depend on the encoding.
+
+    :param response: flask response
+
+    :return: the response, compressed or not
+    """
+    config = current_app.config
+    if not config.get('BIBLIB_COMPRESSION') or \
+            request.method == 'HEAD' or \
+            response.status_code < 200 or \
+            response.status_code in (204, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+
+    # Whether the response is compressed depends on the request from here on
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(
+        get_encodings(streamed=response.is_streamed)
+    )
+    if encoding is None:
+        return response
+
+    level = config.get('BIBLIB_COMPRESSION_LEVEL', 6)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding,
+                                            level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get('BIBLIB_COMPRESSION_THRESHOLD', 0):
+            return response
+
+        start = time.time()
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=level)
+        else:
+            compressor = get_compressor(encoding, level)
+            compressed = compressor.compress(data) + compressor.flush()
+        record_compression(encoding, len(data), len(compressed),
+                           time.time() - start)
+        response.set_data(compressed)
+
+    response.headers['Content-Encoding'] = encoding
+
+    # Set by hand, as werkzeug writes the weak prefix in lower case
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.headers['ETag'] = 'W/{0}'.format(quote_etag(etag))
+
+    return response
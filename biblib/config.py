@@ -5,22 +5,63 @@ the application name.
 """
 
 import os
-import pwd
-
-LOG_PATH = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), '../')
-)
-LOG_PATH = '{home}/logs/'.format(home=LOG_PATH)
-
-if not os.path.isdir(LOG_PATH):
-    os.mkdir(LOG_PATH)
 
 # For running tests on TravisCI
 SQLALCHEMY_BINDS = {
     'libraries': 'postgresql+psycopg2://postgres:@localhost/testdb'
 }
 
+# Connection pool of each bind. pre_ping tests connections when they are
+# checked out, so that connections dropped by a failover are replaced instead
+# of failing the request. warm_up is the number of connections opened by
+# wsgi.py before the worker accepts traffic.
+BIBLIB_POOL = {
+    'libraries': {
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': 3600,
+        'pre_ping': True,
+        'warm_up': 2
+    }
+}
+
+# Responses of at least BIBLIB_COMPRESSION_THRESHOLD bytes are compressed with
+# the best encoding the client accepts: gzip, deflate, or br if the brotli
+# package is installed and BIBLIB_COMPRESSION_BROTLI is set. Streamed responses
+# are always compressed. The level goes from 1 (fastest) to 9 (smallest).
+BIBLIB_COMPRESSION = True
+BIBLIB_COMPRESSION_THRESHOLD = 1024
+BIBLIB_COMPRESSION_LEVEL = 6
+BIBLIB_COMPRESSION_BROTLI = True
+
+# Optional read replica of the libraries database. When SQLALCHEMY_BINDS has
+# an entry under this key, GET requests read from it instead of the primary
+BIBLIB_REPLICA_BIND_KEY = 'libraries_replica'
+
+# Number of seconds the replica can lag behind the primary and still be read
+# from. Users who made a change within this many seconds read from the primary,
+# so that they see their own changes (this is tracked in the user table)
+BIBLIB_REPLICA_MAX_LAG = 5
+
+# Number of seconds the measured lag of the replica is reused for
+BIBLIB_REPLICA_LAG_CHECK_INTERVAL = 5
+
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'staging').lower()
+
+# Seconds to wait for the config stored in consul when the application starts.
+# The last config loaded from consul is kept in the snapshot file, which is
+# used instead when consul is unreachable or does not answer in time. The
+# snapshot holds credentials, so it is only readable by the user running the
+# application, in a directory of its own. Snapshots older than
+# BIBLIB_CONSUL_SNAPSHOT_MAX_AGE seconds are not used.
+BIBLIB_CONSUL_TIMEOUT = 2
+BIBLIB_CONSUL_SNAPSHOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'var',
+    'consul.{}.json'.format(ENVIRONMENT)
+)
+BIBLIB_CONSUL_SNAPSHOT_MAX_AGE = 7 * 24 * 60 * 60
+
 BIBLIB_LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -42,17 +83,86 @@ BIBLIB_LOGGING = {
             'formatter': 'default',
             'level': 'DEBUG',
             'class': 'logging.StreamHandler'
+        },
+        'slow_queries': {
+            'formatter': 'default',
+            'level': 'INFO',
+            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'filename': '/tmp/biblib.slow_queries.{}.log'.format(ENVIRONMENT),
         }
     },
     'loggers': {
         '': {
             'handlers': ['file'],
-            'level': 'DEBUG',
+            'level': 'INFO',
             'propagate': True,
         },
+        # Level of each subsystem, messages below it are never formatted
+        'biblib.views': {'level': 'INFO'},
+        'biblib.client': {'level': 'INFO'},
+        'biblib.models': {'level': 'INFO'},
+        'biblib.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
+# Statements of a bind that take longer than threshold seconds are logged to
+# the slow query log, with their plan (EXPLAIN) on Postgres. The statistics of
+# up to max_statements statements are listed by /admin/slow_queries, which
+# needs the admin token in the X-Biblib-Admin-Token header.
+BIBLIB_SLOW_QUERIES = {
+    'libraries': {
+        'threshold': 0.1,
+        'explain': True,
+        'max_statements': 1000
+    }
+}
+BIBLIB_ADMIN_TOKEN = None
+
+# Profiling of requests with cProfile, off unless BIBLIB_PROFILING is set. A
+# request is profiled if it has the header with the token as value, or at the
+# sample rate (0 to 1). The last max_files profiles are kept in the path.
+BIBLIB_PROFILING = False
+BIBLIB_PROFILING_HEADER = 'X-Biblib-Profile'
+BIBLIB_PROFILING_TOKEN = None
+BIBLIB_PROFILING_SAMPLE_RATE = 0
+BIBLIB_PROFILING_PATH = '/tmp/biblib.profiles'
+BIBLIB_PROFILING_MAX_FILES = 50
+
+# Counts of the SQL statements and upstream calls of each request, returned in
+# X-Biblib-* response headers for the load-test harness, see request_stats.py
+BIBLIB_REQUEST_STATS = False
+
+# Messages of the request path logged with sample=True are only logged once
+# every this many times
+BIBLIB_LOG_SAMPLE_EVERY = 100
+
+# Set to write the log records from a background thread, so that requests do
+# not wait on the log file. Records are dropped once the queue is full.
+BIBLIB_LOG_QUEUE = False
+BIBLIB_LOG_QUEUE_SIZE = 10000
+
+# Number of bibcodes validated and added at once by the bulk document end point
+BIBLIB_BULK_BATCH_SIZE = 1000
+
+# Maximum number of distinct bibcodes the bulk document end point accepts in
+# one request. The whole body is read before the library is locked, so this
+# bounds the memory used by a request.
+BIBLIB_BULK_MAX_BIBCODES = 100000
+
+# Maximum number of bibcodes that can be looked up at once by the contains end
+# point
+BIBLIB_CONTAINS_MAX_BIBCODES = 5000
+
+# Number of seconds shared caches can store the response of a public library
+BIBLIB_PUBLIC_CACHE_MAX_AGE = 60
+
+# Number of library id to slug conversions that are kept in memory
+BIBLIB_SLUG_CACHE_SIZE = 10000
+
 # These lines are necessary only if the app needs to be a client of the
 # adsws-api
 BIBLIB_TWOPOINTOH_SERVICE_URL = 'https://api.adsabs.edu/v1/harbour'
@@ -61,3 +171,29 @@ BIBLIB_SOLR_BIG_QUERY_URL = 'https://api.adsabs.search/v1/bigquery'
 BIBLIB_USER_EMAIL_ADSWS_API_URL = 'https://api.adsabs.harvard.edu/v1/user'
 BIBLIB_ADSWS_API_TOKEN = 'this is a secret api token!'
 BIBLIB_ADSWS_API_DB_URI = 'sqlite:////tmp/test.db'
+
+# Seconds to wait for the Solr bigquery end point to connect and to respond
+BIBLIB_SOLR_BIG_QUERY_TIMEOUT = (3.05, 10)
+
+# Set if the Solr bigquery end point accepts gzip compressed uploads
+# (Content-Encoding: gzip). Bodies of at least the threshold in bytes are then
+# compressed at the given level.
+BIBLIB_SOLR_BIG_QUERY_GZIP = False
+BIBLIB_SOLR_BIG_QUERY_GZIP_THRESHOLD = 16384
+BIBLIB_SOLR_BIG_QUERY_GZIP_LEVEL = 6
+
+# Circuit breaker of the Solr bigquery end point. It opens when at least
+# error_rate of the calls failed within the last window seconds (and there were
+# at least min_calls), after which libraries are served without Solr for
+# cool_down seconds.
+BIBLIB_SOLR_BIG_QUERY_BREAKER = {
+    'window': 60,
+    'min_calls': 10,
+    'error_rate': 0.5,
+    'cool_down': 30
+}
+
+# Identical concurrent reads of the same library version share the Solr
+# bigquery call of the first one. The others wait for its result at most this
+# many seconds, after which they make the call themselves.
+BIBLIB_LIBRARY_SINGLE_FLIGHT_TIMEOUT = 15
@@ -0,0 +1,164 @@
+"""
+Logical export of the libraries, with their bibcodes and permissions, as
+newline delimited JSON: one library per line. Libraries are read with a server
+side cursor in batches of yield_per, and the permissions of each batch with a
+single query, so that memory stays flat however many libraries and bibcodes
+there are. The export can be restored selectively, or fed to analytics.
+"""
+
+import json
+import time
+from log import get_logger
+from models import User, Library, Permissions
+
+logger = get_logger(__name__)
+
+# Columns of the libraries exported, in the order of the records
+LIBRARY_COLUMNS = ('id', 'name', 'description', 'public', 'version',
+                   'date_created', 'date_last_modified', 'bibcode')
+
+
+def isoformat(value):
+    """
+    ISO 8601 form of a datetime
+
+    :param value: datetime, or None
+    :return: string, or None
+    """
+    return value.isoformat() if value is not None else None
+
+
+def library_query(session, users=None, since=None):
+    """
+    Query of the libraries exported, in the order of their ids
+
+    :param session: database session
+    :param users: absolute_uids whose owned libraries are exported, all by
+                  default
+    :param since: only export libraries modified since this datetime
+    :return: query of the columns of LIBRARY_COLUMNS
+    """
+    query = session.query(*[getattr(Library, column)
+                            for column in LIBRARY_COLUMNS])
+    if users:
+        owned = session.query(Permissions.library_id)\
+            .join(User, Permissions.user_id == User.id)\
+            .filter(Permissions.owner.is_(True))\
+            .filter(User.absolute_uid.in_(users))
+        query = query.filter(Library.id.in_(owned.subquery()))
+    if since is not None:
+        query = query.filter(Library.date_last_modified >= since)
+    return query.order_by(Library.id)
+
+
+def permissions_of(session, library_ids):
+    """
+    Permissions of a batch of libraries
+
+    :param session: database session
+    :param library_ids: ids of the libraries
+    :return: dictionary of library id to list of permissions
+    """
+    permissions = dict((library_id, []) for library_id in library_ids)
+    rows = session.query(Permissions.library_id, User.absolute_uid,
+                         Permissions.read, Permissions.write,
+                         Permissions.admin, Permissions.owner)\
+        .join(User, Permissions.user_id == User.id)\
+        .filter(Permissions.library_id.in_(library_ids))\
+        .order_by(Permissions.id)
+    for library_id, absolute_uid, read, write, admin, owner in rows:
+        permissions[library_id].append({
+            'absolute_uid': absolute_uid,
+            'read': read,
+            'write': write,
+            'admin': admin,
+            'owner': owner
+        })
+    return permissions
+
+
+def library_records(session, users=None, since=None, batch_size=1000):
+    """
+    Records of the libraries exported
+
+    :param session: database session
+    :param users: absolute_uids whose owned libraries are exported, all by
+                  default
+    :param since: only export libraries modified since this datetime
+    :param batch_size: number of libraries read at once
+    :return: generator of dictionaries
+    """
+    rows = library_query(session, users, since)\
+        .execution_options(stream_results=True)\
+        .yield_per(batch_size)
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            for record in batch_records(session, batch):
+                yield record
+            batch = []
+    for record in batch_records(session, batch):
+        yield record
+
+
+def batch_records(session, batch):
+    """
+    Records of a batch of library rows, with their permissions
+
+    :param session: database session
+    :param batch: rows of the columns of LIBRARY_COLUMNS
+    :return: list of dictionaries
+    """
+    if not batch:
+        return []
+    permissions = permissions_of(session, [row.id for row in batch])
+    return [{
+        'id': str(row.id),
+        'name': row.name,
+        'description': row.description,
+        'public': row.public,
+        'version': row.version,
+        'date_created': isoformat(row.date_created),
+        'date_last_modified': isoformat(row.date_last_modified),
+        'bibcode': row.bibcode or {},
+        'permissions': permissions[row.id]
+    } for row in batch]
+
+
+def export_libraries(session, output, users=None, since=None,
+                     batch_size=1000, progress_every=10000):
+    """
+    Write the libraries as newline delimited JSON
+
+    :param session: database session
+    :param output: file object the records are written to
+    :param users: absolute_uids whose owned libraries are exported, all by
+                  default
+    :param since: only export libraries modified since this datetime
+    :param batch_size: number of libraries read at once
+    :param progress_every: number of libraries between progress messages
+    :return: dictionary of the number of libraries, bibcodes, permissions
+             and bytes exported
+    """
+    start = time.time()
+    counts = dict(libraries=0, bibcodes=0, permissions=0, bytes=0)
+
+    for record in library_records(session, users, since, batch_size):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        output.write(line)
+
+        counts['libraries'] += 1
+        counts['bibcodes'] += len(record['bibcode'])
+        counts['permissions'] += len(record['permissions'])
+        counts['bytes'] += len(line)
+        if counts['libraries'] % progress_every == 0:
+            elapsed = time.time() - start
+            logger.info('Exported {0} libraries, {1} bibcodes in {2:.1f}s, '
+                        '{3:.0f} libraries/s', counts['libraries'],
+                        counts['bibcodes'], elapsed,
+                        counts['libraries'] / elapsed)
+
+    logger.info('Exported {0} in {1:.1f}s', counts, time.time() - start)
+    return counts
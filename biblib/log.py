@@ -0,0 +1,253 @@
+"""
+Logging for the hot paths of the service. Messages are formatted with
+str.format, but only once a record is going to be emitted, so calls below the
+level of their logger cost no more than a level check. Each module logs to its
+own logger (biblib.views.library_view, biblib.client, ...), so that the level
+of each subsystem can be set in BIBLIB_LOGGING.
+"""
+
+import Queue
+import logging
+import itertools
+import threading
+from flask import current_app, has_app_context
+from . import metrics
+
+# Number of items of a collection shown by a Summary
+SUMMARY_LIMIT = 5
+
+# Default number of messages a sampled message is logged once for
+SAMPLE_EVERY = 100
+
+
+class BraceMessage(object):
+    """
+    Message formatted with str.format when the record is emitted
+    """
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt, args):
+        """
+        Constructor
+        :param fmt: format string
+        :param args: positional arguments of the format string
+        """
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args) if self.args else self.fmt
+
+
+class Summary(object):
+    """
+    Size capped representation of a collection, such as the bibcodes of a
+    library: its length and first few items. It is only built if the message
+    it is part of is emitted.
+    """
+    __slots__ = ('items', 'limit')
+
+    def __init__(self, items, limit=SUMMARY_LIMIT):
+        """
+        Constructor
+        :param items: collection to summarise
+        :param limit: maximum number of items shown
+        """
+        self.items = items
+        self.limit = limit
+
+    def __str__(self):
+        if self.items is None:
+            return 'None'
+        shown = [item for item in itertools.islice(self.items, self.limit)]
+        if len(self.items) > self.limit:
+            shown.append(Ellipsis)
+        return '{0} items: [{1}]'.format(
+            len(self.items),
+            ', '.join('...' if item is Ellipsis else repr(item)
+                      for item in shown)
+        )
+
+
+class Logger(object):
+    """
+    Logger with lazily formatted messages. The positional arguments of a call
+    are the arguments of the format string. The keyword exc_info is passed on
+    to logging, and sample=True only logs one in BIBLIB_LOG_SAMPLE_EVERY of
+    the messages with that format string.
+    """
+
+    def __init__(self, name):
+        """
+        Constructor
+        :param name: name of the logger
+        """
+        self.logger = logging.getLogger(name)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def is_enabled_for(self, level):
+        """
+        If messages of the level given would be emitted
+
+        :param level: logging level
+        :return: boolean
+        """
+        return self.logger.isEnabledFor(level)
+
+    def sampled(self, fmt):
+        """
+        Count a message that is sampled, and return how often it is logged if
+        this one should be, or None otherwise
+
+        :param fmt: format string of the message
+        :return: number of messages logged once, or None
+        """
+        every = SAMPLE_EVERY
+        if has_app_context():
+            every = current_app.config.get('BIBLIB_LOG_SAMPLE_EVERY', every)
+
+        with self.lock:
+            count = self.counts.get(fmt, 0)
+            self.counts[fmt] = count + 1
+
+        return every if count % every == 0 else None
+
+    def log(self, level, fmt, *args, **kwargs):
+        """
+        Log a message at the level given
+
+        :param level: logging level
+        :param fmt: format string
+        :param args: arguments of the format string
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+
+        if kwargs.get('sample'):
+            every = self.sampled(fmt)
+            if every is None:
+                return
+            if every > 1:
+                fmt = '{0} [1 in {1:d} logged]'.format(fmt, every)
+
+        self.logger.log(level, BraceMessage(fmt, args),
+                        exc_info=kwargs.get('exc_info'))
+
+    def debug(self, fmt, *args, **kwargs):
+        self.log(logging.DEBUG, fmt, *args, **kwargs)
+
+    def info(self, fmt, *args, **kwargs):
+        self.log(logging.INFO, fmt, *args, **kwargs)
+
+    def warning(self, fmt, *args, **kwargs):
+        self.log(logging.WARNING, fmt, *args, **kwargs)
+
+    def error(self, fmt, *args, **kwargs):
+        self.log(logging.ERROR, fmt, *args, **kwargs)
+
+    def exception(self, fmt, *args, **kwargs):
+        kwargs['exc_info'] = True
+        self.log(logging.ERROR, fmt, *args, **kwargs)
+
+
+def get_logger(name):
+    """
+    Logger of a module
+
+    :param name: name of the module
+    :return: Logger
+    """
+    return Logger(name)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Handler that passes the records on to a thread, which writes them with the
+    handlers it wraps, so that the threads serving requests never wait on
+    file I/O. When the queue is full, records are dropped and counted rather
+    than blocking.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        """
+        Constructor
+        :param handlers: handlers that write the records
+        :param maxsize: maximum number of records waiting to be written
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self.serve, name='biblib-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        """
+        Format the message in the thread logging, so that the record no
+        longer refers to objects that could change before it is written. The
+        message includes the traceback, so the traceback cached in exc_text
+        is removed for the handlers wrapped not to append it again.
+
+        :param record: log record
+        :return: log record
+        """
+        record.msg = self.format(record)
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        """
+        Queue the record, or drop it if the queue is full
+
+        :param record: log record
+        """
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            metrics.incr('log.dropped')
+        except Exception:
+            self.handleError(record)
+
+    def serve(self):
+        """
+        Write the records queued, until None is received
+        """
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def close(self):
+        """
+        Write the records left in the queue, and close the handlers wrapped
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(5)
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def use_queue(logger=None, maxsize=10000):
+    """
+    Move the handlers of a logger behind a QueueHandler
+
+    :param logger: logger, the root logger by default
+    :param maxsize: maximum number of records waiting to be written
+    :return: QueueHandler
+    """
+    logger = logger or logging.getLogger()
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    queue_handler = QueueHandler(handlers, maxsize=maxsize)
+    logger.addHandler(queue_handler)
+    return queue_handler
@@ -3,6 +3,8 @@ Alembic migration management file
 """
 import os
 import sys
+import gzip
+from datetime import datetime
 PROJECT_HOME = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(PROJECT_HOME)
@@ -10,6 +12,8 @@ from flask import current_app
 from flask.ext.script import Manager, Command, Option
 from flask.ext.migrate import Migrate, MigrateCommand
 from models import db, User, Permissions, Library
+from synthetic import DatasetGenerator
+from export import export_libraries
 from biblib.app import create_app
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
@@ -102,6 +106,103 @@ class DeleteStaleUsers(Command):
             current_app.logger.info('Deleted {} stale users: {}'.format(len(removal_list), removal_list))
 
 
+class GenerateDataset(Command):
+    """
+    Generates a synthetic, production shaped, dataset of users, libraries and
+    permissions for load and scale testing
+    """
+    option_list = (
+        Option('--users', '-u', dest='users', type=int, default=1000,
+               help='Number of users'),
+        Option('--libraries-exponent', dest='libraries_exponent', type=float,
+               default=2.0,
+               help='Zipf exponent of the number of libraries of a user'),
+        Option('--max-libraries', dest='max_libraries', type=int,
+               default=100, help='Largest number of libraries of a user'),
+        Option('--size-exponent', dest='size_exponent', type=float,
+               default=1.1,
+               help='Zipf exponent of the number of bibcodes of a library'),
+        Option('--max-size', dest='max_size', type=int, default=20000,
+               help='Largest number of bibcodes of a library'),
+        Option('--bibcodes', dest='bibcodes', type=int, default=100000,
+               help='Number of distinct bibcodes'),
+        Option('--public-rate', dest='public_rate', type=float, default=0.05,
+               help='Share of the libraries that are public'),
+        Option('--share-rate', dest='share_rate', type=float, default=0.1,
+               help='Share of the libraries shared with other users'),
+        Option('--first-uid', dest='first_uid', type=int, default=None,
+               help='absolute_uid of the first user, after the existing '
+                    'users by default'),
+        Option('--batch-size', dest='batch_size', type=int, default=10000,
+               help='Number of rows loaded at once'),
+        Option('--executemany', dest='copy', action='store_false',
+               default=None, help='Load with executemany rather than COPY'),
+        Option('--seed', dest='seed', type=int, default=None,
+               help='Seed of the random generator')
+    )
+
+    @staticmethod
+    def run(app=app, **kwargs):
+        """
+        Generates and loads the dataset in the application context. The
+        numbers of rows generated are logged, as Flask-Script exits with any
+        value returned.
+        :return: no return
+        """
+        with app.app_context():
+            engine = db.get_engine(app, bind='libraries')
+            DatasetGenerator(engine, **kwargs).run()
+
+
+class ExportLibraries(Command):
+    """
+    Streams every library, with its bibcodes and permissions, as newline
+    delimited JSON
+    """
+    option_list = (
+        Option('--output', '-o', dest='output', default='-',
+               help='File to write to, standard output by default'),
+        Option('--gzip', dest='compress', action='store_true', default=False,
+               help='Compress the output with gzip'),
+        Option('--user', '-u', dest='users', type=int, action='append',
+               help='Only export the libraries owned by this absolute_uid, '
+                    'can be repeated'),
+        Option('--since', dest='since',
+               type=lambda value: datetime.strptime(value, '%Y-%m-%d'),
+               help='Only export the libraries modified since this date, '
+                    'YYYY-MM-DD'),
+        Option('--batch-size', dest='batch_size', type=int, default=1000,
+               help='Number of libraries read at once')
+    )
+
+    @staticmethod
+    def run(app=app, output='-', compress=False, users=None, since=None,
+            batch_size=1000):
+        """
+        Writes the export in the application context. The numbers of rows
+        exported are logged, as Flask-Script exits with any value returned.
+        :return: no return
+        """
+        if output == '-':
+            stream = sys.stdout
+            if compress:
+                stream = gzip.GzipFile(fileobj=sys.stdout, mode='wb')
+        elif compress:
+            stream = gzip.open(output, 'wb')
+        else:
+            stream = open(output, 'wb')
+
+        try:
+            with app.app_context():
+                export_libraries(db.session, stream, users=users,
+                                 since=since, batch_size=batch_size)
+        finally:
+            if stream is sys.stdout:
+                stream.flush()
+            else:
+                stream.close()
+
+
 # Set up the alembic migration
 migrate = Migrate(app, db, compare_type=True)
 
@@ -111,6 +212,8 @@ manager.add_command('db', MigrateCommand)
 manager.add_command('createdb', CreateDatabase())
 manager.add_command('destroydb', DestroyDatabase())
 manager.add_command('syncdb', DeleteStaleUsers())
+manager.add_command('generate', GenerateDataset())
+manager.add_command('export', ExportLibraries())
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,82 @@
+"""
+In-process metrics. Counters, gauges and timings are kept in memory for each
+worker, so that they can be inspected or shipped elsewhere without the
+application depending on a metrics backend.
+"""
+
+import threading
+from collections import defaultdict
+
+LOCK = threading.Lock()
+COUNTERS = defaultdict(int)
+GAUGES = {}
+TIMINGS = {}
+
+
+def incr(name, value=1):
+    """
+    Increment a counter
+    :param name: name of the counter
+    :param value: amount to increment it by
+    """
+    with LOCK:
+        COUNTERS[name] += value
+
+
+def gauge(name, value):
+    """
+    Set the current value of a gauge
+    :param name: name of the gauge
+    :param value: current value
+    """
+    with LOCK:
+        GAUGES[name] = value
+
+
+def timing(name, seconds):
+    """
+    Record the duration of an event
+    :param name: name of the timing
+    :param seconds: duration of the event in seconds
+    """
+    observe(name, seconds)
+
+
+def observe(name, value):
+    """
+    Record a value of a distribution, such as a duration or a ratio. Only the
+    count, total and maximum are kept.
+    :param name: name of the distribution
+    :param value: value observed
+    """
+    with LOCK:
+        stats = TIMINGS.get(name)
+        if stats is None:
+            stats = TIMINGS[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        stats['count'] += 1
+        stats['total'] += value
+        stats['max'] = max(stats['max'], value)
+
+
+def snapshot():
+    """
+    Copy of all the metrics recorded so far
+
+    :return: dictionary with the counters, gauges and timings
+    """
+    with LOCK:
+        return {
+            'counters': dict(COUNTERS),
+            'gauges': dict(GAUGES),
+            'timings': {name: dict(stats) for name, stats in TIMINGS.items()}
+        }
+
+
+def reset():
+    """
+    Forget all the metrics recorded so far
+    """
+    with LOCK:
+        COUNTERS.clear()
+        GAUGES.clear()
+        TIMINGS.clear()
@@ -0,0 +1,34 @@
+"""bibcode stored as JSONB with a GIN index
+
+Revision ID: 2e5b8ef3c9d1
+Revises: 1c82f25a268e
+Create Date: 2026-10-19 10:12:31.402118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e5b8ef3c9d1'
+down_revision = '1c82f25a268e'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.alter_column('library', 'bibcode',
+               existing_type=postgresql.JSON(),
+               type_=postgresql.JSONB(),
+               existing_nullable=True,
+               postgresql_using='bibcode::jsonb')
+    op.create_index('ix_library_bibcode', 'library', ['bibcode'],
+                    unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_library_bibcode', table_name='library')
+    op.alter_column('library', 'bibcode',
+               existing_type=postgresql.JSONB(),
+               type_=postgresql.JSON(),
+               existing_nullable=True,
+               postgresql_using='bibcode::json')
@@ -0,0 +1,23 @@
+"""version counter added to library table
+
+Revision ID: 3a1d7c0e5f42
+Revises: 2e5b8ef3c9d1
+Create Date: 2026-10-19 11:03:54.219870
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1d7c0e5f42'
+down_revision = '2e5b8ef3c9d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('library', sa.Column('version', sa.Integer(),
+                                       server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('library', 'version')
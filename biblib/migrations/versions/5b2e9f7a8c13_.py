@@ -0,0 +1,23 @@
+"""time of the last change of each user added to user table
+
+Revision ID: 5b2e9f7a8c13
+Revises: 3a1d7c0e5f42
+Create Date: 2026-10-19 16:42:08.531907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b2e9f7a8c13'
+down_revision = '3a1d7c0e5f42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('last_write', sa.DateTime(),
+                                    nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'last_write')
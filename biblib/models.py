@@ -5,15 +5,305 @@ The database is not initiated here, but a pointer is created named db. This is
 to be passed to the app creator within the Flask blueprint.
 """
 
+import os
+import time
 import uuid
+import weakref
+import threading
+import metrics
 from datetime import datetime
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy.dialects.postgresql import UUID, JSON
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, inspect, cast, literal, select, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.ext.mutable import Mutable
-from sqlalchemy.types import TypeDecorator, CHAR, String
+from sqlalchemy.types import TypeDecorator, CHAR, String, Text
+from log import get_logger
+from slow_queries import instrument_queries
 
+logger = get_logger(__name__)
 
-db = SQLAlchemy()
+# Connections of the pools of a parent process, see protect_pool_from_forks
+INHERITED_CONNECTIONS = []
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that reads the libraries bind from its read replica, when asked to
+    with use_replica. Only plain SELECT statements go to the replica: flushes,
+    other statements, and SELECT ... FOR UPDATE always go to the primary.
+    """
+    use_replica = False
+
+    def get_bind(self, mapper=None, clause=None):
+        """
+        Return the replica engine for reads of the libraries bind, otherwise
+        fall back on the normal bind selection
+        :param mapper: mapper of the entity queried
+        :param clause: clause being executed
+
+        :return: engine to use
+        """
+        if self.use_replica and not self._flushing and mapper is not None \
+                and isinstance(clause, Select) \
+                and clause._for_update_arg is None:
+            info = getattr(mapper.mapped_table, 'info', {})
+            if info.get('bind_key') == 'libraries':
+                state = get_state(self.app)
+                return state.db.get_engine(
+                    self.app,
+                    bind=self.app.config['BIBLIB_REPLICA_BIND_KEY']
+                )
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool that records how long each checkout waits for a connection
+    """
+    metric_prefix = 'pool'
+
+    def _do_get(self):
+        """
+        Check out a connection, recording the time taken
+
+        :return: connection record
+        """
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            metrics.timing('{0}.checkout_wait'.format(self.metric_prefix),
+                           time.time() - start)
+
+    def recreate(self):
+        """
+        Create a new pool with the same configuration, for example after a
+        failover invalidated all the connections
+
+        :return: new pool
+        """
+        pool = QueuePool.recreate(self)
+        pool.metric_prefix = self.metric_prefix
+        return pool
+
+
+def ping_connection(connection, branch):
+    """
+    Test a connection when it is checked out, replacing it if the database
+    dropped it, for example after a failover. This is the pessimistic
+    disconnect handling recipe of SQLAlchemy, which has no pre-ping option in
+    this version.
+
+    :param connection: connection checked out
+    :param branch: if this is a branch of an already tested connection
+    """
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as error:
+        # The connection was invalidated by the failed ping, and is replaced
+        # by a new one when used again
+        if error.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def protect_pool_from_forks(engine):
+    """
+    Keep the connections of a pool to the process that opened them. A worker
+    forked from a process with open connections, for example when gunicorn
+    preloads the application, would otherwise share their sockets with its
+    parent and its siblings. Such connections are dropped from the pool on
+    checkout and replaced with new ones. They are kept referenced, as closing
+    them, even by garbage collection, would end the session of the parent.
+
+    :param engine: engine whose pool is protected
+    """
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['pid'] = os.getpid()
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info['pid'] != pid:
+            INHERITED_CONNECTIONS.append(dbapi_connection)
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid {0}, attempting to check '
+                'out in pid {1}'.format(connection_record.info['pid'], pid)
+            )
+
+    event.listen(engine.pool, 'connect', connect)
+    event.listen(engine.pool, 'checkout', checkout)
+
+
+def instrument_pool(engine, bind):
+    """
+    Record the connections in use and the invalidated connections of the pool
+    of an engine. Only queue pools keep count of the connections in use.
+
+    :param engine: engine of the bind
+    :param bind: name of the bind
+    """
+    prefix = 'pool.{0}'.format(bind)
+    pool = engine.pool
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.gauge('{0}.in_use'.format(prefix), pool.checkedout())
+
+    def checkin(dbapi_connection, connection_record):
+        # The connection is only counted as returned once this has run
+        metrics.gauge('{0}.in_use'.format(prefix), pool.checkedout() - 1)
+
+    def invalidate(dbapi_connection, connection_record, exception):
+        metrics.incr('{0}.invalidated'.format(prefix))
+        logger.warning('Connection of bind {0} invalidated: {1}', bind,
+                       exception)
+
+    if isinstance(pool, QueuePool):
+        event.listen(pool, 'checkout', checkout)
+        event.listen(pool, 'checkin', checkin)
+    if isinstance(pool, TimedQueuePool):
+        pool.metric_prefix = prefix
+    event.listen(pool, 'invalidate', invalidate)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy extension that hands out RoutingSession sessions, and pools
+    configured from BIBLIB_POOL and instrumented for each bind, as well as
+    their statements if the bind is in BIBLIB_SLOW_QUERIES
+    """
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        # Engines whose pool and statements are instrumented
+        self.instrumented_engines = weakref.WeakSet()
+        self.instrument_lock = threading.Lock()
+
+    def create_session(self, options):
+        """
+        Creates the session
+        :param options: session options
+
+        :return: RoutingSession instance
+        """
+        return RoutingSession(self, **options)
+
+    @staticmethod
+    def get_pool_options(app, info):
+        """
+        Options of BIBLIB_POOL for the bind of a database URL. Engines are
+        created without being told their bind, so it is found from its URL.
+        Binds that share a URL share their options.
+        :param app: flask application
+        :param info: URL of the database
+
+        :return: dictionary of pool options
+        """
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[None] = app.config.get('SQLALCHEMY_DATABASE_URI')
+        for bind, pool_options in \
+                sorted(app.config.get('BIBLIB_POOL', {}).items()):
+            if binds.get(bind) and make_url(binds[bind]) == info:
+                return pool_options
+        return {}
+
+    def apply_driver_hacks(self, app, info, options):
+        """
+        Use a timed queue pool, sized by BIBLIB_POOL, for the engines of
+        databases other than SQLite
+        :param app: flask application
+        :param info: URL of the database
+        :param options: keyword arguments of sqlalchemy.create_engine
+        """
+        # Found before the driver hacks, which can change the URL
+        pool_options = self.get_pool_options(app, info)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite':
+            return
+
+        options['poolclass'] = TimedQueuePool
+        for key in ['pool_size', 'max_overflow', 'pool_timeout',
+                    'pool_recycle']:
+            if pool_options.get(key) is not None:
+                options[key] = pool_options[key]
+
+    def get_engine(self, app, bind=None):
+        """
+        Return the engine of a bind, instrumenting it the first time
+        :param app: flask application
+        :param bind: name of the bind
+
+        :return: engine
+        """
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine in self.instrumented_engines:
+            return engine
+
+        with self.instrument_lock:
+            if engine not in self.instrumented_engines:
+                self.instrument_engine(app, engine, bind)
+                self.instrumented_engines.add(engine)
+        return engine
+
+    @staticmethod
+    def instrument_engine(app, engine, bind):
+        """
+        Protect the pool of a new engine from forks, test its connections if
+        pre_ping is set in BIBLIB_POOL, and record its use
+        :param app: flask application
+        :param engine: engine of the bind
+        :param bind: name of the bind
+        """
+        protect_pool_from_forks(engine)
+        if app.config.get('BIBLIB_POOL', {}).get(bind, {}).get('pre_ping'):
+            event.listen(engine, 'engine_connect', ping_connection)
+        instrument_pool(engine, bind)
+
+        slow_queries = app.config.get('BIBLIB_SLOW_QUERIES', {}).get(bind)
+        if slow_queries is not None:
+            instrument_queries(engine, bind, slow_queries)
+
+    def warm_up(self, app):
+        """
+        Open the number of connections given by warm_up in BIBLIB_POOL for
+        each bind, so that the first requests do not pay for them. Binds that
+        cannot be reached are skipped. The connections are only used by the
+        calling process, see protect_pool_from_forks, so this has to be called
+        in every worker.
+        :param app: flask application
+        """
+        for bind, pool_options in app.config.get('BIBLIB_POOL', {}).items():
+            if bind not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+                continue
+
+            start = time.time()
+            connections = []
+            try:
+                engine = self.get_engine(app, bind=bind)
+                for i in range(pool_options.get('warm_up', 0)):
+                    connections.append(engine.connect())
+            except exc.SQLAlchemyError as error:
+                logger.warning('Could not warm up the pool of bind {0}: {1}',
+                               bind, error)
+            finally:
+                for connection in connections:
+                    connection.close()
+
+            logger.info('Opened {0} connections for bind {1} in {2:.3f}s',
+                        len(connections), bind, time.time() - start)
+
+
+db = RoutingSQLAlchemy()
 
 
 class GUID(TypeDecorator):
@@ -23,6 +313,10 @@ class GUID(TypeDecorator):
     Uses Postgresql's UUID type, otherwise uses
     CHAR(32), storing as stringified hex values.
 
+    On Postgres, psycopg2 already hands back uuid.UUID instances, so these are
+    used as they are rather than being converted to a string and back for
+    every row.
+
     Taken from http://docs.sqlalchemy.org/en/latest/core/custom_types.html
     ?highlight=guid#backend-agnostic-guid-type
 
@@ -44,7 +338,7 @@ class GUID(TypeDecorator):
         :return: native type of the database
         """
         if dialect.name == 'postgresql':
-            return dialect.type_descriptor(UUID())
+            return dialect.type_descriptor(UUID(as_uuid=True))
         else:
             return dialect.type_descriptor(CHAR(32))
 
@@ -60,7 +354,9 @@ class GUID(TypeDecorator):
         if value is None:
             return value
         elif dialect.name == 'postgresql':
-            return str(value)
+            if not isinstance(value, uuid.UUID):
+                return uuid.UUID(value)
+            return value
         else:
             if not isinstance(value, uuid.UUID):
                 return '{0:.32x}'.format(uuid.UUID(value))
@@ -77,7 +373,7 @@ class GUID(TypeDecorator):
 
         :return: value cast to the type expected
         """
-        if value is None:
+        if value is None or isinstance(value, uuid.UUID):
             return value
         else:
             return uuid.UUID(value)
@@ -105,8 +401,19 @@ class MutableDict(Mutable, dict):
     "as expected" for simple values, such as ints and strings, but not dicts.
     http://stackoverflow.com/questions/25300447/
     using-list-on-postgresql-json-type-with-sqlalchemy
+
+    The keys added and removed since the value was last in sync with the
+    database are also recorded, so that only those keys need to be written
+    when the change is flushed, see partial_update_expression.
     """
 
+    def __init__(self, *args, **kwargs):
+        """
+        Start with an empty record of changes
+        """
+        dict.__init__(self, *args, **kwargs)
+        self.reset_changes()
+
     @classmethod
     def coerce(cls, key, value):
         """
@@ -121,11 +428,38 @@ class MutableDict(Mutable, dict):
         else:
             return value
 
+    def reset_changes(self, synchronised=True):
+        """
+        Forget the keys added and removed so far
+        :param synchronised: the content is the same as in the database, so
+        later changes can be written as a partial update
+        """
+        self.synchronised = synchronised
+        self.added = {}
+        self.removed = set()
+
+    def _record_set(self, key):
+        """
+        Record that a key was added or replaced
+        :param key: key set
+        """
+        self.added[key] = dict.__getitem__(self, key)
+        self.removed.discard(key)
+
+    def _record_delete(self, key):
+        """
+        Record that a key was removed
+        :param key: key removed
+        """
+        self.added.pop(key, None)
+        self.removed.add(key)
+
     def __setitem__(self, key, value):
         """
         Detect dictionary set events and emit change events.
         """
         dict.__setitem__(self, key, value)
+        self._record_set(key)
         self.changed()
 
     def __delitem__(self, key):
@@ -133,16 +467,31 @@ class MutableDict(Mutable, dict):
         Detect dictionary del events and emit change events.
         """
         dict.__delitem__(self, key)
+        self._record_delete(key)
         self.changed()
 
-    def setdefault(self, key, value):
+    def setdefault(self, key, value=None):
         """
         Detect dictionary setdefault events and emit change events
         """
-        dict.setdefault(self, key, value)
+        if key in self:
+            return dict.__getitem__(self, key)
+
+        self[key] = value
+        return value
+
+    def update(self, *args, **kwargs):
+        """
+        Detect dictionary update events and emit a single change event,
+        regardless of the number of keys updated
+        """
+        new = dict(*args, **kwargs)
+        dict.update(self, new)
+        for key in new:
+            self._record_set(key)
         self.changed()
 
-    def pop(self, key, default):
+    def pop(self, key, *default):
         """
         Detect dictionary pop events and emit change events
         :param key: key to pop
@@ -150,9 +499,45 @@ class MutableDict(Mutable, dict):
 
         :return: the item under the given key
         """
-        dict.pop(self, key, default)
+        if key not in self:
+            return dict.pop(self, key, *default)
+
+        value = dict.pop(self, key)
+        self._record_delete(key)
+        self.changed()
+        return value
+
+    def clear(self):
+        """
+        Detect dictionary clear events and emit change events. The whole value
+        is written on the next flush.
+        """
+        dict.clear(self)
+        self.reset_changes(synchronised=False)
         self.changed()
 
+    def partial_update_expression(self, column):
+        """
+        SQL expression that applies the recorded changes to the value stored
+        in the database, using the JSONB key removal (-) and concatenation
+        (||) operators, rather than writing out the whole value. Keys are
+        removed one jsonb - text at a time, as jsonb - text[] is only
+        available from PostgreSQL 10.
+        :param column: the JSONB column the value is stored in
+
+        :return: SQL expression, or None if a partial update is not possible
+        """
+        if not self.synchronised:
+            return None
+
+        expression = column
+        for key in sorted(self.removed):
+            expression = expression.op('-')(cast(literal(key), Text))
+        if self.added:
+            expression = expression.op('||')(literal(self.added, JSONB))
+
+        return expression
+
 
 class User(db.Model):
     """
@@ -164,6 +549,10 @@ class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
     absolute_uid = db.Column(db.Integer, unique=True)
+    # When the user last changed something, by the clock of the database, so
+    # that every worker sends their reads to the primary until the read
+    # replica has caught up, see BaseView.helper_use_replica
+    last_write = db.Column(db.DateTime)
     permissions = db.relationship('Permissions',
                                   backref='user')
 
@@ -180,11 +569,20 @@ class Library(db.Model):
     """
     __bind_key__ = 'libraries'
     __tablename__ = 'library'
+    # The GIN index on the bibcodes makes it fast to find which libraries
+    # contain a given bibcode, using the JSONB key exists operators
+    __table_args__ = (
+        db.Index('ix_library_bibcode', 'bibcode', postgresql_using='gin'),
+    )
     id = db.Column(GUID, primary_key=True, default=uuid.uuid4)
     name = db.Column(db.String(50))
     description = db.Column(db.String(200))
     public = db.Column(db.Boolean)
-    bibcode = db.Column(MutableDict.as_mutable(JSON), default={})
+    bibcode = db.Column(MutableDict.as_mutable(JSONB), default={})
+    # Incremented by every modification made by a user, see
+    # BaseView.helper_bump_library_version
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
     date_created = db.Column(
         db.DateTime,
         nullable=False,
@@ -227,10 +625,23 @@ class Library(db.Model):
         one location needs to be modified (or YAGNI?).
 
         :param bibcodes: list of bibcodes
+
+        :return: number of bibcodes that were not already in the library
         """
-        if not self.bibcode:
+        if self.bibcode is None:
             self.bibcode = {}
-        [self.bibcode.setdefault(item, {}) for item in bibcodes]
+
+        # Collect the missing bibcodes first, so that only one change event is
+        # emitted however many bibcodes are added
+        new_bibcodes = {}
+        for item in bibcodes:
+            if item not in self.bibcode:
+                new_bibcodes[item] = {}
+
+        if new_bibcodes:
+            self.bibcode.update(new_bibcodes)
+
+        return len(new_bibcodes)
 
     def remove_bibcodes(self, bibcodes):
         """
@@ -245,6 +656,54 @@ class Library(db.Model):
         [self.bibcode.pop(key, None) for key in bibcodes]
 
 
+@event.listens_for(Library.bibcode, 'set', retval=True)
+def library_bibcode_set(target, value, oldvalue, initiator):
+    """
+    A value assigned to the bibcodes has nothing in common with what is in the
+    database, so it has to be written out in full on the next flush
+    """
+    if isinstance(value, dict):
+        value = MutableDict(value)
+        value.reset_changes(synchronised=False)
+    return value
+
+
+@event.listens_for(Library, 'before_update')
+def library_before_update(mapper, connection, target):
+    """
+    Replace a modified bibcode value by an expression that only writes the
+    bibcodes added and removed. Only Postgres has the JSONB operators needed,
+    other databases get the whole value.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+
+    state = inspect(target)
+    if 'bibcode' not in state.committed_state:
+        return
+
+    bibcode = state.dict.get('bibcode')
+    if not isinstance(bibcode, MutableDict):
+        return
+
+    expression = bibcode.partial_update_expression(Library.__table__.c.bibcode)
+    if expression is not None:
+        # Bypasses the attribute events, the value is expired once the
+        # UPDATE has been emitted, and is reloaded when next accessed
+        state.dict['bibcode'] = expression
+
+
+@event.listens_for(Library, 'after_insert')
+@event.listens_for(Library, 'after_update')
+def library_after_write(mapper, connection, target):
+    """
+    The bibcodes in memory are now the same as in the database
+    """
+    bibcode = inspect(target).dict.get('bibcode')
+    if isinstance(bibcode, MutableDict):
+        bibcode.reset_changes()
+
+
 class Permissions(db.Model):
     """
     Permissions table
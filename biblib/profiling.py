@@ -0,0 +1,143 @@
+"""
+Opt-in profiling of requests. When BIBLIB_PROFILING is set, a request is run
+under cProfile if it carries the BIBLIB_PROFILING_HEADER header with the value
+of BIBLIB_PROFILING_TOKEN, or if it is picked at BIBLIB_PROFILING_SAMPLE_RATE.
+The pstats output is written to BIBLIB_PROFILING_PATH, named after the time,
+end point, library and duration of the request, and only the last
+BIBLIB_PROFILING_MAX_FILES profiles are kept. The hooks are only registered
+when profiling is enabled, so it costs nothing otherwise.
+"""
+
+import os
+import time
+import random
+import cProfile
+import threading
+import metrics
+from log import get_logger
+from flask import g, request, current_app
+
+logger = get_logger(__name__)
+
+# Profiles are written by every thread of a worker
+LOCK = threading.Lock()
+
+
+def init_profiling(app):
+    """
+    Register the profiling hooks if profiling is enabled
+
+    :param app: flask.Flask application instance
+    :return: None
+    """
+    if not app.config.get('BIBLIB_PROFILING'):
+        return
+    app.before_request(start_profile)
+    app.teardown_request(stop_profile)
+
+
+def should_profile():
+    """
+    If the current request should be profiled: it asks for it with the token,
+    or it is sampled
+
+    :return: boolean
+    """
+    token = current_app.config.get('BIBLIB_PROFILING_TOKEN')
+    header = current_app.config.get('BIBLIB_PROFILING_HEADER',
+                                    'X-Biblib-Profile')
+    if token and request.headers.get(header) == token:
+        return True
+
+    rate = current_app.config.get('BIBLIB_PROFILING_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def start_profile():
+    """
+    Start profiling the request, if it should be
+    """
+    if not should_profile():
+        return
+    g.profile = cProfile.Profile()
+    g.profile_start = time.time()
+    g.profile.enable()
+
+
+def stop_profile(exception=None):
+    """
+    Stop profiling the request, and write its profile
+
+    :param exception: exception raised by the request, if any
+    """
+    profile = getattr(g, 'profile', None)
+    if profile is None:
+        return
+    profile.disable()
+    g.profile = None
+    duration = time.time() - g.profile_start
+
+    try:
+        path = write_profile(
+            profile,
+            directory=current_app.config.get('BIBLIB_PROFILING_PATH',
+                                             '/tmp/biblib.profiles'),
+            max_files=current_app.config.get('BIBLIB_PROFILING_MAX_FILES', 50),
+            endpoint=request.endpoint,
+            library=(request.view_args or {}).get('library'),
+            duration=duration
+        )
+    except (IOError, OSError) as error:
+        logger.warning('Could not write profile: {0}', error)
+        return
+
+    metrics.incr('profiling.profiles')
+    logger.info('Profiled {0} {1} in {2:.3f}s: {3}',
+                request.method, request.path, duration, path)
+
+
+def profile_name(endpoint, library, duration):
+    """
+    File name of a profile, which sorts by the time it was written
+
+    :param endpoint: end point of the request
+    :param library: library id of the request, or None
+    :param duration: duration of the request in seconds
+    :return: file name
+    """
+    return '{time:.6f}-{endpoint}-{library}-{duration:d}ms.prof'.format(
+        time=time.time(),
+        endpoint=endpoint or 'none',
+        library=library or 'none',
+        duration=int(duration * 1000)
+    )
+
+
+def write_profile(profile, directory, max_files, endpoint, library,
+                  duration):
+    """
+    Write a profile to the ring of profiles, removing the oldest ones beyond
+    the maximum number of files
+
+    :param profile: cProfile.Profile instance
+    :param directory: directory of the profiles
+    :param max_files: maximum number of profiles kept
+    :param endpoint: end point of the request
+    :param library: library id of the request, or None
+    :param duration: duration of the request in seconds
+    :return: path of the profile
+    """
+    with LOCK:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        path = os.path.join(directory,
+                            profile_name(endpoint, library, duration))
+        profile.dump_stats(path)
+
+        profiles = sorted(name for name in os.listdir(directory)
+                          if name.endswith('.prof'))
+        for name in profiles[:max(len(profiles) - max_files, 0)]:
+            os.remove(os.path.join(directory, name))
+
+    return path
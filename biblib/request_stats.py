@@ -0,0 +1,90 @@
+"""
+Opt-in accounting of the work done by each request, for load tests. When
+BIBLIB_REQUEST_STATS is set, the SQL statements run and the calls made to
+upstream services while serving a request are counted, and returned with the
+time spent in the worker in the X-Biblib-Sql-Statements,
+X-Biblib-Upstream-Calls and X-Biblib-Server-Time headers. The load-test
+harness aggregates them per end point, whichever worker served the request.
+"""
+
+import time
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SQL_HEADER = 'X-Biblib-Sql-Statements'
+UPSTREAM_HEADER = 'X-Biblib-Upstream-Calls'
+TIME_HEADER = 'X-Biblib-Server-Time'
+
+
+def init_request_stats(app):
+    """
+    Register the accounting hooks if request stats are enabled
+
+    :param app: flask.Flask application instance
+    :return: None
+    """
+    if not app.config.get('BIBLIB_REQUEST_STATS'):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', count_statement):
+        event.listen(Engine, 'before_cursor_execute', count_statement)
+    app.before_request(start_request_stats)
+    app.after_request(add_request_stats)
+
+
+def current_stats():
+    """
+    Stats of the current request, if they are being kept
+
+    :return: dictionary, or None
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, 'request_stats', None)
+
+
+def count_statement(connection, cursor, statement, parameters, context,
+                    executemany):
+    """
+    Engine hook: count a SQL statement of the current request
+    """
+    stats = current_stats()
+    if stats is not None:
+        stats['sql'] += 1
+
+
+def count_upstream_call(response, *args, **kwargs):
+    """
+    requests response hook: count a call to an upstream service
+
+    :param response: requests.Response
+    :return: None, so that the response is kept
+    """
+    stats = current_stats()
+    if stats is not None:
+        stats['upstream'] += 1
+
+
+def start_request_stats():
+    """
+    Start the accounting of the request
+    """
+    g.request_stats = {'sql': 0, 'upstream': 0, 'start': time.time()}
+
+
+def add_request_stats(response):
+    """
+    After request hook: add the stats of the request to its response
+
+    :param response: flask response
+    :return: the same response
+    """
+    stats = current_stats()
+    if stats is None:
+        return response
+    response.headers[SQL_HEADER] = str(stats['sql'])
+    response.headers[UPSTREAM_HEADER] = str(stats['upstream'])
+    response.headers[TIME_HEADER] = '{0:.6f}'.format(
+        time.time() - stats['start']
+    )
+    return response
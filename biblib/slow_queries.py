@@ -0,0 +1,263 @@
+"""
+Slow query log. The statements of an engine that take longer than the
+threshold of its bind in BIBLIB_SLOW_QUERIES are logged to the
+biblib.slow_queries logger, with the shape of their parameters and the
+function of biblib they come from. On Postgres, the plan of each new slow
+statement is captured with EXPLAIN by a background thread, so that the request
+does not wait for it. The slowest statements since the worker started are kept
+for the admin end point.
+"""
+
+import os
+import time
+import Queue
+import threading
+import traceback
+import metrics
+from log import get_logger
+from sqlalchemy import event
+
+logger = get_logger(__name__)
+
+# Statements of the slow queries, and their statistics, shared by all threads
+LOCK = threading.Lock()
+SLOW_QUERIES = {}
+
+# Statements worth explaining, those that EXPLAIN does not run
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+# Frames of these files are skipped when looking for the origin of a query
+SOURCE_PATH = os.path.dirname(os.path.abspath(__file__))
+SKIPPED_PATHS = (os.path.join(SOURCE_PATH, 'slow_queries.py'),
+                 os.path.join(SOURCE_PATH, 'tests'))
+
+
+def value_shape(value):
+    """
+    Shape of a bound parameter: its type, and length for collections
+
+    :param value: value of the parameter
+    :return: string
+    """
+    if isinstance(value, (list, tuple, set, dict)):
+        return '{0}[{1:d}]'.format(type(value).__name__, len(value))
+    return type(value).__name__
+
+
+def parameter_shape(parameters):
+    """
+    Shape of the bound parameters of a statement, without their values
+
+    :param parameters: parameters as passed to the DBAPI cursor
+    :return: string
+    """
+    if isinstance(parameters, dict):
+        return '{{{0}}}'.format(', '.join(
+            '{0}: {1}'.format(key, value_shape(value))
+            for key, value in sorted(parameters.items())
+        ))
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return '{0:d} x {1}'.format(len(parameters),
+                                        parameter_shape(parameters[0]))
+        return '({0})'.format(', '.join(value_shape(value)
+                                        for value in parameters))
+    return value_shape(parameters)
+
+
+def query_origin():
+    """
+    Innermost function of biblib, outside of this module and the tests, that
+    is running
+
+    :return: string, file:line function
+    """
+    for filename, line, function, _ in reversed(traceback.extract_stack()):
+        filename = os.path.abspath(filename)
+        if filename.startswith(SOURCE_PATH) and \
+                not filename.startswith(SKIPPED_PATHS):
+            return '{0}:{1:d} {2}'.format(
+                os.path.relpath(filename, SOURCE_PATH), line, function
+            )
+    return 'unknown'
+
+
+def record_slow_query(bind, statement, parameters, duration, max_statements):
+    """
+    Record an execution of a slow statement
+
+    :param bind: name of the bind
+    :param statement: SQL statement
+    :param parameters: parameters of the statement
+    :param duration: duration in seconds
+    :param max_statements: maximum number of statements kept
+    :return: True if the statement was not slow before
+    """
+    origin = query_origin()
+    shape = parameter_shape(parameters)
+    metrics.incr('slow_queries.{0}'.format(bind))
+    logger.warning('Slow query on {0}: {1:.3f}s from {2}, parameters {3}: '
+                   '{4}', bind, duration, origin, shape, statement)
+
+    with LOCK:
+        stats = SLOW_QUERIES.get((bind, statement))
+        new = stats is None
+        if new:
+            if len(SLOW_QUERIES) >= max_statements:
+                return False
+            stats = SLOW_QUERIES[(bind, statement)] = dict(
+                bind=bind,
+                statement=statement,
+                parameters=shape,
+                origin=origin,
+                count=0,
+                total=0.0,
+                max=0.0,
+                plan=None
+            )
+        stats['count'] += 1
+        stats['total'] += duration
+        stats['max'] = max(stats['max'], duration)
+    return new
+
+
+def get_slow_queries(number=10):
+    """
+    The slowest statements recorded, by their longest execution
+
+    :param number: number of statements returned
+    :return: list of dictionaries
+    """
+    with LOCK:
+        slow_queries = [dict(stats) for stats in SLOW_QUERIES.values()]
+    slow_queries.sort(key=lambda stats: stats['max'], reverse=True)
+    return slow_queries[:number]
+
+
+def reset():
+    """
+    Forget the slow queries recorded
+    """
+    with LOCK:
+        SLOW_QUERIES.clear()
+
+
+class Explainer(object):
+    """
+    Thread that captures the plans of slow statements, one at a time. Plans
+    are dropped when too many are waiting.
+    """
+
+    def __init__(self, maxsize=100):
+        """
+        Constructor
+        :param maxsize: maximum number of plans waiting to be captured
+        """
+        self.queue = Queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, engine, bind, statement, parameters):
+        """
+        Queue the capture of the plan of a statement
+
+        :param engine: engine to run EXPLAIN on
+        :param bind: name of the bind
+        :param statement: SQL statement
+        :param parameters: parameters of the statement
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.serve,
+                                               name='biblib-explain')
+                self.thread.daemon = True
+                self.thread.start()
+        try:
+            self.queue.put_nowait((engine, bind, statement, parameters))
+        except Queue.Full:
+            metrics.incr('slow_queries.explain_dropped')
+
+    def serve(self):
+        """
+        Capture the plans queued
+        """
+        while True:
+            self.explain(*self.queue.get())
+            self.queue.task_done()
+
+    @staticmethod
+    def explain(engine, bind, statement, parameters):
+        """
+        Capture the plan of a statement, without running it, and keep it with
+        the statistics of the statement
+
+        :param engine: engine to run EXPLAIN on
+        :param bind: name of the bind
+        :param statement: SQL statement
+        :param parameters: parameters of the statement
+        """
+        try:
+            # The DBAPI cursor is used so that EXPLAIN is not timed itself
+            connection = engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute('EXPLAIN (ANALYZE off) ' + statement,
+                               parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                cursor.close()
+            finally:
+                connection.close()
+        except Exception as error:
+            logger.warning('Could not explain slow query: {0}', error)
+            return
+
+        with LOCK:
+            stats = SLOW_QUERIES.get((bind, statement))
+            if stats is not None:
+                stats['plan'] = plan
+        logger.warning('Plan of slow query on {0}: {1}\n{2}', bind, statement,
+                       plan)
+
+
+EXPLAINER = Explainer()
+
+
+def instrument_queries(engine, bind, settings):
+    """
+    Time the statements of an engine, and record those over the threshold
+
+    :param engine: engine of the bind
+    :param bind: name of the bind
+    :param settings: dictionary with threshold, in seconds, explain, and
+                     max_statements, the number of statements kept
+    """
+    threshold = settings.get('threshold', 0.1)
+    explain = settings.get('explain', True) and \
+        engine.dialect.name == 'postgresql'
+    max_statements = settings.get('max_statements', 1000)
+
+    def before_cursor_execute(connection, cursor, statement, parameters,
+                              context, executemany):
+        connection.info.setdefault('query_start', []).append(time.time())
+
+    def after_cursor_execute(connection, cursor, statement, parameters,
+                             context, executemany):
+        duration = time.time() - connection.info['query_start'].pop()
+        if duration < threshold:
+            return
+
+        new = record_slow_query(bind, statement, parameters, duration,
+                                max_statements)
+        if new and explain and not executemany and \
+                statement.lstrip().upper().startswith(EXPLAINABLE):
+            EXPLAINER.submit(engine, bind, statement, parameters)
+
+    def handle_error(exception_context):
+        # The statement failed, after_cursor_execute is not called
+        if exception_context.connection is not None and \
+                exception_context.connection.info.get('query_start'):
+            exception_context.connection.info['query_start'].pop()
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(engine, 'handle_error', handle_error)
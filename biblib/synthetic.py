@@ -0,0 +1,362 @@
+"""
+Generator of synthetic, production shaped, data for load and scale testing.
+Users own a Zipf distributed number of libraries, whose sizes are also Zipf
+distributed, filled with 19 character bibcodes drawn from a corpus where a few
+papers are far more popular than the rest. Some libraries are public, and some
+are shared with other users with read, write or admin permissions.
+
+The rows are bulk loaded in batches, with COPY on Postgres and executemany
+otherwise, so that millions of users take minutes rather than hours.
+"""
+
+import csv
+import json
+import time
+import uuid
+import bisect
+import random
+import cStringIO
+from datetime import datetime, timedelta
+from log import get_logger
+from models import User, Library, Permissions
+
+logger = get_logger(__name__)
+
+# Abbreviations of journals, padded to the 5 characters of a bibcode
+JOURNALS = [
+    'ApJ..', 'ApJS.', 'AJ...', 'MNRAS', 'A&A..', 'PASP.', 'Natur', 'Sci..',
+    'PhRvD', 'PhRvL', 'Icar.', 'JGRA.', 'GeoRL', 'SoPh.', 'arXiv', 'AAS..',
+    'SPIE.', 'ARA&A', 'P&SS.', 'CQGra'
+]
+
+# Share of the shared permissions that are read, write and admin
+ACCESS = [('read', 0.7), ('write', 0.2), ('admin', 0.1)]
+
+# Columns loaded, in the order of the rows generated
+USER_COLUMNS = ('absolute_uid',)
+LIBRARY_COLUMNS = ('id', 'name', 'description', 'public', 'bibcode', 'version',
+                   'date_created', 'date_last_modified')
+PERMISSION_COLUMNS = ('read', 'write', 'admin', 'owner', 'user_id',
+                      'library_id')
+
+
+class ZipfSampler(object):
+    """
+    Draws integers from 1 to maximum, with a probability proportional to
+    1 / k ** exponent
+    """
+
+    def __init__(self, exponent, maximum, rng):
+        """
+        Constructor
+        :param exponent: exponent of the distribution, larger is more skewed
+        :param maximum: largest integer drawn
+        :param rng: random.Random instance
+        """
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for k in range(1, maximum + 1):
+            total += 1.0 / k ** exponent
+            self.cumulative.append(total)
+
+    def __call__(self):
+        """
+        Draw an integer
+        :return: integer
+        """
+        return bisect.bisect_left(
+            self.cumulative, self.rng.random() * self.cumulative[-1]
+        ) + 1
+
+
+def synthetic_bibcode(rng):
+    """
+    A 19 character bibcode: year, journal, volume, qualifier, page and the
+    initial of the first author, padded with dots, eg., 2015ApJ...805..123S
+
+    :param rng: random.Random instance
+    :return: bibcode
+    """
+    return '{year:d}{journal}{volume:.>4d}{qualifier}{page:.>4d}{author}'\
+        .format(
+            year=rng.randint(1950, 2016),
+            journal=rng.choice(JOURNALS),
+            volume=rng.randint(1, 999),
+            qualifier='L' if rng.random() < 0.05 else '.',
+            page=rng.randint(1, 9999),
+            author=chr(rng.randint(ord('A'), ord('Z')))
+        )
+
+
+def bibcode_corpus(size, rng):
+    """
+    Distinct bibcodes, the first ones being the most popular when drawn with
+    popular_bibcodes
+
+    :param size: number of bibcodes
+    :param rng: random.Random instance
+    :return: list of bibcodes
+    """
+    corpus = set()
+    while len(corpus) < size:
+        corpus.add(synthetic_bibcode(rng))
+    corpus = list(corpus)
+    rng.shuffle(corpus)
+    return corpus
+
+
+def popular_bibcodes(corpus, number, rng):
+    """
+    Distinct bibcodes of the corpus, skewed towards the popular ones
+
+    :param corpus: list of bibcodes, the most popular first
+    :param number: number of bibcodes
+    :param rng: random.Random instance
+    :return: set of bibcodes
+    """
+    number = min(number, len(corpus))
+    bibcodes = set()
+    while len(bibcodes) < number:
+        bibcodes.add(corpus[int(len(corpus) * rng.random() ** 2)])
+    return bibcodes
+
+
+def copy_rows(connection, table, columns, rows):
+    """
+    Load rows into a table with COPY
+
+    :param connection: psycopg2 connection
+    :param table: name of the table
+    :param columns: names of the columns
+    :param rows: list of tuples
+    """
+    buffer = cStringIO.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+    buffer.seek(0)
+
+    cursor = connection.cursor()
+    cursor.copy_expert(
+        'COPY "{0}" ({1}) FROM STDIN WITH CSV'.format(table,
+                                                     ', '.join(columns)),
+        buffer
+    )
+    cursor.close()
+
+
+def insert_rows(connection, table, columns, rows):
+    """
+    Load rows into a table with executemany
+
+    :param connection: DBAPI connection
+    :param table: name of the table
+    :param columns: names of the columns
+    :param rows: list of tuples
+    """
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns))
+        ),
+        rows
+    )
+    cursor.close()
+
+
+class DatasetGenerator(object):
+    """
+    Generates and loads users, libraries and permissions in batches
+    """
+
+    def __init__(self, engine, users=1000, libraries_exponent=2.0,
+                 max_libraries=100, size_exponent=1.1, max_size=20000,
+                 bibcodes=100000, public_rate=0.05, share_rate=0.1,
+                 max_shares=20, first_uid=None, batch_size=10000, copy=None,
+                 seed=None):
+        """
+        Constructor
+        :param engine: engine of the libraries database
+        :param users: number of users
+        :param libraries_exponent: exponent of the number of libraries owned
+        by a user
+        :param max_libraries: largest number of libraries owned by a user
+        :param size_exponent: exponent of the number of bibcodes in a library
+        :param max_size: largest number of bibcodes in a library
+        :param bibcodes: number of distinct bibcodes
+        :param public_rate: share of the libraries that are public
+        :param share_rate: share of the libraries shared with other users
+        :param max_shares: largest number of users a library is shared with
+        :param first_uid: absolute_uid of the first user, after the existing
+        users by default
+        :param batch_size: number of rows loaded at once
+        :param copy: load with COPY, by default when the database is Postgres
+        :param seed: seed of the random generator, for a reproducible dataset
+        """
+        self.engine = engine
+        self.users = users
+        self.bibcodes = bibcodes
+        self.public_rate = public_rate
+        self.share_rate = share_rate
+        self.first_uid = first_uid
+        self.batch_size = batch_size
+        self.copy = engine.dialect.driver == 'psycopg2' \
+            if copy is None else copy
+
+        self.rng = random.Random(seed)
+        self.library_count = ZipfSampler(libraries_exponent, max_libraries,
+                                         self.rng)
+        self.library_size = ZipfSampler(size_exponent, max_size, self.rng)
+        self.share_count = ZipfSampler(2.0, max_shares, self.rng)
+
+        self.counts = dict(users=0, libraries=0, bibcodes=0, permissions=0)
+
+    def load(self, connection, table, columns, rows):
+        """
+        Load rows with COPY or executemany
+
+        :param connection: DBAPI connection
+        :param table: name of the table
+        :param columns: names of the columns
+        :param rows: list of tuples
+        """
+        if not rows:
+            return
+        if self.copy:
+            copy_rows(connection, table, columns, rows)
+        else:
+            insert_rows(connection, table, columns, rows)
+
+    def access(self):
+        """
+        Permission given to a user a library is shared with
+
+        :return: tuple of read, write, admin
+        """
+        value = self.rng.random()
+        for name, share in ACCESS:
+            if value < share:
+                break
+            value -= share
+        return tuple(name == key for key, _ in ACCESS)
+
+    def load_users(self, connection):
+        """
+        Load the users, and return their ids
+
+        :param connection: DBAPI connection
+        :return: list of user ids
+        """
+        cursor = connection.cursor()
+        if self.first_uid is None:
+            cursor.execute('SELECT coalesce(max(absolute_uid), 0) + 1 '
+                           'FROM "{0}"'.format(User.__tablename__))
+            self.first_uid = cursor.fetchone()[0]
+
+        last_uid = self.first_uid + self.users
+        for start in range(self.first_uid, last_uid, self.batch_size):
+            self.load(
+                connection, User.__tablename__, USER_COLUMNS,
+                [(uid,) for uid in
+                 range(start, min(start + self.batch_size, last_uid))]
+            )
+
+        cursor.execute(
+            'SELECT id FROM "{0}" WHERE absolute_uid >= %s AND '
+            'absolute_uid < %s ORDER BY absolute_uid'
+            .format(User.__tablename__),
+            (self.first_uid, last_uid)
+        )
+        user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        self.counts['users'] = len(user_ids)
+        return user_ids
+
+    def libraries(self, user_ids, corpus):
+        """
+        Libraries and permissions of the users, in batches
+
+        :param user_ids: ids of the users
+        :param corpus: list of bibcodes
+        :return: generator of lists of library and permission rows
+        """
+        libraries, permissions = [], []
+        now = datetime.utcnow()
+
+        for user_id in user_ids:
+            for number in range(self.library_count()):
+                library_id = str(uuid.uuid4())
+                bibcodes = popular_bibcodes(corpus, self.library_size(),
+                                            self.rng)
+                age = self.rng.randint(0, 5 * 365 * 24 * 3600)
+                created = now - timedelta(seconds=age)
+                libraries.append((
+                    library_id,
+                    'Library {0:d}'.format(number + 1),
+                    'Synthetic library of {0:d} bibcodes'
+                    .format(len(bibcodes)),
+                    self.rng.random() < self.public_rate,
+                    json.dumps(dict.fromkeys(bibcodes, {})),
+                    1,
+                    created,
+                    created + timedelta(seconds=self.rng.randint(0, age))
+                ))
+                permissions.append(
+                    (False, False, False, True, user_id, library_id)
+                )
+                self.counts['bibcodes'] += len(bibcodes)
+
+                if len(user_ids) > 1 and self.rng.random() < self.share_rate:
+                    shared = set()
+                    for _ in range(min(self.share_count(),
+                                       len(user_ids) - 1)):
+                        other = self.rng.choice(user_ids)
+                        if other == user_id or other in shared:
+                            continue
+                        shared.add(other)
+                        permissions.append(
+                            self.access() + (False, other, library_id)
+                        )
+
+                if len(libraries) >= self.batch_size:
+                    yield libraries, permissions
+                    libraries, permissions = [], []
+
+        if libraries:
+            yield libraries, permissions
+
+    def run(self):
+        """
+        Generate and load the dataset, committing after each batch
+
+        :return: dictionary of the number of rows generated
+        """
+        start = time.time()
+        corpus = bibcode_corpus(self.bibcodes, self.rng)
+
+        connection = self.engine.raw_connection()
+        try:
+            user_ids = self.load_users(connection)
+            connection.commit()
+            logger.info('Loaded {0} users in {1:.1f}s', len(user_ids),
+                        time.time() - start)
+
+            for libraries, permissions in self.libraries(user_ids, corpus):
+                self.load(connection, Library.__tablename__, LIBRARY_COLUMNS,
+                          libraries)
+                self.load(connection, Permissions.__tablename__,
+                          PERMISSION_COLUMNS, permissions)
+                connection.commit()
+
+                self.counts['libraries'] += len(libraries)
+                self.counts['permissions'] += len(permissions)
+                logger.info('Loaded {0} libraries, {1} permissions in '
+                            '{2:.1f}s', self.counts['libraries'],
+                            self.counts['permissions'], time.time() - start)
+        finally:
+            connection.close()
+
+        logger.info('Generated {0} in {1:.1f}s', self.counts,
+                    time.time() - start)
+        return self.counts
@@ -2,16 +2,28 @@
 Common utilities used by the test classes
 """
 
+import os
 import re
 import json
+import time
+import atexit
 from flask import current_app
 from flask.ext.testing import TestCase
+from flask.ext.sqlalchemy import get_state
 from biblib import app
 from httpretty import HTTPretty
-from biblib.models import db
+from biblib.models import db, RoutingSession
+from biblib.views.library_view import SOLR_BIG_QUERY_BREAKER
 from biblib.utils import assert_unsorted_equal
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session
 import testing.postgresql
 
+# Postgres instance of the process, see get_postgresql, and the databases
+# whose schema has been created for the transaction isolation
+POSTGRESQL = None
+SCHEMAS = set()
+
 
 class HTTPrettyContext(object):
 
@@ -200,6 +212,7 @@ class MockSolrBigqueryService(MockADSWSAPI):
                 resp.pop('response')
 
             resp = json.dumps(resp)
+            time.sleep(self.kwargs.get('delay', 0))
 
             status = self.kwargs.get('status', 200)
             return status, headers, resp
@@ -266,24 +279,71 @@ class MockEmailService(MockADSWSAPI):
         )
 
 
+def get_postgresql():
+    """
+    Postgres instance of the test process, started the first time it is needed
+    and stopped when the process exits. It listens on a free port, so that
+    test processes running in parallel, eg., with nosetests --processes=4,
+    each have their own database.
+
+    :return: testing.postgresql.Postgresql instance
+    """
+    global POSTGRESQL
+    if POSTGRESQL is None:
+        POSTGRESQL = testing.postgresql.Postgresql()
+        atexit.register(POSTGRESQL.stop)
+    return POSTGRESQL
+
+
+class TransactionalSession(RoutingSession):
+    """
+    Session of the transaction isolation of the tests: every statement goes
+    through the connection of the test, whichever bind it is for, and each
+    session runs in a savepoint that is started again whenever the code
+    commits or rolls back.
+    """
+
+    def __init__(self, db, connection):
+        """
+        Constructor
+        :param db: flask_sqlalchemy.SQLAlchemy instance
+        :param connection: connection holding the transaction of the test
+        """
+        super(TransactionalSession, self).__init__(db, bind=connection,
+                                                   binds={})
+        self.begin_nested()
+        event.listen(self, 'after_transaction_end', self.restart_savepoint)
+
+    def get_bind(self, mapper=None, clause=None):
+        """
+        The connection of the test
+        """
+        return self.bind
+
+    @staticmethod
+    def restart_savepoint(session, transaction):
+        """
+        Start a new savepoint when the one of the session ends
+        """
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+
 class TestCaseDatabase(TestCase):
     """
     Base test class for when databases are being used.
+
+    With the default 'transaction' isolation, the schema is created once, and
+    each test runs in a transaction of its own that is rolled back when it
+    ends. Tests that use the database from other threads or connections, which
+    cannot see that transaction, set isolation to 'schema' to have the schema
+    created and dropped around each of them instead. The BIBLIB_TEST_ISOLATION
+    environment variable sets the isolation of every test.
     """
+    isolation = 'transaction'
 
-    postgresql_url_dict = {
-        'port': 1234,
-        'host': '127.0.0.1',
-        'user': 'postgres',
-        'database': 'test'
-    }
-    postgresql_url = 'postgresql://{user}@{host}:{port}/{database}'\
-        .format(
-            user=postgresql_url_dict['user'],
-            host=postgresql_url_dict['host'],
-            port=postgresql_url_dict['port'],
-            database=postgresql_url_dict['database']
-        )
+    postgresql_url = None
 
     def create_app(self):
         """
@@ -298,12 +358,8 @@ class TestCaseDatabase(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        cls.postgresql = \
-            testing.postgresql.Postgresql(**cls.postgresql_url_dict)
-
-    @classmethod
-    def tearDownClass(cls):
-        cls.postgresql.stop()
+        cls.postgresql = get_postgresql()
+        TestCaseDatabase.postgresql_url = cls.postgresql.url()
 
     def setUp(self):
         """
@@ -311,10 +367,32 @@ class TestCaseDatabase(TestCase):
 
         :return: no return
         """
+        isolation = os.environ.get('BIBLIB_TEST_ISOLATION', self.isolation)
+        current_app.logger.info('Setting up db on: {0}, isolation: {1}'
+                                .format(current_app.config['SQLALCHEMY_BINDS'],
+                                        isolation))
+
+        # Failed Solr calls of other tests must not open the circuit breaker
+        SOLR_BIG_QUERY_BREAKER.reset()
+
+        self.connection = None
+        if isolation != 'transaction':
+            SCHEMAS.discard(self.postgresql_url)
+            db.create_all()
+            return
 
-        current_app.logger.info('Setting up db on: {0}'
-                                .format(current_app.config['SQLALCHEMY_BINDS']))
-        db.create_all()
+        if self.postgresql_url not in SCHEMAS:
+            db.create_all()
+            SCHEMAS.add(self.postgresql_url)
+
+        db.session.remove()
+        self.session = db.session
+        self.connection = db.get_engine(current_app, bind='libraries')\
+            .connect()
+        self.transaction = self.connection.begin()
+        db.session = scoped_session(
+            lambda: TransactionalSession(db, self.connection)
+        )
 
     def tearDown(self):
         """
@@ -323,7 +401,17 @@ class TestCaseDatabase(TestCase):
         :return: no return
         """
         db.session.remove()
-        db.drop_all()
+        if self.connection is None:
+            db.drop_all()
+        else:
+            db.session = self.session
+            self.transaction.rollback()
+            self.connection.close()
+
+        # Each test has an application of its own, whose pools would otherwise
+        # keep their connections to the database of the process open
+        for bind in get_state(current_app).connectors:
+            db.get_engine(current_app, bind=bind).dispose()
 
     def assertUnsortedEqual(self, hashable_1, hashable_2):
         """
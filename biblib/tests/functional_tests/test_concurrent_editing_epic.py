@@ -0,0 +1,107 @@
+"""
+Functional test
+
+Concurrent Editing Epic
+
+Storyboard is defined within the comments of the program itself
+"""
+
+import time
+import json
+import unittest
+import threading
+from Queue import Queue, Empty
+from flask import url_for
+from biblib.models import Library
+from biblib.views import BaseView
+from biblib.tests.stubdata.stub_data import UserShop, LibraryShop
+from biblib.tests.base import TestCaseDatabase
+
+
+class TestConcurrentEditingEpic(TestCaseDatabase):
+    """
+    Base class used to test the Concurrent Editing Epic
+    """
+    # The editors commit from connections of their own, in other threads
+    isolation = 'schema'
+
+    number_of_requests = 200
+    number_of_threads = 10
+
+    def test_concurrent_editing_epic(self):
+        """
+        Carries out the epic 'Concurrent Editing', where a group of editors
+        add documents to the same library at the same time, and none of their
+        additions are lost
+
+        :return: no return
+        """
+
+        # Mary creates a library for her research group
+        user_mary = UserShop()
+        stub_library = LibraryShop(want_bibcode=False)
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=stub_library.user_view_post_data_json,
+            headers=user_mary.headers
+        )
+        self.assertEqual(response.status_code, 200, response)
+        library_id = response.json['id']
+
+        # The whole group then adds a document each, all at the same time
+        bibcodes = ['2016TEST.{0:06d}...A'.format(i)
+                    for i in range(self.number_of_requests)]
+        url = url_for('documentview', library=library_id)
+
+        jobs = Queue()
+        for bibcode in bibcodes:
+            jobs.put(bibcode)
+        status_codes = []
+
+        def editor():
+            client = self.app.test_client()
+            while True:
+                try:
+                    bibcode = jobs.get_nowait()
+                except Empty:
+                    return
+                response = client.post(
+                    url,
+                    data=json.dumps({'bibcode': [bibcode], 'action': 'add'}),
+                    headers=user_mary.headers
+                )
+                status_codes.append(response.status_code)
+
+        editors = [threading.Thread(target=editor)
+                   for i in range(self.number_of_threads)]
+        start = time.time()
+        for thread in editors:
+            thread.start()
+        for thread in editors:
+            thread.join()
+        elapsed = time.time() - start
+
+        self.app.logger.info(
+            '{0} concurrent additions in {1:.2f}s ({2:.1f} requests/s)'
+            .format(self.number_of_requests,
+                    elapsed,
+                    self.number_of_requests / elapsed)
+        )
+
+        # Every editor was told their document was added
+        self.assertEqual(len(status_codes), self.number_of_requests)
+        self.assertEqual(set(status_codes), {200})
+
+        # And none of the documents were lost along the way
+        library = Library.query\
+            .filter(Library.id == BaseView.helper_slug_to_uuid(library_id))\
+            .populate_existing()\
+            .one()
+        self.assertUnsortedEqual(library.get_bibcodes(), bibcodes)
+        self.assertEqual(library.version, self.number_of_requests + 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
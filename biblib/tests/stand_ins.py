@@ -0,0 +1,308 @@
+"""
+Stand-in servers of the services biblib depends on, for load testing.
+
+They serve Solr bigquery, the user email resolver of the API, and the ADS
+Classic and ADS 2.0 harbour end points. Unlike the HTTPretty mocks of base.py,
+they are real HTTP servers, so that biblib can be load tested end to end under
+gunicorn on one machine.
+
+Each service answers after a latency drawn from a log-normal distribution,
+and fails or hangs at the rates of its profile. The data returned is derived
+from the request alone, so any number of workers give the same answers, and
+the users match those of `manage.py generate`: user N has the email
+userN@example.com.
+
+Usage:
+    python biblib/tests/stand_ins.py [--profile production] [--port 5001]
+    gunicorn -w 4 -k gevent -b :5001 \\
+        -e STAND_IN_PROFILE=production biblib.tests.stand_ins:application
+
+and point biblib at them with, eg., for port 5001:
+    BIBLIB_SOLR_BIG_QUERY_URL = 'http://localhost:5001/bigquery'
+    BIBLIB_USER_EMAIL_ADSWS_API_URL = 'http://localhost:5001/user'
+    BIBLIB_CLASSIC_SERVICE_URL = 'http://localhost:5001/classic'
+    BIBLIB_TWOPOINTOH_SERVICE_URL = 'http://localhost:5001/twopointoh'
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import math
+import time
+import zlib
+import random
+import argparse
+from flask import Flask, request, jsonify
+
+# Latency, in seconds, and failures of each service. latency is the median,
+# and sigma the spread of the log-normal distribution. A request fails with
+# error_status at error_rate, and hangs for hang seconds at hang_rate.
+PROFILES = {
+    'fast': {
+        'bigquery': {'latency': 0, 'sigma': 0},
+        'user': {'latency': 0, 'sigma': 0},
+        'harbour': {'latency': 0, 'sigma': 0}
+    },
+    'production': {
+        'bigquery': {'latency': 0.15, 'sigma': 0.5, 'error_rate': 0.001},
+        'user': {'latency': 0.02, 'sigma': 0.3, 'error_rate': 0.001},
+        'harbour': {'latency': 0.5, 'sigma': 0.5, 'error_rate': 0.01}
+    },
+    'degraded': {
+        'bigquery': {'latency': 1.0, 'sigma': 0.8, 'error_rate': 0.05,
+                     'hang_rate': 0.01, 'hang': 60},
+        'user': {'latency': 0.2, 'sigma': 0.8, 'error_rate': 0.05},
+        'harbour': {'latency': 2.0, 'sigma': 0.8, 'error_rate': 0.1,
+                    'hang_rate': 0.01, 'hang': 60}
+    }
+}
+
+# Share of the bibcodes that are an alternate of another, canonical, bibcode,
+# and share of those that Solr does not know of
+ALTERNATE_RATE = 0.02
+MISSING_RATE = 0.001
+
+EMAIL = re.compile(r'^user(\d+)@example\.com$')
+
+
+def key_random(*key):
+    """
+    Random generator seeded by a key, so that every worker derives the same
+    data for it
+
+    :param key: strings
+    :return: random.Random instance
+    """
+    return random.Random(zlib.crc32('|'.join(str(part) for part in key)))
+
+
+def document(bibcode, fields):
+    """
+    Solr document of a bibcode, with the fields asked for. A share of the
+    bibcodes are alternates, whose document has another canonical bibcode.
+
+    :param bibcode: bibcode requested
+    :param fields: list of Solr fields
+    :return: dictionary, or None if Solr does not know the bibcode
+    """
+    rng = key_random('document', bibcode)
+    value = rng.random()
+    if value < MISSING_RATE:
+        return None
+
+    canonical = bibcode
+    alternates = []
+    if value < MISSING_RATE + ALTERNATE_RATE:
+        canonical = '{0:d}{1}'.format(int(bibcode[:4]) + 1, bibcode[4:])
+        alternates = [bibcode]
+
+    year = canonical[:4]
+    values = {
+        'bibcode': canonical,
+        'alternate_bibcode': alternates,
+        'title': ['Title of {0}'.format(canonical)],
+        'author': ['{0}, {1}.'.format(canonical[-1], chr(65 + i))
+                   for i in range(rng.randint(1, 5))],
+        'year': year,
+        'pubdate': '{0}-{1:02d}-00'.format(year, rng.randint(1, 12)),
+        'citation_count': int(rng.paretovariate(1.5)) - 1,
+        'read_count': int(rng.paretovariate(1.2)) - 1
+    }
+    return dict((field, values[field]) for field in fields
+                if field in values)
+
+
+def sort_key(sort):
+    """
+    Key and direction of a Solr sort, of the fields supported
+
+    :param sort: Solr sort, eg., 'date desc'
+    :return: key function, and if it is reversed
+    """
+    field, _, direction = sort.strip().partition(' ')
+    keys = {
+        'date': lambda doc: doc['_sort']['pubdate'],
+        'bibcode': lambda doc: doc['_sort']['bibcode'],
+        'citation_count': lambda doc: doc['_sort']['citation_count'],
+        'read_count': lambda doc: doc['_sort']['read_count']
+    }
+    return keys.get(field, keys['date']), direction.strip() != 'asc'
+
+
+def request_body():
+    """
+    Body of the request, decompressed if it is gzip or deflate encoded
+
+    :return: string
+    """
+    body = request.get_data()
+    encoding = request.headers.get('Content-Encoding', '').lower()
+    if encoding == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        body = zlib.decompress(body)
+    return body
+
+
+def create_app(profile='fast', seed=None):
+    """
+    Create the stand-in application
+
+    :param profile: name of a profile of PROFILES, or a dictionary
+    :param seed: seed of the latencies and failures, for reproducible runs
+    :return: flask.Flask application
+    """
+    app = Flask(__name__)
+    if not isinstance(profile, dict):
+        profile = PROFILES[profile]
+    app.config['STAND_IN_PROFILE'] = copy.deepcopy(profile)
+    rng = random.Random(seed)
+
+    def delay(service):
+        """
+        Wait for the latency of the service, and fail at its rates
+
+        :param service: name of the service in the profile
+        :return: error response, or None
+        """
+        settings = app.config['STAND_IN_PROFILE'].get(service, {})
+        if settings.get('latency'):
+            time.sleep(rng.lognormvariate(math.log(settings['latency']),
+                                          settings.get('sigma', 0)))
+        if rng.random() < settings.get('hang_rate', 0):
+            time.sleep(settings.get('hang', 60))
+        if rng.random() < settings.get('error_rate', 0):
+            response = jsonify(error='Injected error of {0}'.format(service))
+            response.status_code = settings.get('error_status', 503)
+            return response
+
+    @app.route('/bigquery', methods=['POST'])
+    def bigquery():
+        """
+        Solr bigquery: documents of the bibcodes of the body, one per line
+        after a bibcode header, with fl, sort, start and rows
+        """
+        error = delay('bigquery')
+        if error is not None:
+            return error
+
+        lines = request_body().splitlines()
+        if not lines or lines[0].strip() != 'bibcode':
+            response = jsonify(error='Body must start with a bibcode header')
+            response.status_code = 400
+            return response
+
+        fields = request.args.get('fl', 'bibcode').split(',')
+        sort = request.args.get('sort', 'date desc')
+        start = int(request.args.get('start', 0))
+        rows = int(request.args.get('rows', 10))
+
+        docs, seen = [], set()
+        sort_fields = ['bibcode', 'pubdate', 'citation_count', 'read_count']
+        for bibcode in lines[1:]:
+            bibcode = bibcode.strip()
+            doc = document(bibcode, fields) if bibcode else None
+            if doc is None:
+                continue
+            doc['_sort'] = document(bibcode, sort_fields)
+            if doc['_sort']['bibcode'] in seen:
+                continue
+            seen.add(doc['_sort']['bibcode'])
+            docs.append(doc)
+
+        key, reverse = sort_key(sort)
+        docs.sort(key=key, reverse=reverse)
+        page = docs[start:start + rows]
+        for doc in page:
+            doc.pop('_sort')
+
+        return jsonify(
+            responseHeader={
+                'status': 0,
+                'QTime': 1,
+                'params': dict(request.args.items())
+            },
+            response={
+                'numFound': len(docs),
+                'start': start,
+                'docs': page
+            }
+        )
+
+    @app.route('/user/<user>')
+    def user(user):
+        """
+        User email resolver: the uid and email of a user, given either
+        """
+        error = delay('user')
+        if error is not None:
+            return error
+
+        match = EMAIL.match(user)
+        if match:
+            uid = int(match.group(1))
+        elif user.isdigit():
+            uid = int(user)
+        else:
+            response = jsonify(error='user not found')
+            response.status_code = 404
+            return response
+
+        return jsonify(uid=uid, email='user{0:d}@example.com'.format(uid))
+
+    @app.route('/classic/<int:uid>')
+    @app.route('/twopointoh/<int:uid>')
+    def harbour(uid):
+        """
+        Classic and 2.0 harbour: the libraries of a user
+        """
+        error = delay('harbour')
+        if error is not None:
+            return error
+
+        source = request.path.split('/')[1]
+        rng = key_random(source, uid)
+        libraries = []
+        for number in range(rng.randint(0, 5)):
+            documents = [
+                '{0:d}ApJ...{1:.>3d}..{2:.>3d}{3}'.format(
+                    rng.randint(1950, 2016), rng.randint(1, 999),
+                    rng.randint(1, 999), chr(rng.randint(65, 90))
+                )
+                for _ in range(int(rng.paretovariate(1.0)))
+            ]
+            libraries.append({
+                'name': '{0} library {1:d}'.format(source, number + 1),
+                'description': 'Imported from {0}'.format(source),
+                'documents': documents
+            })
+        return jsonify(libraries=libraries)
+
+    return app
+
+
+# For WSGI servers, eg., gunicorn biblib.tests.stand_ins:application
+application = create_app(os.environ.get('STAND_IN_PROFILE', 'fast'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--profile', default='fast',
+                        help='{0}, or a JSON file of the same shape'
+                        .format(', '.join(sorted(PROFILES))))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the latencies and failures')
+    args = parser.parse_args()
+
+    profile = args.profile
+    if profile not in PROFILES:
+        with open(profile) as profile_file:
+            profile = json.load(profile_file)
+
+    sys.stderr.write(__doc__.split('and point biblib')[1])
+    create_app(profile, args.seed).run(host=args.host, port=args.port,
+                                       threaded=True)
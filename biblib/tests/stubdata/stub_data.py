@@ -348,8 +348,8 @@ class LibraryShop(object):
         """
 
         expected_types = ['name', 'description', 'id', 'num_documents',
-                          'date_created', 'date_last_modified', 'permission',
-                          'public', 'num_users', 'owner']
+                          'date_created', 'date_last_modified', 'version',
+                          'permission', 'public', 'num_users', 'owner']
         return expected_types
 
     @staticmethod
@@ -361,6 +361,6 @@ class LibraryShop(object):
         """
 
         expected_types = ['name', 'description', 'id', 'num_documents',
-                          'date_created', 'date_last_modified', 'permission',
-                          'public', 'num_users', 'owner']
+                          'date_created', 'date_last_modified', 'version',
+                          'permission', 'public', 'num_users', 'owner']
         return expected_types
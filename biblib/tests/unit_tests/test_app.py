@@ -0,0 +1,203 @@
+"""
+Tests the loading of the configuration when the application starts
+"""
+
+import os
+import json
+import time
+import mock
+import shutil
+import tempfile
+import unittest
+from flask import Flask, Config
+from biblib import metrics
+from biblib.app import load_config, get_remote_config, \
+    write_config_snapshot
+from flask.ext.consulate import ConsulConnectionError
+from requests.exceptions import ConnectionError
+
+
+class TestLoadConfig(unittest.TestCase):
+    """
+    Class for testing the consul config, and its snapshot
+    """
+
+    def setUp(self):
+        """
+        Create an application with a stand-in consul, and a snapshot path
+
+        :return: no return
+        """
+        metrics.reset()
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'consul.json')
+        self.namespace = 'config/generic_service/generic_environment/'
+
+        self.app = Flask('biblib')
+        self.consul = mock.Mock()
+        self.app.extensions = {'consul': self.consul}
+
+        self.environment = mock.patch.dict(os.environ, {
+            'SERVICE': 'generic_service',
+            'ENVIRONMENT': 'generic_environment'
+        })
+        self.environment.start()
+
+    def tearDown(self):
+        """
+        Remove the snapshot
+
+        :return: no return
+        """
+        self.environment.stop()
+        shutil.rmtree(self.directory)
+
+    def load_config(self):
+        """
+        Load the config with the snapshot path and a short timeout
+        """
+        original = Config.from_pyfile
+
+        def from_pyfile(config, filename, silent=False):
+            result = original(config, filename, silent)
+            if filename == 'config.py':
+                config['BIBLIB_CONSUL_SNAPSHOT'] = self.snapshot
+                config['BIBLIB_CONSUL_TIMEOUT'] = 0.2
+            return result
+
+        with mock.patch.object(Config, 'from_pyfile',
+                               from_pyfile):
+            load_config(self.app)
+
+    def test_remote_config_is_applied_and_kept_in_the_snapshot(self):
+        """
+        Tests that the values stored in consul are decoded and applied, and
+        written to the snapshot
+
+        :return: no return
+        """
+        self.consul.session.kv.find.return_value = {
+            self.namespace + 'BIBLIB_CLASSIC_SERVICE_URL': '"http://classic"',
+            self.namespace + 'BIBLIB_MAX_ROWS': '10',
+            self.namespace + 'BIBLIB_RAW': 'not json'
+        }
+        self.load_config()
+
+        self.consul.session.kv.find.assert_called_with(self.namespace)
+        self.assertEqual(self.app.config['BIBLIB_CLASSIC_SERVICE_URL'],
+                         'http://classic')
+        self.assertEqual(self.app.config['BIBLIB_MAX_ROWS'], 10)
+        self.assertEqual(self.app.config['BIBLIB_RAW'], 'not json')
+
+        with open(self.snapshot) as snapshot:
+            self.assertEqual(json.load(snapshot)['BIBLIB_MAX_ROWS'], 10)
+        self.assertIn('startup.load_config', metrics.snapshot()['timings'])
+
+    def test_snapshot_is_used_when_consul_is_unreachable(self):
+        """
+        Tests that the snapshot of the last remote config is applied when
+        consul cannot be connected to
+
+        :return: no return
+        """
+        with open(self.snapshot, 'w') as snapshot:
+            json.dump({'BIBLIB_MAX_ROWS': 10}, snapshot)
+        self.consul.session.kv.find.side_effect = ConnectionError('refused')
+
+        self.load_config()
+
+        self.assertEqual(self.app.config['BIBLIB_MAX_ROWS'], 10)
+        self.assertEqual(
+            metrics.snapshot()['counters']['startup.config_snapshot'], 1
+        )
+
+    def test_snapshot_is_only_readable_by_its_owner(self):
+        """
+        Tests that the snapshot, which holds credentials, is written in a
+        directory and a file only the user running the application can read,
+        and that a failed write leaves no file behind
+
+        :return: no return
+        """
+        self.snapshot = os.path.join(self.directory, 'var', 'consul.json')
+        self.consul.session.kv.find.return_value = {
+            self.namespace + 'BIBLIB_MAX_ROWS': '10'
+        }
+        self.load_config()
+
+        self.assertEqual(os.stat(self.snapshot).st_mode & 0o777, 0o600)
+        self.assertEqual(
+            os.stat(os.path.dirname(self.snapshot)).st_mode & 0o777, 0o700
+        )
+
+        write_config_snapshot(self.app, self.snapshot, {'key': object()})
+        self.assertEqual(os.listdir(os.path.dirname(self.snapshot)),
+                         ['consul.json'])
+
+    def test_old_snapshots_are_not_used(self):
+        """
+        Tests that a snapshot older than BIBLIB_CONSUL_SNAPSHOT_MAX_AGE is
+        not applied
+
+        :return: no return
+        """
+        with open(self.snapshot, 'w') as snapshot:
+            json.dump({'BIBLIB_MAX_ROWS': 10}, snapshot)
+        written = time.time() - 8 * 24 * 60 * 60
+        os.utime(self.snapshot, (written, written))
+        self.consul.session.kv.find.side_effect = ConnectionError('refused')
+
+        self.load_config()
+
+        self.assertNotIn('BIBLIB_MAX_ROWS', self.app.config)
+        self.assertNotIn('startup.config_snapshot',
+                         metrics.snapshot()['counters'])
+
+    def test_consul_is_not_waited_on_beyond_the_timeout(self):
+        """
+        Tests that a consul that does not answer delays the start by no more
+        than the timeout, and that the snapshot is used instead
+
+        :return: no return
+        """
+        with open(self.snapshot, 'w') as snapshot:
+            json.dump({'BIBLIB_MAX_ROWS': 10}, snapshot)
+        self.consul.session.kv.find.side_effect = \
+            lambda namespace: time.sleep(5)
+
+        start = time.time()
+        self.load_config()
+        self.assertLess(time.time() - start, 1)
+
+        self.assertEqual(self.app.config['BIBLIB_MAX_ROWS'], 10)
+
+    def test_no_remote_config_without_consul_or_snapshot(self):
+        """
+        Tests that the application still starts with its own config when there
+        is neither consul nor a snapshot
+
+        :return: no return
+        """
+        self.consul.session.kv.find.side_effect = ConnectionError('refused')
+
+        self.load_config()
+
+        self.assertNotIn('BIBLIB_MAX_ROWS', self.app.config)
+        self.assertIn('BIBLIB_SOLR_BIG_QUERY_URL', self.app.config)
+        self.assertFalse(os.path.exists(self.snapshot))
+
+    def test_remote_config_errors_are_connection_errors(self):
+        """
+        Tests that get_remote_config raises ConsulConnectionError for any
+        failure, after retrying
+
+        :return: no return
+        """
+        self.consul.session.kv.find.side_effect = ConnectionError('refused')
+        with self.assertRaises(ConsulConnectionError):
+            get_remote_config(self.consul, timeout=1)
+        self.assertEqual(self.consul.session.kv.find.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
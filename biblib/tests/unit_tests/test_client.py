@@ -0,0 +1,295 @@
+"""
+Tests the circuit breaker and the single flight of the client module
+"""
+
+import time
+import mock
+import threading
+import unittest
+from flask import Flask
+from biblib import metrics
+from biblib.client import CircuitBreaker, SingleFlight
+from biblib.biblib_exceptions import CircuitOpenError
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Class for testing the behaviour of the circuit breaker
+    """
+
+    def setUp(self):
+        """
+        Create a breaker that opens after half of four calls failed, within an
+        application context holding its settings
+
+        :return: no return
+        """
+        self.app = Flask(__name__)
+        self.app.config['TEST_BREAKER'] = {
+            'window': 60,
+            'min_calls': 4,
+            'error_rate': 0.5,
+            'cool_down': 30
+        }
+        self.context = self.app.app_context()
+        self.context.push()
+        metrics.reset()
+        self.breaker = CircuitBreaker(name='test', config_key='TEST_BREAKER')
+
+    def tearDown(self):
+        """
+        Remove the application context
+
+        :return: no return
+        """
+        self.context.pop()
+
+    def call(self, success):
+        """
+        Carry out a call through the breaker
+
+        :param success: outcome of the call
+        """
+        generation = self.breaker.before_call()
+        self.breaker.after_call(success=success, generation=generation)
+
+    def test_breaker_opens_at_the_error_rate(self):
+        """
+        Tests that the breaker stays closed below the error rate, and refuses
+        calls once it is reached
+
+        :return: no return
+        """
+        self.call(True)
+        self.call(False)
+        self.call(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['gauges']['breaker.test.state'], 2)
+        self.assertEqual(snapshot['counters']['breaker.test.opened'], 1)
+        self.assertEqual(snapshot['counters']['breaker.test.rejected'], 1)
+
+    def test_breaker_lets_a_single_trial_through_after_cool_down(self):
+        """
+        Tests that after the cool down a single call is attempted, and that it
+        closes the breaker if it succeeds, or opens it again if it fails
+
+        :return: no return
+        """
+        for i in range(4):
+            self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with mock.patch('biblib.client.time.time',
+                        return_value=self.breaker.opened_at + 31):
+            self.breaker.before_call()
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+            # Only the trial call is let through
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.before_call()
+
+            self.breaker.after_call(success=False)
+            self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with mock.patch('biblib.client.time.time',
+                        return_value=self.breaker.opened_at + 31):
+            self.call(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(metrics.snapshot()['gauges']['breaker.test.state'],
+                         0)
+
+    def test_state_is_exported_before_any_call(self):
+        """
+        Tests that the state of a new breaker is exported straight away
+
+        :return: no return
+        """
+        metrics.reset()
+        CircuitBreaker(name='new', config_key='TEST_BREAKER')
+        self.assertEqual(metrics.snapshot()['gauges']['breaker.new.state'], 0)
+
+    def test_late_outcomes_of_earlier_calls_are_ignored(self):
+        """
+        Tests that calls in flight when the breaker opened do not open it
+        again, or decide the trial call, when they fail afterwards
+
+        :return: no return
+        """
+        in_flight = [self.breaker.before_call() for i in range(3)]
+        for i in range(4):
+            self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        opened_at = self.breaker.opened_at
+
+        with mock.patch('biblib.client.time.time',
+                        return_value=opened_at + 10):
+            self.breaker.after_call(success=False, generation=in_flight[0])
+        self.assertEqual(self.breaker.opened_at, opened_at)
+
+        with mock.patch('biblib.client.time.time',
+                        return_value=opened_at + 31):
+            trial = self.breaker.before_call()
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+            self.breaker.after_call(success=False, generation=in_flight[1])
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+            self.breaker.after_call(success=True, generation=trial)
+            self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+            self.breaker.after_call(success=False, generation=in_flight[2])
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(self.breaker.calls), 0)
+        self.assertEqual(metrics.snapshot()['counters']['breaker.test.ignored'],
+                         3)
+
+
+
+class TestSingleFlight(unittest.TestCase):
+    """
+    Class for testing the coalescing of identical calls
+    """
+
+    def setUp(self):
+        """
+        Create a single flight, and a call that blocks until it is released
+
+        :return: no return
+        """
+        self.app = Flask(__name__)
+        metrics.reset()
+        self.flight = SingleFlight(name='test')
+        self.release = threading.Event()
+        self.calls = []
+        self.results = []
+
+    def call(self):
+        """
+        Call that is counted, and only returns once released
+
+        :return: result of the call
+        """
+        self.calls.append(1)
+        self.release.wait()
+        return {'result': len(self.calls)}
+
+    def do(self, function, timeout=5):
+        """
+        Carry out the call through the single flight, within an application
+        context, and keep its result or exception
+
+        :param function: function to call
+        :param timeout: seconds a follower waits for the leader
+        """
+        with self.app.app_context():
+            try:
+                self.results.append(
+                    self.flight.do(key='key', function=function,
+                                   timeout=timeout)
+                )
+            except Exception as error:
+                self.results.append(error)
+
+    def burst(self, function, followers, timeout=5):
+        """
+        Start a leader, and followers once the leader is in flight, then
+        release the call
+
+        :param function: function to call
+        :param followers: number of followers
+        :param timeout: seconds a follower waits for the leader
+        """
+        threads = [threading.Thread(target=self.do, args=(function,))]
+        threads[0].start()
+        while not self.calls:
+            time.sleep(0.01)
+
+        threads += [threading.Thread(target=self.do, args=(function, timeout))
+                    for i in range(followers)]
+        for thread in threads[1:]:
+            thread.start()
+        while metrics.snapshot()['counters']\
+                .get('singleflight.test.shared', 0) < followers:
+            time.sleep(0.01)
+
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+    def test_followers_share_the_result_of_the_leader(self):
+        """
+        Tests that identical calls in flight together are made once, and all
+        get the same result, while a later call is made again
+
+        :return: no return
+        """
+        self.burst(self.call, followers=5)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, [{'result': 1}] * 6)
+        self.assertEqual(self.flight.calls, {})
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['singleflight.test.leader'], 1)
+        self.assertEqual(counters['singleflight.test.shared'], 5)
+
+        self.do(self.call)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_followers_share_the_exception_of_the_leader(self):
+        """
+        Tests that the exception raised by the leader is raised to the
+        followers too
+
+        :return: no return
+        """
+        error = ValueError('failed')
+
+        def fail():
+            self.call()
+            raise error
+
+        self.burst(fail, followers=3)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, [error] * 4)
+        self.assertEqual(self.flight.calls, {})
+
+    def test_followers_call_themselves_after_the_timeout(self):
+        """
+        Tests that a follower that is not answered in time makes the call
+
+        :return: no return
+        """
+        def call():
+            if self.calls:
+                self.calls.append(1)
+                return 'follower'
+            return self.call()
+
+        leader = threading.Thread(target=self.do, args=(call,))
+        leader.start()
+        while not self.calls:
+            time.sleep(0.01)
+
+        self.do(call, timeout=0.01)
+        self.assertEqual(self.results, ['follower'])
+
+        self.release.set()
+        leader.join()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(
+            metrics.snapshot()['counters']['singleflight.test.timeout'], 1
+        )
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,156 @@
+"""
+Tests the compression of the responses
+"""
+
+import json
+import mock
+import zlib
+import unittest
+from flask import Flask, Response
+from biblib import metrics
+from biblib.compression import compress_response
+
+
+class TestCompression(unittest.TestCase):
+    """
+    Class for testing the negotiation and compression of responses
+    """
+
+    def setUp(self):
+        """
+        Create an application that compresses its responses
+
+        :return: no return
+        """
+        self.app = Flask(__name__)
+        self.app.config.update(
+            BIBLIB_COMPRESSION=True,
+            BIBLIB_COMPRESSION_THRESHOLD=1024,
+            BIBLIB_COMPRESSION_LEVEL=6,
+            BIBLIB_COMPRESSION_BROTLI=False
+        )
+        self.app.after_request(compress_response)
+        self.payload = json.dumps({'documents': ['2016TEST..{0:09d}'.format(i)
+                                                 for i in range(1000)]})
+
+        @self.app.route('/large')
+        def large():
+            response = Response(self.payload, mimetype='application/json')
+            response.set_etag('1')
+            return response
+
+        @self.app.route('/small')
+        def small():
+            return Response('{}', mimetype='application/json')
+
+        @self.app.route('/stream')
+        def stream():
+            lines = ('{0}\n'.format(json.dumps({'line': i}))
+                     for i in range(100))
+            return Response(lines, mimetype='application/x-ndjson')
+
+        self.client = self.app.test_client()
+        metrics.reset()
+
+    def test_large_responses_are_gzip_compressed(self):
+        """
+        Tests that a large response is compressed with gzip when accepted,
+        with a weak entity tag, and that the metrics are recorded
+
+        :return: no return
+        """
+        response = self.client.get('/large',
+                                   headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(response.headers['ETag'], 'W/"1"')
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS),
+            self.payload
+        )
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['compression.bytes_in'],
+                         len(self.payload))
+        self.assertEqual(snapshot['counters']['compression.bytes_out'],
+                         len(response.data))
+        self.assertLess(snapshot['timings']['compression.ratio']['max'], 0.5)
+        self.assertEqual(snapshot['timings']['compression.cpu_time']['count'],
+                         1)
+
+    def test_deflate_is_used_when_preferred(self):
+        """
+        Tests that the encoding with the highest quality is used
+
+        :return: no return
+        """
+        response = self.client.get(
+            '/large',
+            headers={'Accept-Encoding': 'gzip;q=0.5, deflate'}
+        )
+
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), self.payload)
+
+    def test_responses_are_not_compressed_when_not_worth_it(self):
+        """
+        Tests that small responses, and clients that do not accept any of the
+        encodings, get the response as it is
+
+        :return: no return
+        """
+        response = self.client.get('/small',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, '{}')
+
+        response = self.client.get('/large')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['ETag'], '"1"')
+        self.assertEqual(response.data, self.payload)
+
+    def test_streamed_responses_are_compressed(self):
+        """
+        Tests that streamed responses are compressed chunk by chunk
+
+        :return: no return
+        """
+        response = self.client.get('/stream',
+                                   headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        lines = zlib.decompress(response.data, 16 + zlib.MAX_WBITS)\
+            .splitlines()
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(json.loads(lines[-1]), {'line': 99})
+
+    def test_streamed_responses_only_use_the_encodings_accepted(self):
+        """
+        Tests that a streamed response, which br is not used for, falls back
+        on another encoding the client accepts, or on none, and varies on
+        Accept-Encoding either way
+
+        :return: no return
+        """
+        self.app.config['BIBLIB_COMPRESSION_BROTLI'] = True
+        with mock.patch('biblib.compression.brotli', mock.Mock()):
+            response = self.client.get(
+                '/stream',
+                headers={'Accept-Encoding': 'br, deflate;q=0.5'}
+            )
+            self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(len(zlib.decompress(response.data)
+                                 .splitlines()), 100)
+
+            response = self.client.get('/stream',
+                                       headers={'Accept-Encoding': 'br'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(len(response.data.splitlines()), 100)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,224 @@
+"""
+Tests the logging of the hot paths
+"""
+
+import time
+import logging
+import unittest
+from StringIO import StringIO
+from flask import Flask
+from biblib import metrics
+from biblib.log import Logger, Summary, QueueHandler, use_queue
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Handler that keeps the messages of the records it handles
+    """
+
+    def __init__(self, delay=0):
+        """
+        Constructor
+        :param delay: seconds each record takes to write
+        """
+        logging.Handler.__init__(self)
+        self.delay = delay
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.messages.append(record.getMessage())
+
+
+class Formatted(object):
+    """
+    Object that counts how many times it is formatted
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __str__(self):
+        self.count += 1
+        return 'formatted'
+
+
+class TestLogger(unittest.TestCase):
+    """
+    Class for testing the lazily formatted logger
+    """
+
+    def setUp(self):
+        """
+        Create a logger at the INFO level, recording its messages
+
+        :return: no return
+        """
+        self.handler = RecordingHandler()
+        self.logger = Logger('biblib.tests.log')
+        self.logger.logger.addHandler(self.handler)
+        self.logger.logger.setLevel(logging.INFO)
+        self.logger.logger.propagate = False
+
+    def tearDown(self):
+        """
+        Remove the recording handler
+
+        :return: no return
+        """
+        self.logger.logger.removeHandler(self.handler)
+
+    def test_messages_are_only_formatted_when_emitted(self):
+        """
+        Tests that the arguments of a message below the level of the logger
+        are never formatted, and those above are formatted once
+
+        :return: no return
+        """
+        formatted = Formatted()
+        self.logger.debug('Not emitted: {0}', formatted)
+        self.assertEqual(formatted.count, 0)
+        self.assertEqual(self.handler.messages, [])
+
+        self.logger.info('Emitted: {0} {1:d}', formatted, 1)
+        self.assertEqual(formatted.count, 1)
+        self.assertEqual(self.handler.messages, ['Emitted: formatted 1'])
+
+    def test_messages_without_arguments_keep_their_braces(self):
+        """
+        Tests that a message with no arguments is not formatted
+
+        :return: no return
+        """
+        self.logger.error('Literal {braces}')
+        self.assertEqual(self.handler.messages, ['Literal {braces}'])
+
+    def test_sampled_messages_are_logged_once_every_n(self):
+        """
+        Tests that a sampled message is logged once every
+        BIBLIB_LOG_SAMPLE_EVERY times, and other messages every time
+
+        :return: no return
+        """
+        app = Flask(__name__)
+        app.config['BIBLIB_LOG_SAMPLE_EVERY'] = 10
+        with app.app_context():
+            for i in range(25):
+                self.logger.info('Sampled: {0}', i, sample=True)
+                self.logger.info('Not sampled: {0}', i)
+
+        sampled = [message for message in self.handler.messages
+                   if message.startswith('Sampled')]
+        self.assertEqual(sampled, ['Sampled: {0} [1 in 10 logged]'.format(i)
+                                   for i in [0, 10, 20]])
+        self.assertEqual(len(self.handler.messages), 28)
+
+    def test_summaries_are_capped(self):
+        """
+        Tests that a summary shows the length and the first few items of a
+        collection
+
+        :return: no return
+        """
+        bibcodes = ['2016TEST..{0:09d}'.format(i) for i in range(1000)]
+        self.assertEqual(
+            str(Summary(bibcodes, limit=2)),
+            "1000 items: ['2016TEST..000000000', '2016TEST..000000001', ...]"
+        )
+        self.assertEqual(str(Summary(bibcodes[:1])),
+                         "1 items: ['2016TEST..000000000']")
+        self.assertEqual(str(Summary({})), '0 items: []')
+        self.assertEqual(str(Summary(None)), 'None')
+
+
+class TestQueueHandler(unittest.TestCase):
+    """
+    Class for testing the background writing of the log records
+    """
+
+    def setUp(self):
+        """
+        Create a logger whose records are written from a queue
+
+        :return: no return
+        """
+        metrics.reset()
+        self.logger = logging.getLogger('biblib.tests.queue')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        """
+        Remove the handlers of the logger
+
+        :return: no return
+        """
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def test_records_are_written_by_the_handlers_wrapped(self):
+        """
+        Tests that the records are formatted when logged, and written by the
+        handlers previously attached to the logger
+
+        :return: no return
+        """
+        handler = RecordingHandler()
+        self.logger.addHandler(handler)
+        queue_handler = use_queue(self.logger)
+        self.assertEqual(self.logger.handlers, [queue_handler])
+
+        items = [1]
+        self.logger.info('Items: %s', items)
+        items.append(2)
+        queue_handler.close()
+
+        self.assertEqual(handler.messages, ['Items: [1]'])
+
+    def test_tracebacks_are_written_once(self):
+        """
+        Tests that the traceback of an exception logged is written once, by
+        the handlers wrapped
+
+        :return: no return
+        """
+        stream = StringIO()
+        self.logger.addHandler(logging.StreamHandler(stream))
+        queue_handler = use_queue(self.logger)
+
+        try:
+            raise ValueError('Failure')
+        except ValueError:
+            self.logger.exception('Something failed')
+        queue_handler.close()
+
+        output = stream.getvalue()
+        self.assertIn('Something failed', output)
+        self.assertEqual(output.count('Traceback'), 1)
+        self.assertEqual(output.count('ValueError: Failure'), 1)
+
+    def test_records_are_dropped_when_the_queue_is_full(self):
+        """
+        Tests that logging does not wait on a slow handler, and drops the
+        records that do not fit in the queue
+
+        :return: no return
+        """
+        handler = RecordingHandler(delay=0.1)
+        queue_handler = QueueHandler([handler], maxsize=2)
+        self.logger.addHandler(queue_handler)
+
+        start = time.time()
+        for i in range(10):
+            self.logger.info('Message: %d', i)
+        self.assertLess(time.time() - start, 0.1)
+        queue_handler.close()
+
+        dropped = metrics.snapshot()['counters']['log.dropped']
+        self.assertGreater(dropped, 0)
+        self.assertEqual(len(handler.messages) + dropped, 10)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -3,10 +3,21 @@ Tests the methods within the flask-script file manage.py
 """
 
 import os
+import sys
+import gzip
+import mock
+import json
+import random
+import shutil
+import tempfile
 import unittest
 import testing.postgresql
 from biblib.app import create_app
-from biblib.manage import CreateDatabase, DestroyDatabase, DeleteStaleUsers
+from biblib import manage
+from biblib.manage import CreateDatabase, DestroyDatabase, DeleteStaleUsers, \
+    GenerateDataset, ExportLibraries
+from datetime import datetime, timedelta
+from biblib.synthetic import ZipfSampler, synthetic_bibcode
 from biblib.models import User, Library, Permissions, db
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
@@ -20,27 +31,16 @@ class TestManagePy(unittest.TestCase):
     Base test class for when databases are being used.
     """
 
-    postgresql_url_dict = {
-        'port': 1234,
-        'host': '127.0.0.1',
-        'user': 'postgres',
-        'database': 'test'
-    }
-    postgresql_url = 'postgresql://{user}@{host}:{port}/{database}'\
-        .format(
-            user=postgresql_url_dict['user'],
-            host=postgresql_url_dict['host'],
-            port=postgresql_url_dict['port'],
-            database=postgresql_url_dict['database']
-        )
+    postgresql_url = None
 
     adsws_sqlite = 'sqlite:////tmp/test.db'
 
     @classmethod
     def setUpClass(cls):
-        cls.postgresql = \
-        cls.postgresql = \
-            testing.postgresql.Postgresql(**cls.postgresql_url_dict)
+        # A database of its own, on a free port, as the tables are created and
+        # dropped outside of the isolation of TestCaseDatabase
+        cls.postgresql = testing.postgresql.Postgresql()
+        TestManagePy.postgresql_url = cls.postgresql.url()
 
     @classmethod
     def tearDownClass(cls):
@@ -241,5 +241,174 @@ class TestManagePy(unittest.TestCase):
             db.metadata.drop_all(bind=engine)
             os.remove(TestManagePy.adsws_sqlite.replace('sqlite:///', ''))
 
+    def test_generate_dataset(self):
+        """
+        Tests that the GenerateDataset action loads the users, libraries with
+        their owner, and shared permissions asked for, with COPY and with
+        executemany
+
+        :return: no return
+        """
+        engine = create_engine(TestManagePy.postgresql_url)
+        db.metadata.create_all(bind=engine)
+        session = scoped_session(sessionmaker(bind=engine))()
+
+        try:
+            for copy in [None, False]:
+                result = GenerateDataset.run(
+                    app=self._app, users=50, max_size=30, bibcodes=200,
+                    share_rate=0.5, batch_size=20, copy=copy, seed=1
+                )
+                self.assertIsNone(result)
+
+            self.assertGreaterEqual(session.query(Library).count(), 100)
+            self.assertGreater(session.query(Permissions).count(),
+                               session.query(Library).count())
+
+            self.assertEqual(session.query(User).count(), 100)
+            self.assertEqual(
+                sorted(user.absolute_uid for user in session.query(User)),
+                range(1, 101)
+            )
+
+            libraries = session.query(Library).all()
+            self.assertEqual(
+                session.query(Permissions).filter(Permissions.owner).count(),
+                len(libraries)
+            )
+            for library in libraries:
+                self.assertTrue(1 <= len(library.bibcode) <= 30)
+                for bibcode in library.bibcode:
+                    self.assertEqual(len(bibcode), 19)
+
+            shared = session.query(Permissions)\
+                .filter(Permissions.owner.is_(False)).all()
+            self.assertTrue(shared)
+            for permission in shared:
+                self.assertEqual(
+                    [permission.read, permission.write,
+                     permission.admin].count(True), 1
+                )
+        finally:
+            session.close()
+            db.metadata.drop_all(bind=engine)
+
+    def test_export_libraries(self):
+        """
+        Tests that the ExportLibraries action writes every library, with its
+        bibcodes and permissions, as one JSON line each, and filters them by
+        owner and modification time
+
+        :return: no return
+        """
+        engine = create_engine(TestManagePy.postgresql_url)
+        db.metadata.create_all(bind=engine)
+        session = scoped_session(sessionmaker(bind=engine))()
+        directory = tempfile.mkdtemp()
+
+        def export(**kwargs):
+            path = os.path.join(directory, 'export.ndjson.gz')
+            result = ExportLibraries.run(app=self._app, output=path,
+                                         compress=True, batch_size=7,
+                                         **kwargs)
+            self.assertIsNone(result)
+            with gzip.open(path) as export_file:
+                return [json.loads(line) for line in export_file]
+
+        try:
+            GenerateDataset.run(app=self._app, users=20, max_size=30,
+                                bibcodes=200, share_rate=0.5, seed=1)
+
+            records = export()
+            libraries = dict((str(library.id), library)
+                             for library in session.query(Library))
+            self.assertEqual(sorted(record['id'] for record in records),
+                             sorted(libraries.keys()))
+            for record in records:
+                library = libraries[record['id']]
+                self.assertEqual(record['name'], library.name)
+                self.assertEqual(record['bibcode'], library.bibcode)
+                self.assertEqual(
+                    len(record['permissions']),
+                    session.query(Permissions)
+                    .filter(Permissions.library_id == library.id).count()
+                )
+                self.assertEqual([permission['owner'] for permission
+                                  in record['permissions']].count(True), 1)
+
+            owned = export(users=[1, 2])
+            self.assertTrue(owned)
+            for record in owned:
+                self.assertIn(
+                    [permission['absolute_uid']
+                     for permission in record['permissions']
+                     if permission['owner']][0],
+                    [1, 2]
+                )
+
+            self.assertEqual(
+                export(since=datetime.utcnow() + timedelta(days=1)), []
+            )
+        finally:
+            shutil.rmtree(directory)
+            session.close()
+            db.metadata.drop_all(bind=engine)
+
+    def test_export_command_exits_successfully(self):
+        """
+        Tests that the export run from the command line exits with status 0,
+        as Flask-Script exits with whatever the command returns
+
+        :return: no return
+        """
+        engine = create_engine(TestManagePy.postgresql_url)
+        db.metadata.create_all(bind=engine)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'export.ndjson')
+
+        binds = dict(manage.app.config['SQLALCHEMY_BINDS'],
+                     libraries=TestManagePy.postgresql_url)
+        try:
+            GenerateDataset.run(app=self._app, users=5, max_size=10,
+                                bibcodes=50, seed=1)
+
+            with mock.patch.dict(manage.app.config,
+                                 {'SQLALCHEMY_BINDS': binds}), \
+                    mock.patch.object(sys, 'argv',
+                                      ['manage.py', 'export', '-o', path]):
+                with self.assertRaises(SystemExit) as context:
+                    manage.manager.run()
+            self.assertEqual(context.exception.code, 0)
+
+            session = scoped_session(sessionmaker(bind=engine))()
+            with open(path) as export_file:
+                self.assertEqual(len(export_file.readlines()),
+                                 session.query(Library).count())
+            session.close()
+        finally:
+            shutil.rmtree(directory)
+            db.metadata.drop_all(bind=engine)
+
+    def test_synthetic_distributions(self):
+        """
+        Tests that the library sizes are skewed towards small libraries within
+        their bounds, and that bibcodes have the ADS shape
+
+        :return: no return
+        """
+        rng = random.Random(1)
+        sampler = ZipfSampler(1.1, 1000, rng)
+        sizes = [sampler() for _ in range(10000)]
+        self.assertEqual(min(sizes), 1)
+        self.assertLessEqual(max(sizes), 1000)
+        self.assertGreater(sizes.count(1), sizes.count(2))
+        self.assertGreater(sizes.count(2), sizes.count(10))
+
+        for _ in range(100):
+            bibcode = synthetic_bibcode(rng)
+            self.assertRegexpMatches(bibcode,
+                                     r'^[0-9]{4}.{5}[0-9.]{4}[.L][0-9.]{4}'
+                                     r'[A-Z]$')
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
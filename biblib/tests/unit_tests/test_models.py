@@ -2,8 +2,12 @@
 Tests the underlying models of the database
 """
 
+import mock
 import unittest
-from biblib.models import db, User, Library, Permissions, MutableDict
+from biblib import metrics, slow_queries
+from biblib.models import db, User, Library, Permissions, MutableDict, \
+    TimedQueuePool, INHERITED_CONNECTIONS
+from biblib.views import BaseView
 from biblib.tests.base import TestCaseDatabase
 
 class TestLibraryModel(TestCaseDatabase):
@@ -39,6 +43,29 @@ class TestLibraryModel(TestCaseDatabase):
 
         self.assertUnsortedEqual(lib.get_bibcodes(), expected_bibcode_output)
 
+    def test_adding_bibcodes_returns_number_added_and_changes_once(self):
+        """
+        Checks that adding bibcodes reports how many were new, and only emits
+        a single change event for the whole list
+        """
+        lib = Library(bibcode={'1': {}})
+        db.session.add(lib)
+        db.session.commit()
+
+        changes = []
+        original_changed = MutableDict.changed
+        MutableDict.changed = lambda self: changes.append(1) or \
+            original_changed(self)
+        try:
+            number_added = lib.add_bibcodes(['1', '2', '3', '4'])
+        finally:
+            MutableDict.changed = original_changed
+        db.session.commit()
+
+        self.assertEqual(number_added, 3)
+        self.assertEqual(len(changes), 1)
+        self.assertUnsortedEqual(lib.get_bibcodes(), ['1', '2', '3', '4'])
+
     def test_adding_bibcode_if_not_commited_to_library(self):
         """
         Checks that bibcodes are add correctly if the library has not been
@@ -72,6 +99,92 @@ class TestLibraryModel(TestCaseDatabase):
 
         self.assertUnsortedEqual(lib.get_bibcodes(), expected_list)
 
+    def test_removing_several_bibcodes_removes_one_key_at_a_time(self):
+        """
+        Checks that several bibcodes can be removed at once, with one
+        jsonb - text per key, as jsonb - text[] needs PostgreSQL 10
+        """
+        lib = Library(bibcode={'1': {}, '2': {}, '3': {}, '4': {}})
+        db.session.add(lib)
+        db.session.commit()
+        lib_id = lib.id
+
+        lib.remove_bibcodes(['1', '3', '4'])
+        expression = lib.bibcode.partial_update_expression(
+            Library.__table__.c.bibcode
+        )
+        sql = str(expression.compile(dialect=db.engine.dialect))
+        self.assertEqual(sql.count(' - '), 3)
+        self.assertNotIn('ARRAY', sql)
+        db.session.commit()
+
+        lib = Library.query.filter(Library.id == lib_id).one()
+        self.assertUnsortedEqual(lib.get_bibcodes(), ['2'])
+
+    def test_modifying_bibcodes_only_writes_the_keys_changed(self):
+        """
+        Checks that adding and removing bibcodes only writes the keys that
+        changed, so that bibcodes written by someone else in the mean time
+        are kept
+        """
+        lib = Library(bibcode={'1': {}, '2': {}})
+        db.session.add(lib)
+        db.session.commit()
+        lib_id = lib.id
+        self.assertUnsortedEqual(lib.get_bibcodes(), ['1', '2'])
+
+        # Someone else adds a bibcode behind our back
+        db.session.execute(
+            "UPDATE library SET bibcode = bibcode || '{\"3\": {}}' "
+            "WHERE id = :id",
+            {'id': str(lib_id)},
+            mapper=Library.__mapper__
+        )
+
+        lib.add_bibcodes(['4'])
+        lib.remove_bibcodes(['1'])
+        db.session.commit()
+
+        lib = Library.query.filter(Library.id == lib_id).one()
+        self.assertUnsortedEqual(lib.get_bibcodes(), ['2', '3', '4'])
+
+    def test_assigning_bibcodes_writes_the_whole_value(self):
+        """
+        Checks that replacing the bibcodes writes the new value in full
+        """
+        lib = Library(bibcode={'1': {}, '2': {}})
+        db.session.add(lib)
+        db.session.commit()
+        lib_id = lib.id
+        self.assertTrue(lib.bibcode.synchronised)
+
+        lib.bibcode = {'3': {}}
+        self.assertFalse(lib.bibcode.synchronised)
+        lib.bibcode['4'] = {}
+        db.session.commit()
+
+        lib = Library.query.filter(Library.id == lib_id).one()
+        self.assertUnsortedEqual(lib.get_bibcodes(), ['3', '4'])
+
+    def test_mutable_dict_records_changes(self):
+        """
+        Checks that the keys added and removed are recorded, and that pop
+        returns the item removed
+        """
+        mutable_dict = MutableDict({'1': {}, '2': {}})
+
+        mutable_dict['3'] = {}
+        mutable_dict.update({'4': {}})
+        self.assertEqual(mutable_dict.pop('1', None), {})
+        self.assertIsNone(mutable_dict.pop('missing', None))
+        del mutable_dict['3']
+
+        self.assertEqual(mutable_dict.added, {'4': {}})
+        self.assertEqual(mutable_dict.removed, {'1', '3'})
+
+        with self.assertRaises(KeyError):
+            mutable_dict.pop('missing')
+
     def test_coerce(self):
         """
         Checks the coerce for SQLAlchemy works correctly
@@ -87,5 +200,212 @@ class TestLibraryModel(TestCaseDatabase):
         same_list = mutable_dict.coerce('key', mutable_dict)
         self.assertEqual(same_list, mutable_dict)
 
+
+class TestConnectionPool(TestCaseDatabase):
+    """
+    Class for testing the configuration and instrumentation of the pools
+    """
+
+    def setUp(self):
+        """
+        Forget the metrics of other tests
+        """
+        super(TestConnectionPool, self).setUp()
+        metrics.reset()
+
+    def test_pool_is_configured_per_bind(self):
+        """
+        Checks that the pool of the libraries bind follows BIBLIB_POOL
+        """
+        pool_options = self.app.config['BIBLIB_POOL']['libraries']
+        engine = db.get_engine(self.app, bind='libraries')
+
+        self.assertIsInstance(engine.pool, TimedQueuePool)
+        self.assertEqual(engine.pool.size(), pool_options['pool_size'])
+        self.assertEqual(engine.pool._recycle, pool_options['pool_recycle'])
+
+    def test_checkouts_are_instrumented(self):
+        """
+        Checks that checkouts record their wait and the connections in use
+        """
+        engine = db.get_engine(self.app, bind='libraries')
+
+        connection = engine.connect()
+        self.assertEqual(metrics.snapshot()['gauges']['pool.libraries.in_use'],
+                         engine.pool.checkedout())
+        connection.close()
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['gauges']['pool.libraries.in_use'],
+                         engine.pool.checkedout())
+        self.assertGreater(
+            snapshot['timings']['pool.libraries.checkout_wait']['count'], 0
+        )
+
+    def test_dropped_connections_are_replaced(self):
+        """
+        Checks that a connection dropped by the database, as happens after a
+        failover, is replaced when it is checked out instead of failing
+        """
+        engine = db.get_engine(self.app, bind='libraries')
+        engine.dispose()
+
+        connection = engine.connect()
+        other = engine.connect()
+        pid = connection.scalar('SELECT pg_backend_pid()')
+        connection.close()
+
+        # Drop the connection that is now idle in the pool
+        other.execute('SELECT pg_terminate_backend({0:d})'.format(pid))
+        other.close()
+
+        connection = engine.connect()
+        self.assertEqual(connection.scalar('SELECT 1'), 1)
+        connection.close()
+
+        self.assertEqual(
+            metrics.snapshot()['counters']['pool.libraries.invalidated'], 1
+        )
+
+    def test_warm_up_opens_connections(self):
+        """
+        Checks that warming up leaves the connections open in the pool
+        """
+        engine = db.get_engine(self.app, bind='libraries')
+        engine.dispose()
+        engine = db.get_engine(self.app, bind='libraries')
+
+        db.warm_up(self.app)
+
+        self.assertEqual(engine.pool.checkedin(),
+                         self.app.config['BIBLIB_POOL']['libraries']['warm_up'])
+
+    def test_connections_are_not_shared_with_forked_workers(self):
+        """
+        Checks that a connection opened by another process, as happens when
+        a worker is forked after a warm up, is replaced rather than used or
+        closed
+        """
+        engine = db.get_engine(self.app, bind='libraries')
+        engine.dispose()
+
+        connection = engine.connect()
+        parent_pid = connection.scalar('SELECT pg_backend_pid()')
+        connection.close()
+
+        with mock.patch('biblib.models.os.getpid', return_value=-1):
+            connection = engine.connect()
+            child_pid = connection.scalar('SELECT pg_backend_pid()')
+            # The connection of the parent was left open for it
+            parent_sessions = connection.scalar(
+                'SELECT count(*) FROM pg_stat_activity '
+                'WHERE pid = {0:d}'.format(parent_pid)
+            )
+            connection.close()
+
+        self.assertNotEqual(child_pid, parent_pid)
+        self.assertEqual(parent_sessions, 1)
+        self.assertEqual(len(INHERITED_CONNECTIONS), 1)
+
+        while INHERITED_CONNECTIONS:
+            INHERITED_CONNECTIONS.pop().close()
+        engine.dispose()
+
+    def test_engines_are_instrumented_once(self):
+        """
+        Checks that getting the engine of a bind again does not add its
+        listeners again
+        """
+        engine = db.get_engine(self.app, bind='libraries')
+        checkout = len(engine.pool.dispatch.checkout)
+        engine_connect = len(engine.dispatch.engine_connect)
+
+        self.assertIs(db.get_engine(self.app, bind='libraries'), engine)
+        self.assertEqual(len(engine.pool.dispatch.checkout), checkout)
+        self.assertEqual(len(engine.dispatch.engine_connect), engine_connect)
+        self.assertGreater(engine_connect, 0)
+
+
+class TestSlowQueries(TestCaseDatabase):
+    """
+    Class for testing the slow query log of the libraries bind
+    """
+
+    def create_app(self):
+        """
+        Create the wsgi application, where every statement is slow
+
+        :return: application instance
+        """
+        app_ = super(TestSlowQueries, self).create_app()
+        app_.config['BIBLIB_SLOW_QUERIES'] = {
+            'libraries': {'threshold': 0, 'explain': True,
+                          'max_statements': 1000}
+        }
+        return app_
+
+    def setUp(self):
+        """
+        Forget the slow queries of other tests, and of the database set up
+        """
+        super(TestSlowQueries, self).setUp()
+        slow_queries.EXPLAINER.queue.join()
+        slow_queries.reset()
+        metrics.reset()
+
+    def test_slow_queries_are_recorded_with_their_origin(self):
+        """
+        Checks that a slow statement is recorded with the shape of its
+        parameters, the helper it comes from and its plan
+        """
+        BaseView.helper_user_exists(absolute_uid=1)
+        BaseView.helper_user_exists(absolute_uid=2)
+        slow_queries.EXPLAINER.queue.join()
+
+        # The connection is also pinged when it is checked out
+        recorded = [query for query in slow_queries.get_slow_queries()
+                    if 'FROM "user"' in query['statement']]
+        self.assertEqual(len(recorded), 1)
+        query = recorded[0]
+
+        self.assertEqual(query['bind'], 'libraries')
+        self.assertEqual(query['parameters'], '{absolute_uid_1: int}')
+        self.assertRegexpMatches(query['origin'],
+                                 r'^views/base_view.py:\d+ helper_user_exists$')
+        self.assertEqual(query['count'], 2)
+        self.assertGreaterEqual(query['max'], query['total'] / 2)
+        self.assertIn('Scan', query['plan'])
+        self.assertGreaterEqual(metrics.snapshot()['counters']
+                                ['slow_queries.libraries'], 2)
+
+    def test_slowest_queries_come_first(self):
+        """
+        Checks that the statements are listed by their longest execution, up
+        to the number requested
+        """
+        for statement, duration in [('a', 0.1), ('b', 0.3), ('c', 0.2)]:
+            slow_queries.record_slow_query('libraries', statement, {},
+                                           duration, max_statements=1000)
+
+        self.assertEqual([query['statement']
+                          for query in slow_queries.get_slow_queries(2)],
+                         ['b', 'c'])
+
+    def test_parameter_shapes_do_not_include_values(self):
+        """
+        Checks the shapes of the parameters of single and many executions
+        """
+        self.assertEqual(
+            slow_queries.parameter_shape({'bibcodes': ['a', 'b'], 'id': 1}),
+            '{bibcodes: list[2], id: int}'
+        )
+        self.assertEqual(
+            slow_queries.parameter_shape([{'id': 1}, {'id': 2}]),
+            '2 x {id: int}'
+        )
+        self.assertEqual(slow_queries.parameter_shape(('a', 1)),
+                         '(str, int)')
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
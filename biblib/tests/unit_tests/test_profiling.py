@@ -0,0 +1,127 @@
+"""
+Tests the profiling of requests
+"""
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from biblib import metrics
+from biblib.profiling import init_profiling
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    Class for testing which requests are profiled, and the ring of profiles
+    """
+
+    def create_app(self, **config):
+        """
+        Create an application with profiling configured
+
+        :param config: configuration of the application
+        :return: test client
+        """
+        app = Flask(__name__)
+        app.config.update(
+            BIBLIB_PROFILING=True,
+            BIBLIB_PROFILING_TOKEN='secret',
+            BIBLIB_PROFILING_SAMPLE_RATE=0,
+            BIBLIB_PROFILING_PATH=self.directory,
+            BIBLIB_PROFILING_MAX_FILES=3
+        )
+        app.config.update(config)
+        init_profiling(app)
+
+        @app.route('/libraries/<library>')
+        def library(library):
+            return ''.join(str(i) for i in range(1000))
+
+        return app.test_client()
+
+    def setUp(self):
+        """
+        Create the directory of the profiles
+
+        :return: no return
+        """
+        metrics.reset()
+        self.directory = os.path.join(tempfile.mkdtemp(), 'profiles')
+
+    def tearDown(self):
+        """
+        Remove the directory of the profiles
+
+        :return: no return
+        """
+        shutil.rmtree(os.path.dirname(self.directory))
+
+    def profiles(self):
+        """
+        Profiles written, oldest first
+
+        :return: list of file names
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.listdir(self.directory))
+
+    def test_requests_with_the_token_are_profiled(self):
+        """
+        Tests that a request with the token is profiled, and its profile is
+        tagged with the end point and library, while other requests are not
+
+        :return: no return
+        """
+        client = self.create_app()
+
+        client.get('/libraries/abc')
+        client.get('/libraries/abc', headers={'X-Biblib-Profile': 'wrong'})
+        self.assertEqual(self.profiles(), [])
+
+        client.get('/libraries/abc', headers={'X-Biblib-Profile': 'secret'})
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertRegexpMatches(profiles[0],
+                                 r'^[0-9.]+-library-abc-[0-9]+ms\.prof$')
+
+        stats = pstats.Stats(os.path.join(self.directory, profiles[0]))
+        functions = [function for _, _, function in stats.stats]
+        self.assertIn('library', functions)
+        self.assertEqual(metrics.snapshot()['counters']['profiling.profiles'],
+                         1)
+
+    def test_only_the_last_profiles_are_kept(self):
+        """
+        Tests that the oldest profiles are removed beyond the maximum number
+
+        :return: no return
+        """
+        client = self.create_app(BIBLIB_PROFILING_SAMPLE_RATE=1)
+
+        for library in ['a', 'b', 'c', 'd', 'e']:
+            client.get('/libraries/{0}'.format(library))
+
+        self.assertEqual([profile.split('-')[2]
+                          for profile in self.profiles()], ['c', 'd', 'e'])
+
+    def test_nothing_is_registered_when_disabled(self):
+        """
+        Tests that no hook is registered when profiling is disabled, even for
+        requests with the token
+
+        :return: no return
+        """
+        app = Flask(__name__)
+        app.config.update(BIBLIB_PROFILING=False,
+                          BIBLIB_PROFILING_TOKEN='secret')
+        init_profiling(app)
+
+        self.assertEqual(app.before_request_funcs, {})
+        self.assertEqual(app.teardown_request_funcs, {})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,91 @@
+"""
+Tests the accounting of the SQL statements and upstream calls of requests
+"""
+
+import unittest
+from flask import Flask
+from httpretty import HTTPretty
+from sqlalchemy import create_engine
+from biblib.client import Client
+from biblib.request_stats import init_request_stats, SQL_HEADER, \
+    UPSTREAM_HEADER, TIME_HEADER
+
+
+class TestRequestStats(unittest.TestCase):
+    """
+    Class for testing the request stats headers
+    """
+
+    def create_app(self, enabled):
+        """
+        Create an application whose end point runs two statements and makes
+        one upstream call
+
+        :param enabled: value of BIBLIB_REQUEST_STATS
+        :return: test client
+        """
+        app = Flask(__name__)
+        app.config['BIBLIB_REQUEST_STATS'] = enabled
+        init_request_stats(app)
+        engine = create_engine('sqlite://')
+
+        @app.route('/libraries')
+        def libraries():
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            Client(app.config).session.get('http://upstream.test/user/1')
+            return 'libraries'
+
+        return app.test_client()
+
+    def setUp(self):
+        """
+        Stand in for the upstream service
+
+        :return: no return
+        """
+        HTTPretty.enable()
+        HTTPretty.register_uri(HTTPretty.GET, 'http://upstream.test/user/1',
+                               body='{}')
+
+    def tearDown(self):
+        """
+        Remove the stand-in
+
+        :return: no return
+        """
+        HTTPretty.reset()
+        HTTPretty.disable()
+
+    def test_statements_and_calls_are_counted(self):
+        """
+        Tests that the statements and upstream calls of each request are
+        returned in its headers
+
+        :return: no return
+        """
+        client = self.create_app(enabled=True)
+
+        for _ in range(2):
+            response = client.get('/libraries')
+            self.assertEqual(response.headers[SQL_HEADER], '2')
+            self.assertEqual(response.headers[UPSTREAM_HEADER], '1')
+            self.assertGreaterEqual(float(response.headers[TIME_HEADER]), 0)
+
+    def test_nothing_is_added_when_disabled(self):
+        """
+        Tests that responses have no stats headers when request stats are
+        disabled
+
+        :return: no return
+        """
+        client = self.create_app(enabled=False)
+
+        response = client.get('/libraries')
+        self.assertEqual(response.data, 'libraries')
+        for header in [SQL_HEADER, UPSTREAM_HEADER, TIME_HEADER]:
+            self.assertNotIn(header, response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,194 @@
+"""
+Tests the stand-ins of the services biblib depends on
+"""
+
+import json
+import zlib
+import unittest
+import threading
+from werkzeug.serving import make_server
+from biblib.app import create_app
+from biblib.views import LibraryView
+from biblib.tests import stand_ins
+from biblib.tests.stand_ins import ALTERNATE_RATE, MISSING_RATE
+
+
+def find_bibcode(offset, limit=0.0):
+    """
+    A bibcode whose document is missing, an alternate, or plain, depending on
+    where its draw falls
+
+    :param offset: lower bound of the draw
+    :param limit: upper bound of the draw, 1 by default
+    :return: bibcode
+    """
+    limit = limit or 1.0
+    for i in range(100000):
+        bibcode = '2015ApJ...{0:03d}.{1:04d}S'.format(i % 1000, i)
+        if offset <= stand_ins.key_random('document', bibcode).random() < \
+                limit:
+            return bibcode
+
+
+class TestStandIns(unittest.TestCase):
+    """
+    Class for testing the contracts of the stand-ins
+    """
+
+    def setUp(self):
+        """
+        Create a stand-in without latency or failures
+
+        :return: no return
+        """
+        self.app = stand_ins.create_app('fast', seed=1)
+        self.client = self.app.test_client()
+        self.bibcodes = ['2015ApJ...{0:03d}..{1:03d}S'.format(i, i)
+                         for i in range(1, 31)]
+
+    def bigquery(self, bibcodes, headers=None, compress=False, **params):
+        """
+        Query the bigquery stand-in
+
+        :param bibcodes: bibcodes of the body
+        :param headers: headers of the request
+        :param compress: gzip the body
+        :param params: parameters of the request
+        :return: decoded response
+        """
+        body = 'bibcode\n' + '\n'.join(bibcodes)
+        headers = headers or {}
+        if compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        response = self.client.post('/bigquery', query_string=params,
+                                    data=body, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_bigquery_pages_and_sorts(self):
+        """
+        Tests that the bigquery stand-in returns the fields asked for, sorted
+        and paginated, and the same documents for a gzip body
+
+        :return: no return
+        """
+        everything = self.bigquery(self.bibcodes, fl='bibcode,pubdate',
+                                   sort='date asc', rows=100)
+        docs = everything['response']['docs']
+        self.assertEqual(everything['response']['numFound'], len(docs))
+        self.assertEqual([sorted(doc.keys()) for doc in docs],
+                         [['bibcode', 'pubdate']] * len(docs))
+        self.assertEqual([doc['pubdate'] for doc in docs],
+                         sorted(doc['pubdate'] for doc in docs))
+
+        page = self.bigquery(self.bibcodes, compress=True,
+                             fl='bibcode,pubdate', sort='date asc', start=5,
+                             rows=10)
+        self.assertEqual(page['response']['docs'], docs[5:15])
+        self.assertEqual(page['response']['start'], 5)
+
+    def test_bigquery_alternate_and_missing_bibcodes(self):
+        """
+        Tests that alternate bibcodes are returned under their canonical
+        bibcode, and missing ones are not returned
+
+        :return: no return
+        """
+        missing = find_bibcode(0, MISSING_RATE)
+        alternate = find_bibcode(MISSING_RATE, MISSING_RATE + ALTERNATE_RATE)
+        plain = find_bibcode(MISSING_RATE + ALTERNATE_RATE)
+
+        result = self.bigquery([missing, alternate, plain],
+                               fl='bibcode,alternate_bibcode',
+                               sort='bibcode asc')
+        docs = result['response']['docs']
+        self.assertEqual(result['response']['numFound'], 2)
+        self.assertEqual(
+            docs,
+            [{'bibcode': plain, 'alternate_bibcode': []},
+             {'bibcode': '2016' + alternate[4:],
+              'alternate_bibcode': [alternate]}]
+        )
+
+    def test_user_resolver(self):
+        """
+        Tests that users are resolved by uid and email, matching the users of
+        the synthetic dataset
+
+        :return: no return
+        """
+        by_uid = json.loads(self.client.get('/user/42').data)
+        by_email = json.loads(self.client.get('/user/user42@example.com').data)
+        self.assertEqual(by_uid, {'uid': 42, 'email': 'user42@example.com'})
+        self.assertEqual(by_email, by_uid)
+        self.assertEqual(self.client.get('/user/nobody@ads').status_code, 404)
+
+    def test_harbour_libraries_are_stable(self):
+        """
+        Tests that the harbour end points return the same libraries for a user
+        every time, in the shape biblib imports
+
+        :return: no return
+        """
+        first = json.loads(self.client.get('/classic/7').data)
+        self.assertEqual(json.loads(self.client.get('/classic/7').data),
+                         first)
+        for library in first['libraries']:
+            self.assertEqual(sorted(library.keys()),
+                             ['description', 'documents', 'name'])
+            for bibcode in library['documents']:
+                self.assertEqual(len(bibcode), 19)
+        self.assertEqual(self.client.get('/twopointoh/7').status_code, 200)
+
+    def test_errors_are_injected(self):
+        """
+        Tests that the profile of a service makes its requests fail
+
+        :return: no return
+        """
+        app = stand_ins.create_app(
+            {'user': {'error_rate': 1, 'error_status': 502}}
+        )
+        client = app.test_client()
+        self.assertEqual(client.get('/user/1').status_code, 502)
+        self.assertEqual(client.get('/classic/1').status_code, 200)
+
+    def test_biblib_queries_the_bigquery_stand_in(self):
+        """
+        Tests that the bigquery requests biblib makes, compressed or not, are
+        answered by the stand-in served over HTTP
+
+        :return: no return
+        """
+        server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        app = create_app()
+        app.config['BIBLIB_SOLR_BIG_QUERY_URL'] = \
+            'http://127.0.0.1:{0:d}/bigquery'.format(server.server_port)
+        try:
+            for threshold in [0, 10 ** 6]:
+                app.config['BIBLIB_SOLR_BIG_QUERY_GZIP'] = True
+                app.config['BIBLIB_SOLR_BIG_QUERY_GZIP_THRESHOLD'] = threshold
+                with app.app_context():
+                    response = LibraryView.solr_big_query(
+                        self.bibcodes, start=0, rows=100, fl='title'
+                    )
+                self.assertEqual(response.status_code, 200)
+                docs = response.json()['response']['docs']
+                self.assertTrue(docs)
+                self.assertEqual(
+                    sorted(docs[0].keys()),
+                    ['alternate_bibcode', 'bibcode', 'title']
+                )
+        finally:
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
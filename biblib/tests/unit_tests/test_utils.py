@@ -3,7 +3,12 @@ Tests the functions within the utils module
 """
 
 import unittest
-from biblib.utils import uniquify, assert_unsorted_equal, get_item
+from StringIO import StringIO
+from datetime import datetime
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from biblib.utils import uniquify, assert_unsorted_equal, get_item, \
+    is_valid_bibcode, get_line_batches, get_etag, is_not_modified
 
 class TestUtils(unittest.TestCase):
     """
@@ -74,5 +79,66 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(item_1, 'item_1')
         self.assertEqual(item_2, 'item_2')
 
+    def test_is_valid_bibcode(self):
+        """
+        Tests that only strings with the shape of a bibcode are accepted
+        """
+        self.assertTrue(is_valid_bibcode('2015A&A...575A..31A'))
+        self.assertTrue(is_valid_bibcode(u'1998ApJ...500..525S'))
+
+        for bibcode in ['', 'bibcode', '2015A&A...575A..31', 'A015A&A...575A..31A',
+                        '2015A&A...575 ..31A', '2015A&A...575A..31AB']:
+            self.assertFalse(is_valid_bibcode(bibcode), bibcode)
+
+    def test_get_line_batches_yields_bounded_batches(self):
+        """
+        Tests that the lines of a stream are returned stripped, without empty
+        lines, and in batches no bigger than the size requested
+        """
+        stream = StringIO('1\n 2 \n\n3\r\n4\n5')
+
+        batches = list(get_line_batches(stream, batch_size=2))
+
+        self.assertEqual(batches, [['1', '2'], ['3', '4'], ['5']])
+    def test_get_etag_depends_on_all_parts(self):
+        """
+        Tests that the entity tag is stable for the same values, and changes
+        if any of them changes
+        """
+        etag = get_etag('library', datetime(2016, 1, 1), 'owner')
+
+        self.assertEqual(etag,
+                         get_etag('library', datetime(2016, 1, 1), 'owner'))
+        self.assertNotEqual(etag,
+                            get_etag('library', datetime(2016, 1, 2), 'owner'))
+        self.assertNotEqual(etag,
+                            get_etag('library', datetime(2016, 1, 1), 'read'))
+
+    def test_is_not_modified(self):
+        """
+        Tests that the conditional headers are evaluated, with If-None-Match
+        taking precedence over If-Modified-Since
+        """
+        last_modified = datetime(2016, 1, 1, 12, 0, 0, 500)
+
+        def request(headers):
+            return Request(EnvironBuilder(headers=headers).get_environ())
+
+        self.assertFalse(is_not_modified(request({}), 'etag', last_modified))
+        self.assertTrue(is_not_modified(
+            request({'If-None-Match': '"etag"'}), 'etag', last_modified))
+        self.assertFalse(is_not_modified(
+            request({'If-None-Match': '"old"'}), 'etag', last_modified))
+        self.assertTrue(is_not_modified(
+            request({'If-Modified-Since': 'Fri, 01 Jan 2016 12:00:00 GMT'}),
+            'etag', last_modified))
+        self.assertFalse(is_not_modified(
+            request({'If-Modified-Since': 'Fri, 01 Jan 2016 11:59:59 GMT'}),
+            'etag', last_modified))
+        self.assertFalse(is_not_modified(
+            request({'If-None-Match': '"old"',
+                     'If-Modified-Since': 'Fri, 01 Jan 2016 12:00:00 GMT'}),
+            'etag', last_modified))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
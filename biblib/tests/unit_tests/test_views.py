@@ -2,17 +2,23 @@
 Tests Views of the application
 """
 
-import unittest
+import time
+import mock
 import uuid
+import base64
+import unittest
 from biblib.models import db, User, Library, Permissions, MutableDict
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
+from StringIO import StringIO
 from biblib.views import UserView, LibraryView, DocumentView, PermissionView, \
-    BaseView, TransferView, ClassicView
+    BaseView, TransferView, ClassicView, DocumentBulkView, OperationsView, \
+    ContainsView
 from biblib.views import DEFAULT_LIBRARY_DESCRIPTION
 from biblib.tests.stubdata.stub_data import UserShop, LibraryShop
 from biblib.utils import get_item
-from biblib.biblib_exceptions import BackendIntegrityError, PermissionDeniedError
+from biblib.biblib_exceptions import BackendIntegrityError, \
+    PermissionDeniedError, PreconditionFailedError, TooManyBibcodesError
 from biblib.tests.base import TestCaseDatabase, MockEmailService, \
     MockSolrBigqueryService
 
@@ -51,6 +57,55 @@ class TestBaseViews(TestCaseDatabase):
 
         self.assertEqual(expected_slug, output_slug)
 
+    def test_library_identity_at_1000_libraries(self):
+        """
+        Benchmark of what identifying the libraries costs when listing 1,000
+        of them: the ids come back as UUIDs from the driver, the slugs are
+        only computed once, and nothing is logged per library
+
+        :return: no return
+        """
+        user = User(absolute_uid=1)
+        db.session.add(user)
+        db.session.commit()
+
+        number_of_libs = 1000
+        for i in range(number_of_libs):
+            library = Library(name='{0}'.format(i), public=False)
+            db.session.add(library)
+            db.session.add(Permissions(user=user, library=library, owner=True))
+        db.session.commit()
+
+        def list_slugs():
+            start = time.time()
+            library_ids = db.session.query(Library.id)\
+                .join(Permissions.library)\
+                .filter(Permissions.user_id == user.id)\
+                .all()
+            slugs = [BaseView.helper_uuid_to_slug(library_id)
+                     for library_id, in library_ids]
+            return library_ids, slugs, time.time() - start
+
+        with mock.patch('biblib.views.base_view.base64') as base64_mock, \
+                mock.patch('biblib.views.base_view.logger.log') as log_mock:
+            base64_mock.urlsafe_b64encode.side_effect = \
+                base64.urlsafe_b64encode
+            library_ids, slugs, cold = list_slugs()
+            _, warm_slugs, warm = list_slugs()
+
+        self.app.logger.info(
+            'Identified {0} libraries in {1:.4f}s cold, {2:.4f}s warm'
+            .format(number_of_libs, cold, warm)
+        )
+
+        self.assertTrue(all(isinstance(library_id, uuid.UUID)
+                            for library_id, in library_ids))
+        self.assertEqual(len(set(slugs)), number_of_libs)
+        self.assertEqual(slugs, warm_slugs)
+        self.assertEqual(base64_mock.urlsafe_b64encode.call_count,
+                         number_of_libs)
+        self.assertEqual(log_mock.call_count, 0)
+
     def test_api_email_does_exist(self):
         """
         Tests that the api email resolver returns 200 if e-mail exists
@@ -385,20 +440,23 @@ class TestUserViews(TestCaseDatabase):
             for key in self.stub_library.user_view_get_response():
                 self.assertIn(key, library.keys(), 'Missing key: {0}'
                                                    .format(key))
-        for i in range(number_of_libs):
+        # The libraries are not listed in any particular order
+        libraries = {library['name']: library for library in libraries}
+        for stub_library in libs:
+            library = libraries[stub_library.user_view_post_data['name']]
             for key in ['name', 'description', 'public']:
-                self.assertEqual(libraries[i][key],
-                                 libs[i].user_view_post_data[key])
+                self.assertEqual(library[key],
+                                 stub_library.user_view_post_data[key])
 
-            self.assertEqual(libraries[i]['num_documents'], 0)
+            self.assertEqual(library['num_documents'], 0)
 
-            if libraries[i]['id'] == \
+            if library['id'] == \
                     self.user_view.helper_uuid_to_slug(_lib.id):
-                self.assertEqual(libraries[i]['num_users'], 2)
+                self.assertEqual(library['num_users'], 2)
             else:
-                self.assertEqual(libraries[i]['num_users'], 1)
+                self.assertEqual(library['num_users'], 1)
 
-            self.assertEqual(libraries[i]['permission'], 'owner')
+            self.assertEqual(library['permission'], 'owner')
 
         # Get the library created
         with MockEmailService(stub_user_2, end_type='uid'):
@@ -679,6 +737,51 @@ class TestLibraryViews(TestCaseDatabase):
 
         self.stub_library = LibraryShop()
 
+    def test_solr_big_query_times_out(self):
+        """
+        Test that the call to Solr bigquery is bounded by the configured
+        timeout
+
+        :return: no return
+        """
+        with mock.patch('biblib.views.library_view.client') as client_mock:
+            client_mock.return_value.post.return_value.status_code = 200
+            self.library_view.solr_big_query(bibcodes=['1'])
+
+        self.assertEqual(
+            client_mock.return_value.post.call_args[1]['timeout'],
+            self.app.config['BIBLIB_SOLR_BIG_QUERY_TIMEOUT']
+        )
+
+    def test_page_is_selected_locally_for_bibcode_sorts(self):
+        """
+        Test that only the bibcodes of the page are sent to Solr when the sort
+        order is on the bibcode, and all of them otherwise
+
+        :return: no return
+        """
+        bibcodes = ['{0}'.format(i) for i in range(10)]
+
+        plan = self.library_view.plan_big_query(bibcodes=bibcodes, start=2,
+                                                rows=3, sort='bibcode desc')
+        self.assertTrue(plan['local'])
+        self.assertEqual(plan['bibcodes'], ['7', '6', '5'])
+        self.assertEqual(plan['start'], 0)
+        self.assertEqual(plan['rows'], 3)
+
+        plan = self.library_view.plan_big_query(bibcodes=bibcodes, start=8,
+                                                rows=20, sort=' bibcode asc ')
+        self.assertTrue(plan['local'])
+        self.assertEqual(plan['bibcodes'], ['8', '9'])
+
+        for sort in ['date desc', 'bibcode asc, date desc', 'bibcode']:
+            plan = self.library_view.plan_big_query(bibcodes=bibcodes,
+                                                    start=2, rows=3, sort=sort)
+            self.assertFalse(plan['local'])
+            self.assertEqual(plan['bibcodes'], bibcodes)
+            self.assertEqual(plan['start'], 2)
+            self.assertEqual(plan['rows'], 3)
+
     def test_user_can_get_documents_from_library(self):
         """
         Test that can retrieve all the bibcodes from a library
@@ -1433,6 +1536,150 @@ class TestDocumentViews(TestCaseDatabase):
             'There should be no bibcodes: {0}'.format(library.bibcode)
         )
 
+    def test_modifications_increment_the_library_version(self):
+        """
+        Tests that each modification increments the version of the library,
+        and that a modification of a version that is not current is refused
+
+        :return: no return
+        """
+        library = Library(name='MyLibrary',
+                          description='My library',
+                          public=True)
+        db.session.add(library)
+        db.session.commit()
+        library_id = library.id
+        self.assertEqual(library.version, 1)
+
+        self.document_view.add_document_to_library(
+            library_id=library_id,
+            document_data=self.stub_library.document_view_post_data('add')
+        )
+        self.document_view.update_library(
+            library_id=library_id,
+            library_data={'name': 'MyNewLibrary'},
+            if_match=[2]
+        )
+        library = Library.query.filter(Library.id == library_id).one()
+        self.assertEqual(library.version, 3)
+
+        with self.assertRaises(PreconditionFailedError):
+            self.document_view.remove_documents_from_library(
+                library_id=library_id,
+                document_data=self.stub_library.document_view_post_data(
+                    'remove'
+                ),
+                if_match=[2]
+            )
+        db.session.rollback()
+
+        library = Library.query.filter(Library.id == library_id).one()
+        self.assertEqual(library.version, 3)
+        self.assertUnsortedEqual(library.get_bibcodes(),
+                                 self.stub_library.get_bibcodes())
+
+    def test_user_can_bulk_add_to_library(self):
+        """
+        Tests that streaming bibcodes in to a library adds the new ones, and
+        counts the duplicate and invalid lines
+
+        :return: no return
+        """
+        existing = '2015A&A...575A..31A'
+        new = ['1998ApJ...500..525S', '2001MNRAS.321..112B',
+               '2010Natur.468..927B']
+
+        library = Library(name='MyLibrary',
+                          description='My library',
+                          public=True,
+                          bibcode={existing: {}})
+        db.session.add(library)
+        db.session.commit()
+        library_id = library.id
+
+        lines = [existing, new[0], '', new[1], new[1], 'not a bibcode', new[2]]
+        counts = DocumentBulkView.bulk_add_documents_to_library(
+            library_id=library_id,
+            stream=StringIO('\n'.join(lines)),
+            batch_size=2
+        )
+
+        self.assertEqual(counts['number_added'], 3)
+        self.assertEqual(counts['number_duplicate'], 2)
+        self.assertEqual(counts['number_invalid'], 1)
+
+        library = Library.query.filter(Library.id == library_id).one()
+        self.assertUnsortedEqual(library.get_bibcodes(), [existing] + new)
+
+    def test_bulk_add_reads_the_stream_before_locking_the_library(self):
+        """
+        Tests that the whole stream is read before the library is locked, and
+        that the bibcodes already in the library keep their value
+
+        :return: no return
+        """
+        existing = '2015A&A...575A..31A'
+        library = Library(bibcode={existing: {'note': 'kept'}})
+        db.session.add(library)
+        db.session.commit()
+        library_id = library.id
+
+        events = []
+
+        def lines():
+            for bibcode in [existing, '1998ApJ...500..525S']:
+                events.append('read')
+                yield bibcode + '\n'
+
+        bump = DocumentBulkView.helper_bump_library_version
+
+        def locking_bump(library_id, if_match=None):
+            events.append('lock')
+            return bump(library_id=library_id, if_match=if_match)
+
+        with mock.patch.object(DocumentBulkView,
+                               'helper_bump_library_version',
+                               staticmethod(locking_bump)):
+            counts = DocumentBulkView.bulk_add_documents_to_library(
+                library_id=library_id,
+                stream=lines(),
+                batch_size=1
+            )
+
+        self.assertEqual(events, ['read', 'read', 'lock'])
+        self.assertEqual(counts['number_added'], 1)
+        self.assertEqual(counts['number_duplicate'], 1)
+
+        library = Library.query.filter(Library.id == library_id).one()
+        self.assertEqual(library.bibcode[existing], {'note': 'kept'})
+        self.assertEqual(library.version, 2)
+
+    def test_bulk_add_refuses_too_many_bibcodes(self):
+        """
+        Tests that a stream with more distinct bibcodes than the limit is
+        refused, and the library left as it was
+
+        :return: no return
+        """
+        library = Library(bibcode={})
+        db.session.add(library)
+        db.session.commit()
+        library_id = library.id
+
+        lines = ['1998ApJ...500..525S', '2001MNRAS.321..112B',
+                 '2010Natur.468..927B']
+        with self.assertRaises(TooManyBibcodesError):
+            DocumentBulkView.bulk_add_documents_to_library(
+                library_id=library_id,
+                stream=StringIO('\n'.join(lines)),
+                batch_size=1,
+                max_bibcodes=2
+            )
+
+        library = Library.query.filter(Library.id == library_id).one()
+        self.assertEqual(library.bibcode, {})
+        self.assertEqual(library.version, 1)
+
     def test_user_without_permission_cannot_edit_private_library(self):
         """
         Tests that the user requesting to edit the contents of a library has
@@ -2729,5 +2976,164 @@ class TestClassicViews(TestCaseDatabase):
         self.assertNotIn('new bibcode', stub_library.get_bibcodes())
 
 
+
+class TestOperationsViews(TestCaseDatabase):
+    """
+    Base class to test the Operations view for POST
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor of the class
+
+        :param args: to pass on to the super class
+        :param kwargs: to pass on to the super class
+
+        :return: no return
+        """
+
+        super(TestOperationsViews, self).__init__(*args, **kwargs)
+        self.operations_view = OperationsView
+
+        # Stub data
+        self.stub_user = UserShop()
+
+    def test_set_operations_on_bibcodes(self):
+        """
+        Tests that each of the operations gives the expected set of bibcodes
+
+        :return: no return
+        """
+        primary = set(['1', '2', '3'])
+        secondaries = [set(['2', '3', '4']), set(['3', '5'])]
+
+        expected = dict(
+            union=set(['1', '2', '3', '4', '5']),
+            intersection=set(['3']),
+            difference=set(['1']),
+            copy=set(['1', '2', '3'])
+        )
+        for action in expected:
+            result = self.operations_view.compute_operation(
+                action=action,
+                primary=primary,
+                secondaries=secondaries
+            )
+            self.assertEqual(result, expected[action], action)
+
+        with self.assertRaises(ValueError):
+            self.operations_view.compute_operation(
+                action='merge',
+                primary=primary,
+                secondaries=secondaries
+            )
+
+    def test_operations_need_the_right_number_of_libraries(self):
+        """
+        Tests that the operations are only valid with the number of secondary
+        libraries that they can use
+
+        :return: no return
+        """
+        self.assertTrue(self.operations_view.valid_operation('union', ['1']))
+        self.assertTrue(
+            self.operations_view.valid_operation('difference', ['1', '2'])
+        )
+        self.assertFalse(self.operations_view.valid_operation('union', []))
+        self.assertTrue(self.operations_view.valid_operation('copy', ['1']))
+        self.assertFalse(
+            self.operations_view.valid_operation('copy', ['1', '2'])
+        )
+        self.assertFalse(self.operations_view.valid_operation('merge', ['1']))
+
+    def test_read_access_for_operations(self):
+        """
+        Tests that a library can be used in an operation if it is public, or
+        if the user has read permissions for it
+
+        :return: no return
+        """
+        user = User(absolute_uid=self.stub_user.absolute_uid)
+        library_public = Library(public=True)
+        library_private = Library(public=False)
+        library_read = Library(public=False)
+        permission = Permissions(read=True)
+
+        user.permissions.append(permission)
+        library_read.permissions.append(permission)
+        db.session.add_all([user, library_public, library_private,
+                            library_read, permission])
+        db.session.commit()
+
+        self.assertTrue(self.operations_view.read_access(
+            service_uid=user.id, library_id=library_public.id))
+        self.assertTrue(self.operations_view.read_access(
+            service_uid=user.id, library_id=library_read.id))
+        self.assertFalse(self.operations_view.read_access(
+            service_uid=user.id, library_id=library_private.id))
+
+
+class TestContainsViews(TestCaseDatabase):
+    """
+    Base class to test the Contains view for POST
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Constructor of the class
+
+        :param args: to pass on to the super class
+        :param kwargs: to pass on to the super class
+
+        :return: no return
+        """
+
+        super(TestContainsViews, self).__init__(*args, **kwargs)
+        self.contains_view = ContainsView
+
+        # Stub data
+        self.stub_user_1 = UserShop()
+        self.stub_user_2 = UserShop()
+
+    def test_libraries_containing_bibcodes(self):
+        """
+        Tests that only the libraries of the user that contain each bibcode
+        are returned
+
+        :return: no return
+        """
+        user_1 = User(absolute_uid=self.stub_user_1.absolute_uid)
+        user_2 = User(absolute_uid=self.stub_user_2.absolute_uid)
+
+        library_1 = Library(bibcode={'1': {}, '2': {}})
+        library_2 = Library(bibcode={'2': {}, '3': {}})
+        library_other = Library(bibcode={'1': {}, '2': {}, '3': {}})
+
+        permission_1 = Permissions(owner=True)
+        permission_2 = Permissions(read=True)
+        permission_other = Permissions(owner=True)
+
+        user_1.permissions.extend([permission_1, permission_2])
+        user_2.permissions.append(permission_other)
+        library_1.permissions.append(permission_1)
+        library_2.permissions.append(permission_2)
+        library_other.permissions.append(permission_other)
+        db.session.add_all([user_1, user_2, library_1, library_2,
+                            library_other])
+        db.session.commit()
+
+        slug_1 = BaseView.helper_uuid_to_slug(library_1.id)
+        slug_2 = BaseView.helper_uuid_to_slug(library_2.id)
+
+        libraries = self.contains_view.get_libraries_containing(
+            service_uid=user_1.id,
+            bibcodes=['1', '2', '3', '4']
+        )
+
+        self.assertEqual(libraries['1'], [slug_1])
+        self.assertUnsortedEqual(libraries['2'], [slug_1, slug_2])
+        self.assertEqual(libraries['3'], [slug_2])
+        self.assertEqual(libraries['4'], [])
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -2,18 +2,29 @@
 Test webservices
 """
 
+import zlib
 import json
+import mock
+import time
+import threading
+from httpretty import HTTPretty
 import unittest
 from flask import url_for
 from biblib.views import DEFAULT_LIBRARY_DESCRIPTION, DEFAULT_LIBRARY_NAME_PREFIX
 from biblib.views.http_errors import DUPLICATE_LIBRARY_NAME_ERROR, \
     MISSING_LIBRARY_ERROR, MISSING_USERNAME_ERROR, \
     NO_PERMISSION_ERROR, WRONG_TYPE_ERROR, \
-    API_MISSING_USER_EMAIL, SOLR_RESPONSE_MISMATCH_ERROR, NO_CLASSIC_ACCOUNT
+    API_MISSING_USER_EMAIL, SOLR_RESPONSE_MISMATCH_ERROR, NO_CLASSIC_ACCOUNT, \
+    WRONG_OPERATION_ERROR, TOO_MANY_BIBCODES_ERROR, PRECONDITION_FAILED_ERROR, \
+    SOLR_UNAVAILABLE_ERROR
 from biblib.tests.stubdata.stub_data import LibraryShop, UserShop, fake_biblist
 from biblib.tests.base import MockEmailService, MockSolrBigqueryService,\
     TestCaseDatabase, MockEndPoint, MockClassicService
+from biblib import metrics, slow_queries
 from biblib.utils import get_item
+from biblib.models import db, RoutingSession, User, Library
+from biblib.views.base_view import BaseView, REPLICA_STATUS, \
+    REPLICA_LAG_QUERY, REPLICA_LAG_FUNCTIONS
 
 
 class TestWebservices(TestCaseDatabase):
@@ -426,6 +437,216 @@ class TestWebservices(TestCaseDatabase):
         self.assertUnsortedEqual(lib_docs, non_canonical_biblist)
         self.assertUnsortedNotEqual(lib_docs, canonical_biblist)
 
+    def test_large_bigquery_uploads_are_compressed(self):
+        """
+        Test the /libraries/<> end point
+        The bibcodes of a large library are sent to Solr bigquery gzip
+        compressed, when it accepts it
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+        self.app.config['BIBLIB_SOLR_BIG_QUERY_GZIP'] = True
+        metrics.reset()
+
+        post_data = stub_library.user_view_post_data
+        post_data['bibcode'] = fake_biblist(5000)
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=json.dumps(post_data),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+
+        url = url_for('libraryview', library=library_id)
+        with MockSolrBigqueryService(number_of_bibcodes=20) as BQ, \
+                MockEndPoint([stub_user]) as EP:
+            response = self.client.get(url, headers=stub_user.headers)
+            request = [request for request in HTTPretty.latest_requests
+                       if 'bigquery' in request.path][-1]
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        uploaded = zlib.decompress(request.body, 16 + zlib.MAX_WBITS)\
+            .split('\n')
+        self.assertEqual(uploaded[0], 'bibcode')
+        self.assertEqual(set(uploaded[1:]), set(post_data['bibcode']))
+
+        uncompressed = len('\n'.join(uploaded))
+        compressed = len(request.body)
+        self.app.logger.info('Bigquery upload of {0} bibcodes: {1} bytes '
+                             'instead of {2}'
+                             .format(len(uploaded) - 1, compressed,
+                                     uncompressed))
+        self.assertLess(compressed, uncompressed / 2)
+        self.assertEqual(
+            metrics.snapshot()['counters']['bigquery.upload_bytes_saved'],
+            uncompressed - compressed
+        )
+
+    def test_bigquery_only_receives_the_page_for_bibcode_sorts(self):
+        """
+        Test the /libraries/<> end point
+        When sorting by bibcode, only the bibcodes of the page are sent to
+        Solr bigquery, and the Solr response still describes the library
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+
+        post_data = stub_library.user_view_post_data
+        post_data['bibcode'] = fake_biblist(200)
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=json.dumps(post_data),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+        bibcodes = sorted(set(post_data['bibcode']))
+
+        url = url_for('libraryview', library=library_id)
+        page = bibcodes[10:15]
+        with MockSolrBigqueryService(canonical_bibcode=page) as BQ, \
+                MockEndPoint([stub_user]) as EP:
+            response = self.client.get(
+                url,
+                query_string={'start': 10, 'rows': 5, 'sort': 'bibcode asc'},
+                headers=stub_user.headers
+            )
+            request = [request for request in HTTPretty.latest_requests
+                       if 'bigquery' in request.path][-1]
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(request.body.split('\n'), ['bibcode'] + page)
+        self.assertEqual(request.querystring['start'], ['0'])
+        self.assertEqual(request.querystring['rows'], ['5'])
+
+        self.assertEqual(response.json['documents'], page)
+        self.assertEqual(response.json['solr']['response']['numFound'],
+                         len(bibcodes))
+        self.assertEqual(response.json['solr']['response']['start'], 10)
+
+    def test_identical_concurrent_reads_share_one_bigquery_call(self):
+        """
+        Test the /libraries/<> end point
+        A burst of identical reads of a public library is answered with fewer
+        Solr bigquery calls than requests, and every request gets the content
+
+        :return: no return
+        """
+        stub_owner = UserShop()
+        stub_users = [UserShop() for i in range(10)]
+        stub_library = LibraryShop(public=True)
+
+        post_data = stub_library.user_view_post_data
+        post_data['bibcode'] = fake_biblist(20)
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=json.dumps(post_data),
+            headers=stub_owner.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+        bibcodes = sorted(set(post_data['bibcode']))
+
+        url = url_for('libraryview', library=library_id)
+        go = threading.Event()
+        responses = []
+        metrics.reset()
+
+        def read(stub_user):
+            go.wait()
+            responses.append(self.client.get(url, headers=stub_user.headers))
+
+        threads = [threading.Thread(target=read, args=(stub_user,))
+                   for stub_user in stub_users]
+        with MockSolrBigqueryService(canonical_bibcode=bibcodes,
+                                     delay=1) as BQ, \
+                MockEndPoint([stub_owner] + stub_users) as EP:
+            for thread in threads:
+                thread.start()
+            go.set()
+            for thread in threads:
+                thread.join()
+            calls = len([request for request in HTTPretty.latest_requests
+                         if 'bigquery' in request.path])
+
+        self.app.logger.info('{0} reads made {1} bigquery calls'
+                             .format(len(stub_users), calls))
+        self.assertEqual(len(responses), len(stub_users))
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['documents'], bibcodes[:20])
+        self.assertLess(calls, len(stub_users))
+
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(calls, counters['singleflight.library_content.leader'])
+        self.assertEqual(
+            counters['singleflight.library_content.leader'] +
+            counters.get('singleflight.library_content.shared', 0),
+            len(stub_users)
+        )
+
+    def test_library_is_served_degraded_while_solr_keeps_failing(self):
+        """
+        Test the /libraries/<> end point
+        Once Solr bigquery failed often enough, libraries are served from the
+        local bibcodes without calling Solr, and marked as degraded
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        stub_library = LibraryShop(want_bibcode=True)
+        metrics.reset()
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+
+        url = url_for('libraryview', library=library_id)
+        min_calls = \
+            self.app.config['BIBLIB_SOLR_BIG_QUERY_BREAKER']['min_calls']
+        with MockSolrBigqueryService(status=500) as BQ, \
+                MockEndPoint([stub_user]) as EP:
+            for i in range(min_calls):
+                response = self.client.get(url, headers=stub_user.headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(response.json['degraded'])
+
+            def solr_calls():
+                return len([request for request in HTTPretty.latest_requests
+                            if 'bigquery' in request.path])
+
+            self.assertEqual(solr_calls(), min_calls)
+            response = self.client.get(url, headers=stub_user.headers)
+
+            # Solr was not called
+            self.assertEqual(solr_calls(), min_calls)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['degraded'])
+        self.assertEqual(response.json['solr'], SOLR_UNAVAILABLE_ERROR['body'])
+        self.assertUnsortedEqual(response.json['documents'],
+                                 stub_library.get_bibcodes())
+        self.assertEqual(
+            metrics.snapshot()['gauges']['breaker.bigquery.state'], 2
+        )
+
     def test_create_library_resource_and_add_bibcodes_of_wrong_type(self):
         """
         Test the /libraries route
@@ -754,6 +975,64 @@ class TestWebservices(TestCaseDatabase):
         self.assertEqual(stub_library.get_bibcodes(),
                          response.json['documents'])
 
+    def test_bulk_add_documents_to_library(self):
+        """
+        Test the /documents/<>/bulk end point with POST to stream documents
+        in to a library
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_user_2 = UserShop()
+        stub_library = LibraryShop()
+        bibcodes = fake_biblist(50)
+
+        # Make the library
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+
+        # Stream the bibcodes, with a duplicate and an invalid line
+        url = url_for('documentbulkview', library=library_id)
+        response = self.client.post(
+            url,
+            data='\n'.join(bibcodes + bibcodes[:1] + ['not a bibcode']),
+            headers=stub_user.headers,
+            content_type='text/plain'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['number_added'], len(set(bibcodes)))
+        self.assertEqual(response.json['number_duplicate'],
+                         len(bibcodes) + 1 - len(set(bibcodes)))
+        self.assertEqual(response.json['number_invalid'], 1)
+
+        # More bibcodes than the limit are refused
+        with mock.patch.dict(self.app.config, {'BIBLIB_BULK_MAX_BIBCODES': 10}):
+            response = self.client.post(
+                url,
+                data='\n'.join(bibcodes),
+                headers=stub_user.headers,
+                content_type='text/plain'
+            )
+        self.assertEqual(response.status_code,
+                         TOO_MANY_BIBCODES_ERROR['number'])
+
+        # A user without permissions cannot stream in to the library
+        response = self.client.post(
+            url,
+            data='\n'.join(bibcodes),
+            headers=stub_user_2.headers,
+            content_type='text/plain'
+        )
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
     def test_cannot_add_duplicate_documents_to_library(self):
         """
         Test the /documents/<> end point with POST to add a document. Should
@@ -2101,6 +2380,735 @@ class TestWebservices(TestCaseDatabase):
                 .format(stub_library.bibcode, response.json['documents'])
         )
 
+    def test_library_operations(self):
+        """
+        Test the /libraries/operations/<> end point with POST, for each of the
+        operations between two libraries
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        bibcodes_1 = ['2015A&A...575A..31A', '1998ApJ...500..525S']
+        bibcodes_2 = ['1998ApJ...500..525S', '2001MNRAS.321..112B']
+
+        # Make the libraries
+        library_ids = []
+        for name, bibcodes in [('one', bibcodes_1), ('two', bibcodes_2)]:
+            response = self.client.post(
+                url_for('userview'),
+                data=json.dumps(dict(name=name, bibcode=bibcodes)),
+                headers=stub_user.headers
+            )
+            self.assertEqual(response.status_code, 200)
+            library_ids.append(response.json['id'])
+
+        url = url_for('operationsview', library=library_ids[0])
+        expected = dict(
+            union=set(bibcodes_1 + bibcodes_2),
+            intersection=set(bibcodes_1) & set(bibcodes_2),
+            difference=set(bibcodes_1) - set(bibcodes_2)
+        )
+        for action in expected:
+            response = self.client.post(
+                url,
+                data=json.dumps(dict(action=action,
+                                     libraries=[library_ids[1]],
+                                     name=action)),
+                headers=stub_user.headers
+            )
+            self.assertEqual(response.status_code, 200, response.json)
+            self.assertEqual(response.json['name'], action)
+            self.assertEqual(response.json['num_documents'],
+                             len(expected[action]))
+
+            # The new library should contain the result
+            with MockSolrBigqueryService(
+                    canonical_bibcode=list(expected[action])), \
+                    MockEmailService(stub_user, end_type='uid'):
+                response = self.client.get(
+                    url_for('libraryview', library=response.json['id']),
+                    headers=stub_user.headers
+                )
+            self.assertUnsortedEqual(response.json['documents'],
+                                     expected[action])
+
+        # Copy in to the second library
+        response = self.client.post(
+            url,
+            data=json.dumps(dict(action='copy', libraries=[library_ids[1]])),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['id'], library_ids[1])
+        self.assertEqual(response.json['number_added'], 1)
+        self.assertEqual(response.json['num_documents'], 3)
+
+    def test_library_operations_checks_permissions_and_operation(self):
+        """
+        Test the /libraries/operations/<> end point with POST refuses
+        libraries the user cannot read, and operations that do not exist
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user_1 = UserShop()
+        stub_user_2 = UserShop()
+
+        library_ids = []
+        for stub_user in [stub_user_1, stub_user_2]:
+            response = self.client.post(
+                url_for('userview'),
+                data=LibraryShop().user_view_post_data_json,
+                headers=stub_user.headers
+            )
+            library_ids.append(response.json['id'])
+
+        url = url_for('operationsview', library=library_ids[0])
+
+        # The second library is private to the second user
+        response = self.client.post(
+            url,
+            data=json.dumps(dict(action='union', libraries=[library_ids[1]])),
+            headers=stub_user_1.headers
+        )
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        # Copying needs write permissions on the library copied in to
+        response = self.client.post(
+            url_for('operationsview', library=library_ids[1]),
+            data=json.dumps(dict(action='copy', libraries=[library_ids[0]])),
+            headers=stub_user_1.headers
+        )
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        # Unknown operations
+        response = self.client.post(
+            url,
+            data=json.dumps(dict(action='merge', libraries=[library_ids[0]])),
+            headers=stub_user_1.headers
+        )
+        self.assertEqual(response.status_code,
+                         WRONG_OPERATION_ERROR['number'])
+        self.assertEqual(response.json['error'],
+                         WRONG_OPERATION_ERROR['body'])
+    def test_libraries_containing_bibcodes(self):
+        """
+        Test the /libraries/contains end point with POST, returns the
+        libraries of the user that contain each bibcode
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_library = LibraryShop(want_bibcode=True)
+        bibcode = stub_library.get_bibcodes()[0]
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        library_id = response.json['id']
+
+        url = url_for('containsview')
+        response = self.client.post(
+            url,
+            data=json.dumps(dict(bibcode=[bibcode, 'not in a library'])),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['bibcodes'][bibcode], [library_id])
+        self.assertEqual(response.json['bibcodes']['not in a library'], [])
+
+        # Too many bibcodes at once
+        self.app.config['BIBLIB_CONTAINS_MAX_BIBCODES'] = 1
+        response = self.client.post(
+            url,
+            data=json.dumps(dict(bibcode=[bibcode, 'not in a library'])),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code,
+                         TOO_MANY_BIBCODES_ERROR['number'])
+
+    def test_conditional_get_of_a_library(self):
+        """
+        Test the /libraries/<> end point with GET, answers 304 when the ETag
+        or modification date sent by the client is still current, and a full
+        response after the library changes
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_library = LibraryShop(want_bibcode=True, public=True)
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        library_id = response.json['id']
+
+        url = url_for('libraryview', library=library_id)
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes()), \
+                MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=stub_user.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # Neither Solr nor the e-mail service are needed for a 304
+        headers = dict(stub_user.headers)
+        headers['If-None-Match'] = etag
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.data, '')
+
+        headers = dict(stub_user.headers)
+        headers['If-Modified-Since'] = last_modified
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        # Change the library, and the ETag no longer matches
+        response = self.client.put(
+            url_for('documentview', library=library_id),
+            data=stub_library.document_view_put_data_json(name='new name'),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+
+        headers = dict(stub_user.headers)
+        headers['If-None-Match'] = etag
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes()), \
+                MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_conditional_get_does_not_bypass_permissions(self):
+        """
+        Test the /libraries/<> end point with GET, a user without access to a
+        private library gets no 304 for a matching ETag
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_owner = UserShop()
+        stub_other = UserShop()
+        stub_library = LibraryShop(want_bibcode=True)
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_owner.headers
+        )
+        url = url_for('libraryview', library=response.json['id'])
+
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes()), \
+                MockEmailService(stub_owner, end_type='uid'):
+            response = self.client.get(url, headers=stub_owner.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response.headers['Cache-Control'])
+
+        headers = dict(stub_other.headers)
+        headers['If-None-Match'] = '*'
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes()), \
+                MockEmailService(stub_owner, end_type='uid'):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+    def test_conditional_get_of_the_libraries_of_a_user(self):
+        """
+        Test the /libraries end point with GET, answers 304 when none of the
+        libraries of the user have changed
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        library_id = response.json['id']
+
+        url = url_for('userview')
+        with MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=stub_user.headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        headers = dict(stub_user.headers)
+        headers['If-None-Match'] = etag
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        # Adding documents modifies the library
+        response = self.client.post(
+            url_for('documentview', library=library_id),
+            data=stub_library.document_view_post_data_json('add'),
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+
+        with MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_libraries_of_a_user_are_sent_compressed(self):
+        """
+        Test the /libraries end point with GET, a large listing is compressed
+        for clients that accept it, and can still be revalidated
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        for i in range(10):
+            response = self.client.post(
+                url_for('userview'),
+                data=LibraryShop().user_view_post_data_json,
+                headers=stub_user.headers
+            )
+            self.assertEqual(response.status_code, 200)
+
+        url = url_for('userview')
+        headers = dict(stub_user.headers)
+        headers['Accept-Encoding'] = 'gzip'
+        with MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(response.headers['ETag'].startswith('W/'))
+
+        libraries = json.loads(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+        )['libraries']
+        self.assertEqual(len(libraries), 10)
+
+        headers['If-None-Match'] = response.headers['ETag']
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_slow_queries_need_the_admin_token(self):
+        """
+        Test the /admin/slow_queries end point
+        The slowest statements are listed to holders of the admin token only
+
+        :return: no return
+        """
+        slow_queries.reset()
+        for statement, duration in [('a', 0.1), ('b', 0.3), ('c', 0.2)]:
+            slow_queries.record_slow_query('libraries', statement, {},
+                                           duration, max_statements=1000)
+
+        url = url_for('slowqueryview')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        self.app.config['BIBLIB_ADMIN_TOKEN'] = 'secret'
+        response = self.client.get(
+            url,
+            headers={'X-Biblib-Admin-Token': 'wrong'}
+        )
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        response = self.client.get(
+            url,
+            query_string={'rows': 2},
+            headers={'X-Biblib-Admin-Token': 'secret'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([query['statement']
+                          for query in response.json['slow_queries']],
+                         ['b', 'c'])
+        slow_queries.reset()
+
+    def test_metrics_need_the_admin_token(self):
+        """
+        Test the /admin/metrics end point
+        The metrics of the worker are returned to holders of the admin token
+        only
+
+        :return: no return
+        """
+        metrics.reset()
+        metrics.incr('test.requests', 2)
+        metrics.gauge('test.in_use', 3)
+        metrics.timing('test.duration', 0.5)
+
+        url = url_for('metricsview')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        self.app.config['BIBLIB_ADMIN_TOKEN'] = 'secret'
+        response = self.client.get(
+            url,
+            headers={'X-Biblib-Admin-Token': 'wrong'}
+        )
+        self.assertEqual(response.status_code, NO_PERMISSION_ERROR['number'])
+
+        response = self.client.get(
+            url,
+            headers={'X-Biblib-Admin-Token': 'secret'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['counters']['test.requests'], 2)
+        self.assertEqual(response.json['gauges']['test.in_use'], 3)
+        self.assertEqual(response.json['timings']['test.duration'],
+                         {'count': 1, 'total': 0.5, 'max': 0.5})
+        self.assertIn('pid', response.json)
+        metrics.reset()
+
+    def test_concurrent_editors_get_precondition_failed(self):
+        """
+        Test the /documents/<> end point with POST and If-Match, an editor
+        using a version of the library that has since been modified gets 412
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+        stub_library_2 = LibraryShop()
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        library_id = response.json['id']
+
+        # Both editors read the current version
+        with MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url_for('userview'),
+                                       headers=stub_user.headers)
+        version = response.json['libraries'][0]['version']
+        self.assertEqual(version, 1)
+
+        headers = dict(stub_user.headers)
+        headers['If-Match'] = '"{0}"'.format(version)
+
+        # The first editor succeeds, and gets the new version
+        url = url_for('documentview', library=library_id)
+        response = self.client.post(
+            url,
+            data=stub_library.document_view_post_data_json('add'),
+            headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"2"')
+
+        # The second editor is refused, and nothing is added
+        response = self.client.post(
+            url,
+            data=stub_library_2.document_view_post_data_json('add'),
+            headers=headers
+        )
+        self.assertEqual(response.status_code,
+                         PRECONDITION_FAILED_ERROR['number'])
+        self.assertEqual(response.json['error'],
+                         PRECONDITION_FAILED_ERROR['body'])
+
+        # Permission changes also change the version
+        headers['If-Match'] = '"2"'
+        stub_user_2 = UserShop()
+        with MockEmailService(stub_user_2):
+            response = self.client.post(
+                url_for('permissionview', library=library_id),
+                data=stub_user_2.permission_view_post_data_json('read', True),
+                headers=headers
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"3"')
+
+    def test_etag_of_a_library_can_be_used_in_if_match(self):
+        """
+        Test the /libraries/<> and /documents/<> end points, the ETag of a
+        library read with GET is accepted in If-Match by a modification, and
+        is the same as the ETag that the modification sends back
+
+        :return: no return
+        """
+
+        # Stub data
+        stub_user = UserShop()
+        stub_library = LibraryShop(want_bibcode=True)
+        stub_library_2 = LibraryShop()
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        library_id = response.json['id']
+
+        url = url_for('libraryview', library=library_id)
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes()), \
+                MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=stub_user.headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        headers = dict(stub_user.headers)
+        headers['If-Match'] = etag
+        response = self.client.post(
+            url_for('documentview', library=library_id),
+            data=stub_library_2.document_view_post_data_json('add'),
+            headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        new_etag = response.headers['ETag']
+        self.assertNotEqual(new_etag, etag)
+
+        # The ETag read before the modification is no longer current
+        response = self.client.post(
+            url_for('documentview', library=library_id),
+            data=stub_library_2.document_view_post_data_json('remove'),
+            headers=headers
+        )
+        self.assertEqual(response.status_code,
+                         PRECONDITION_FAILED_ERROR['number'])
+
+        with MockSolrBigqueryService(
+                canonical_bibcode=stub_library.get_bibcodes() +
+                stub_library_2.get_bibcodes()), \
+                MockEmailService(stub_user, end_type='uid'):
+            response = self.client.get(url, headers=stub_user.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], new_etag)
+
+    def test_writes_are_not_recorded_without_a_replica(self):
+        """
+        Test the /libraries route
+        Without a read replica, there is nothing to read own changes from, so
+        the time of the change is not recorded
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+
+        response = self.client.post(
+            url_for('userview'),
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(
+            User.query.filter(User.absolute_uid == stub_user.absolute_uid)
+            .one().last_write
+        )
+
+class TestReplicaWebservices(TestCaseDatabase):
+    """
+    Tests that GET requests are routed to the read replica when there is one
+    """
+    # The engines that statements go through are checked
+    isolation = 'schema'
+
+    def create_app(self):
+        """
+        Create the wsgi application, with the database standing in as its own
+        read replica
+
+        :return: application instance
+        """
+        app_ = super(TestReplicaWebservices, self).create_app()
+        app_.config['SQLALCHEMY_BINDS'][
+            app_.config['BIBLIB_REPLICA_BIND_KEY']
+        ] = TestCaseDatabase.postgresql_url
+        return app_
+
+    def setUp(self):
+        """
+        Forget the replica lag measured by other tests
+
+        :return: no return
+        """
+        super(TestReplicaWebservices, self).setUp()
+        REPLICA_STATUS.update(lag=None, checked=0)
+
+    def forget_writes(self):
+        """
+        Move the last changes of the users further back than the lag
+        tolerance, as if the replica had caught up
+
+        :return: no return
+        """
+        db.session.execute(
+            'UPDATE "user" SET last_write = now() - interval \'1 hour\'',
+            mapper=User.__mapper__
+        )
+        db.session.commit()
+
+    def replica_engine(self):
+        """
+        Engine of the read replica
+
+        :return: engine
+        """
+        return db.get_engine(self.app,
+                             bind=self.app.config['BIBLIB_REPLICA_BIND_KEY'])
+
+    def get_engines_used(self, url, user):
+        """
+        Send a GET request and record the engines used for the libraries bind
+        by the view, once it has been decided where it reads from
+
+        :param url: url to request
+        :param user: stub user making the request
+
+        :return: response, and the URLs of the engines used
+        """
+        engines = []
+        decided = []
+        get_bind = RoutingSession.get_bind
+        use_replica = BaseView.helper_use_replica
+        replica = self.replica_engine()
+
+        def recording_get_bind(session, mapper=None, clause=None):
+            engine = get_bind(session, mapper, clause)
+            if decided:
+                engines.append('replica' if engine is replica else 'primary')
+            return engine
+
+        def deciding_use_replica(absolute_uid):
+            decision = use_replica(absolute_uid)
+            decided.append(decision)
+            return decision
+
+        with mock.patch.object(RoutingSession, 'get_bind',
+                               recording_get_bind), \
+                mock.patch.object(BaseView, 'helper_use_replica',
+                                  staticmethod(deciding_use_replica)), \
+                MockEmailService(user, end_type='uid'):
+            response = self.client.get(url, headers=user.headers)
+
+        return response, set(engines)
+
+    def test_reads_go_to_the_replica_except_after_own_writes(self):
+        """
+        Test the /libraries route
+        A user reads from the primary right after changing something, and
+        from the replica otherwise
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        stub_library = LibraryShop()
+
+        url = url_for('userview')
+        response = self.client.post(
+            url,
+            data=stub_library.user_view_post_data_json,
+            headers=stub_user.headers
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # Straight after the change, the user reads from the primary
+        response, engines = self.get_engines_used(url, stub_user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['libraries']), 1)
+        self.assertEqual(engines, {'primary'})
+
+        # The change is recorded in the database, for every worker to see
+        self.assertIsNotNone(
+            User.query.filter(User.absolute_uid == stub_user.absolute_uid)
+            .one().last_write
+        )
+
+        # Once the replica has caught up, reads go to the replica
+        self.forget_writes()
+        response, engines = self.get_engines_used(url, stub_user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['libraries']), 1)
+        self.assertEqual(engines, {'replica'})
+
+    def test_reads_go_to_the_primary_when_the_replica_lags(self):
+        """
+        Test the /libraries route
+        A replica that lags more than the tolerance is not used
+
+        :return: no return
+        """
+        stub_user = UserShop()
+        REPLICA_STATUS.update(
+            lag=self.app.config['BIBLIB_REPLICA_MAX_LAG'] + 1,
+            checked=time.time()
+        )
+
+        response, engines = self.get_engines_used(url_for('userview'),
+                                                  stub_user)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(engines, {'primary'})
+
+    def test_only_plain_selects_go_to_the_replica(self):
+        """
+        Statements other than SELECT, and SELECT ... FOR UPDATE, go to the
+        primary even when the session reads from the replica
+
+        :return: no return
+        """
+        session = db.session()
+        session.use_replica = True
+        replica = self.replica_engine()
+        try:
+            query = Library.query.filter(Library.version > 0)
+            self.assertIs(
+                session.get_bind(Library.__mapper__, query.statement),
+                replica
+            )
+            self.assertIsNot(
+                session.get_bind(Library.__mapper__,
+                                 query.with_for_update().statement),
+                replica
+            )
+            self.assertIsNot(
+                session.get_bind(Library.__mapper__,
+                                 Library.__table__.update()),
+                replica
+            )
+            self.assertIsNot(session.get_bind(Library.__mapper__), replica)
+        finally:
+            session.use_replica = False
+
+    def test_idle_primary_does_not_make_the_replica_lag(self):
+        """
+        The lag of a replica that has replayed all it received is zero, with
+        the replication functions of the version of the server
+
+        :return: no return
+        """
+        version = self.replica_engine().dialect.server_version_info
+        functions = REPLICA_LAG_FUNCTIONS[10 if version >= (10,) else 9]
+        query = REPLICA_LAG_QUERY.format(**functions)
+        self.assertIn(functions['receive'], query)
+
+        with self.app.test_request_context():
+            self.assertEqual(BaseView.helper_replica_lag(), 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -4,8 +4,13 @@ for this module. But are also used in differing modules insidide the same
 project, and so do not belong to anything specific.
 """
 
+import re
+import hashlib
 from collections import Counter
 
+# Bibcodes are 19 characters long, and always start with the year
+BIBCODE_PATTERN = re.compile(r'^\d{4}\S{15}$')
+
 def get_post_data(request, types={}):
     """
     Attempt to coerce POST json data from the request, falling
@@ -83,3 +88,73 @@ def get_item(list_of_dictionaries, key):
     return next(
         item[key]for item in list_of_dictionaries if key in item.keys()
     )
+
+
+def is_valid_bibcode(bibcode):
+    """
+    Checks that the bibcode has the expected shape of a bibcode, i.e., 19
+    characters long, starting with the year and containing no white space.
+    :param bibcode: bibcode to check
+
+    :return: valid (True), not valid (False)
+    """
+    return BIBCODE_PATTERN.match(bibcode) is not None
+
+
+def get_line_batches(stream, batch_size):
+    """
+    Reads a stream line by line and yields lists of the non-empty, stripped
+    lines, so that at most batch_size lines are held in memory at once.
+    :param stream: file-like object to read, e.g., flask.request.stream
+    :param batch_size: maximum number of lines per batch
+
+    :return: generator of lists of lines
+    """
+    batch = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def get_etag(*parts):
+    """
+    Builds a strong entity tag from the values that the representation of a
+    resource depends on.
+    :param parts: values that identify the version of the representation
+
+    :return: unquoted entity tag
+    """
+    return hashlib.sha1(
+        '|'.join([u'{0}'.format(part) for part in parts]).encode('utf-8')
+    ).hexdigest()
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Evaluates the conditional headers of a GET request, If-None-Match and,
+    only if that is not given, If-Modified-Since. Entity tags are compared
+    weakly, as compressed responses have weak entity tags.
+    :param request: flask.request
+    :param etag: current unquoted entity tag of the resource
+    :param last_modified: current modification date of the resource (UTC)
+
+    :return: not modified (True), modified or not conditional (False)
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified:
+        # HTTP dates only have a resolution of seconds
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since
+
+    return False
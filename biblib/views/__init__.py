@@ -6,11 +6,15 @@ get annoying to scroll when reading the source code.
 DEFAULT_LIBRARY_NAME_PREFIX = 'Untitled Library'
 DEFAULT_LIBRARY_DESCRIPTION = 'My ADS library'
 USER_ID_KEYWORD = 'X-Adsws-Uid'
+ADMIN_TOKEN_KEYWORD = 'X-Biblib-Admin-Token'
 
 from base_view import BaseView
 from user_view import UserView
 from library_view import LibraryView
-from document_view import DocumentView
+from document_view import DocumentView, DocumentBulkView
 from permission_view import PermissionView
 from transfer_view import TransferView
-from classic_view import ClassicView, TwoPointOhView
\ No newline at end of file
+from classic_view import ClassicView, TwoPointOhView
+from operations_view import OperationsView
+from contains_view import ContainsView
+from admin_view import SlowQueryView, MetricsView
@@ -0,0 +1,132 @@
+"""
+Admin view
+"""
+
+import os
+import hmac
+from .. import metrics
+from ..utils import err
+from ..views import ADMIN_TOKEN_KEYWORD
+from ..slow_queries import get_slow_queries
+from base_view import BaseView
+from flask import request, current_app
+from flask.ext.discoverer import advertise
+from http_errors import NO_PERMISSION_ERROR
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
+
+def has_admin_token():
+    """
+    Check that the request carries the BIBLIB_ADMIN_TOKEN. There is no access
+    if the token is not configured. The comparison takes the same time
+    whatever part of the token is wrong.
+
+    :return: boolean
+    """
+    token = current_app.config.get('BIBLIB_ADMIN_TOKEN')
+    given = request.headers.get(ADMIN_TOKEN_KEYWORD)
+    if not token or given is None:
+        return False
+    return hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8'))
+
+
+class SlowQueryView(BaseView):
+    """
+    End point listing the slowest statements since the worker started. It is
+    restricted to internal clients, which also need the BIBLIB_ADMIN_TOKEN.
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [100, 60*60*24]
+
+    def get(self):
+        """
+        HTTP GET request that returns the slowest statements recorded by the
+        slow query log of this worker
+
+        :return: list of the statements, slowest first
+
+        Header:
+        -------
+        X-Biblib-Admin-Token: BIBLIB_ADMIN_TOKEN
+
+        Get parameters:
+        ---------------
+        rows: number of statements returned, 10 by default
+
+        Return data:
+        -----------
+        slow_queries: list of dictionaries with
+            bind: name of the bind
+            statement: SQL statement
+            parameters: shape of its bound parameters
+            origin: function it was first seen slow in
+            count: number of slow executions
+            total: total duration of the slow executions in seconds
+            max: longest execution in seconds
+            plan: output of EXPLAIN, on Postgres
+
+        Permissions:
+        -----------
+        The following type of user can read the slow queries
+          - holders of the admin token
+        """
+        if not has_admin_token():
+            logger.error('Slow queries requested without the admin token')
+            return err(NO_PERMISSION_ERROR)
+
+        try:
+            rows = int(request.args.get('rows', 10))
+        except ValueError:
+            rows = 10
+
+        return {'slow_queries': get_slow_queries(rows)}, 200
+
+
+class MetricsView(BaseView):
+    """
+    End point returning the in-process metrics of the worker that serves the
+    request. It is restricted to internal clients, which also need the
+    BIBLIB_ADMIN_TOKEN.
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [1000, 60*60*24]
+
+    def get(self):
+        """
+        HTTP GET request that returns the counters, gauges and timings
+        recorded by this worker since it started
+
+        :return: the metrics of the worker
+
+        Header:
+        -------
+        X-Biblib-Admin-Token: BIBLIB_ADMIN_TOKEN
+
+        Return data:
+        -----------
+        pid: process id of the worker
+        counters: name to count
+        gauges: name to current value
+        timings: name to dictionary with
+            count: number of values observed
+            total: sum of the values
+            max: largest value
+
+        Permissions:
+        -----------
+        The following type of user can read the metrics
+          - holders of the admin token
+        """
+        if not has_admin_token():
+            logger.error('Metrics requested without the admin token')
+            return err(NO_PERMISSION_ERROR)
+
+        snapshot = metrics.snapshot()
+        snapshot['pid'] = os.getpid()
+        return snapshot, 200
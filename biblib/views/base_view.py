@@ -1,18 +1,123 @@
 """
 Base view
 """
+import time
 import uuid
 import base64
 
 from ..views import DEFAULT_LIBRARY_NAME_PREFIX, DEFAULT_LIBRARY_DESCRIPTION, \
     USER_ID_KEYWORD
-from flask import request, current_app
+from flask import request, current_app, Response, g, has_request_context
 from flask.ext.restful import Resource
-from ..models import db, User, Library, Permissions
+from functools import wraps
+from werkzeug.http import http_date, quote_etag
+from ..models import db, User, Library, Permissions, RoutingSession
 from ..client import client
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import event, func
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
-from ..biblib_exceptions import BackendIntegrityError, PermissionDeniedError
+from ..biblib_exceptions import BackendIntegrityError, PermissionDeniedError, \
+    PreconditionFailedError
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
+# Slugs depend on nothing but the library id, so both directions of the
+# conversion are cached instead of being recomputed for every library listed
+SLUG_CACHE = {}
+UUID_CACHE = {}
+
+
+def cache_conversion(cache, key, value):
+    """
+    Store a conversion, emptying the cache first if it has grown beyond the
+    configured size
+
+    :param cache: cache to store the conversion in
+    :param key: input of the conversion
+    :param value: output of the conversion
+
+    :return: the output of the conversion
+    """
+    if len(cache) >= current_app.config.get('BIBLIB_SLUG_CACHE_SIZE', 10000):
+        cache.clear()
+    cache[key] = value
+    return value
+
+# Last measured lag of the read replica, and when it was measured
+REPLICA_STATUS = {'lag': None, 'checked': 0}
+
+# Lag of the replica: none if it has replayed everything it received from the
+# primary, otherwise the age of the last transaction replayed. The replication
+# functions were renamed in PostgreSQL 10.
+REPLICA_LAG_QUERY = '''
+    SELECT CASE WHEN {receive}() = {replay}() THEN 0
+                ELSE EXTRACT(EPOCH FROM
+                             now() - pg_last_xact_replay_timestamp())
+           END
+'''
+REPLICA_LAG_FUNCTIONS = {
+    9: dict(receive='pg_last_xlog_receive_location',
+            replay='pg_last_xlog_replay_location'),
+    10: dict(receive='pg_last_wal_receive_lsn',
+             replay='pg_last_wal_replay_lsn')
+}
+
+
+def read_from_replica(method):
+    """
+    Decorator for view methods: GET requests read from the read replica, when
+    there is one and BaseView.helper_use_replica allows it
+
+    :param method: view method to decorate
+
+    :return: decorated view method
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or not BaseView.helper_use_replica(
+                request.headers.get(USER_ID_KEYWORD)):
+            return method(*args, **kwargs)
+
+        db.session().use_replica = True
+        try:
+            return method(*args, **kwargs)
+        finally:
+            db.session().use_replica = False
+
+    return wrapper
+
+
+def record_write(session):
+    """
+    Before commit hook: remember when a user last changed something, so that
+    they read their own changes from the primary until the replica has caught
+    up, whichever worker serves them. This is only needed when there is a
+    replica, and is written in the transaction of the change itself, once per
+    request.
+
+    :param session: session being committed
+    """
+    if not has_request_context() or \
+            request.method in ('GET', 'HEAD', 'OPTIONS') or \
+            USER_ID_KEYWORD not in request.headers or \
+            getattr(g, 'write_recorded', False) or \
+            not BaseView.helper_has_replica():
+        return
+    g.write_recorded = True
+    BaseView.helper_record_write(session, request.headers[USER_ID_KEYWORD])
+
+
+def init_write_records(app):
+    """
+    Register the hook recording the changes of the users
+
+    :param app: flask.Flask application instance
+    :return: None
+    """
+    if not event.contains(RoutingSession, 'before_commit', record_write):
+        event.listen(RoutingSession, 'before_commit', record_write)
+
 
 class BaseView(Resource):
     """
@@ -33,11 +138,14 @@ class BaseView(Resource):
 
         :return: library_slug: base64 URL safe slug
         """
+        try:
+            return SLUG_CACHE[library_uuid]
+        except KeyError:
+            pass
+
         library_slug = base64.urlsafe_b64encode(library_uuid.bytes)
         library_slug = library_slug.rstrip('=\n').replace('/', '_')
-        current_app.logger.info('Converted uuid: {0} to slug: {1}'
-                                .format(library_uuid, library_slug))
-        return library_slug
+        return cache_conversion(SLUG_CACHE, library_uuid, library_slug)
 
     @staticmethod
     def helper_slug_to_uuid(library_slug):
@@ -59,13 +167,260 @@ class BaseView(Resource):
 
         :return: library_uuid: unique identifier for the library
         """
+        try:
+            return UUID_CACHE[library_slug]
+        except KeyError:
+            pass
 
         library_uuid = (library_slug + '==').replace('_', '/')
         library_uuid = library_uuid.encode('ascii')
         library_uuid = uuid.UUID(bytes=base64.urlsafe_b64decode(library_uuid))
-        current_app.logger.info('Converted slug: {0} to uuid: {1}'
-                                .format(library_slug, library_uuid))
-        return str(library_uuid)
+        return cache_conversion(UUID_CACHE, library_slug, str(library_uuid))
+
+    @staticmethod
+    def helper_replica_lag():
+        """
+        Number of seconds the read replica is behind the primary. This is
+        measured at most once per BIBLIB_REPLICA_LAG_CHECK_INTERVAL seconds.
+        A replica that has replayed all it received has no lag, even if the
+        primary has been idle since its last transaction.
+
+        :return: lag in seconds, None if the replica cannot be reached
+        """
+        now = time.time()
+        interval = current_app.config.get('BIBLIB_REPLICA_LAG_CHECK_INTERVAL',
+                                          5)
+        if now - REPLICA_STATUS['checked'] < interval:
+            return REPLICA_STATUS['lag']
+
+        try:
+            engine = db.get_engine(
+                current_app,
+                bind=current_app.config['BIBLIB_REPLICA_BIND_KEY']
+            )
+            with engine.connect() as connection:
+                version = connection.dialect.server_version_info
+                functions = REPLICA_LAG_FUNCTIONS[
+                    10 if version >= (10,) else 9
+                ]
+                # NULL when the database is not replaying from a primary
+                lag = connection.execute(
+                    REPLICA_LAG_QUERY.format(**functions)
+                ).scalar()
+            lag = float(lag or 0)
+        except SQLAlchemyError as error:
+            logger.warning('Read replica unavailable: {0}', error)
+            lag = None
+
+        REPLICA_STATUS.update(lag=lag, checked=now)
+        return lag
+
+    @staticmethod
+    def helper_has_replica():
+        """
+        Check if a read replica is configured
+
+        :return: boolean
+        """
+        config = current_app.config
+        return config.get('BIBLIB_REPLICA_BIND_KEY') in \
+            (config.get('SQLALCHEMY_BINDS') or {})
+
+    @staticmethod
+    def helper_use_replica(absolute_uid):
+        """
+        Decide if the request of a user can read from the read replica. This is
+        not the case if there is no replica, if it lags too far behind, or if
+        the user changed something too recently to see it on the replica.
+
+        :param absolute_uid: API UID of the user, None if not known
+
+        :return: boolean
+        """
+        if not BaseView.helper_has_replica():
+            return False
+
+        max_lag = current_app.config.get('BIBLIB_REPLICA_MAX_LAG', 5)
+        if absolute_uid is not None:
+            # Read from the primary, on which the change is always visible
+            since_write = db.session.query(
+                func.extract('epoch', func.now() - User.last_write)
+            ).filter(User.absolute_uid == absolute_uid).scalar()
+            if since_write is not None and since_write < max_lag:
+                return False
+
+        lag = BaseView.helper_replica_lag()
+        return lag is not None and lag <= max_lag
+
+    @staticmethod
+    def helper_record_write(session, absolute_uid):
+        """
+        Remember that a user just changed something. This is stored with the
+        user in the database, so that it is seen by every worker.
+
+        :param session: session of the change
+        :param absolute_uid: API UID of the user
+        """
+        session.query(User)\
+            .filter(User.absolute_uid == absolute_uid)\
+            .update({User.last_write: func.now()},
+                    synchronize_session=False)
+
+    @staticmethod
+    def helper_use_primary():
+        """
+        Send the rest of the request to the primary, for when a read request
+        has to write, or has to see the latest data
+
+        :return: True if the request was reading from the replica
+        """
+        session = db.session()
+        use_replica = session.use_replica
+        session.use_replica = False
+        return use_replica
+
+    @staticmethod
+    def helper_cache_headers(etag, last_modified, public=False):
+        """
+        Headers that let clients, and shared caches for public content,
+        revalidate a response with a conditional GET
+
+        :param etag: unquoted entity tag of the response
+        :param last_modified: modification date of the content (UTC)
+        :param public: if the content can be stored by shared caches
+
+        :return: dictionary of headers
+        """
+        headers = {
+            'ETag': quote_etag(etag),
+            'Last-Modified': http_date(last_modified),
+            'Vary': USER_ID_KEYWORD
+        }
+
+        if public:
+            headers['Cache-Control'] = 'public, max-age={0:d}'.format(
+                current_app.config.get('BIBLIB_PUBLIC_CACHE_MAX_AGE', 60)
+            )
+        else:
+            headers['Cache-Control'] = 'private, no-cache'
+
+        return headers
+
+    @staticmethod
+    def helper_not_modified(headers):
+        """
+        Empty response for a conditional GET of content that has not changed
+
+        :param headers: cache headers of the content
+
+        :return: flask.Response with status 304
+        """
+        return Response(status=304, headers=headers)
+
+    @staticmethod
+    def helper_get_if_match():
+        """
+        Helper function: get the versions of the library the user expects to
+        be modifying, from the If-Match header. Weak entity tags are accepted,
+        as the version is the same whatever the encoding of the response that
+        gave it.
+
+        :return: list of versions, or None if any version can be modified
+        """
+        if not request.if_match or request.if_match.star_tag:
+            return None
+
+        return [int(etag) for etag in request.if_match.as_set(include_weak=True)
+                if etag.isdigit()]
+
+    @staticmethod
+    def helper_bump_library_version(library_id, if_match=None):
+        """
+        Increments the version of a library within the current transaction.
+        The library row stays locked until the transaction ends, so concurrent
+        modifications of the same library are carried out one after another.
+
+        :param library_id: the unique ID of the library
+        :param if_match: list of versions the library must currently be at, or
+                         None for any version
+
+        :return: the new version of the library
+        """
+        table = Library.__table__
+        statement = table.update()\
+            .where(table.c.id == library_id)\
+            .values(version=table.c.version + 1)\
+            .returning(table.c.version)
+
+        if if_match is not None:
+            if not if_match:
+                raise PreconditionFailedError('No valid version in If-Match')
+            statement = statement.where(table.c.version.in_(if_match))
+
+        version = db.session.execute(statement,
+                                     mapper=Library.__mapper__).scalar()
+
+        if version is None and if_match is not None:
+            logger.error('Library: {0} is not at version: {1}', library_id,
+                         if_match)
+            raise PreconditionFailedError('Library version does not match')
+        elif version is None:
+            raise NoResultFound('Library does not exist: {0}'
+                                .format(library_id))
+
+        return version
+
+    @staticmethod
+    def helper_get_library_for_update(library_id):
+        """
+        Loads a library with SELECT ... FOR UPDATE, so that no one else can
+        modify it until the current transaction ends. The library is refreshed
+        even if it is already in the session, so its content is never stale
+        when it is modified.
+
+        :param library_id: the unique ID of the library
+
+        :return: SQLAlchemy Library instance
+        """
+        return Library.query\
+            .filter(Library.id == library_id)\
+            .with_for_update()\
+            .populate_existing()\
+            .one()
+
+    @staticmethod
+    def helper_version_headers(library_id):
+        """
+        Headers that give the current version of a library, to be sent back in
+        If-Match with the next modification
+
+        :param library_id: the unique ID of the library
+
+        :return: dictionary of headers
+        """
+        version = db.session.query(Library.version)\
+            .filter(Library.id == library_id)\
+            .scalar()
+
+        return {'ETag': quote_etag('{0}'.format(version))}
+
+    @staticmethod
+    def helper_main_permission(permission):
+        """
+        The highest permission a user has for a library
+
+        :param permission: Permissions instance, or None if there are none
+
+        :return: 'owner', 'admin', 'write', 'read', or 'none'
+        """
+        if permission is None:
+            return 'none'
+
+        for access_type in ['owner', 'admin', 'write', 'read']:
+            if getattr(permission, access_type):
+                return access_type
+
+        return 'none'
 
     @staticmethod
     def helper_get_user_id():
@@ -81,7 +436,7 @@ class BaseView(Resource):
                 user = int(user)
             return user
         except KeyError:
-            current_app.logger.error('No username passed')
+            logger.error('No username passed')
             raise
 
     @staticmethod
@@ -98,15 +453,13 @@ class BaseView(Resource):
             db.session.add(user)
             db.session.commit()
 
-            current_app.logger.info('Successfully created user: {0} [API] as '
-                                    '{1} [Microservice]'
-                                    .format(absolute_uid, user.id))
+            logger.info('Successfully created user: {0} [API] as {1} '
+                        '[Microservice]', absolute_uid, user.id)
             return user
 
         except IntegrityError as error:
-            current_app.logger.error('IntegrityError. User: {0:d} was not'
-                                     'added. Full traceback: {1}'
-                                     .format(absolute_uid, error))
+            logger.error('IntegrityError. User: {0:d} was not added. Full '
+                         'traceback: {1}', absolute_uid, error)
             raise
 
     @staticmethod
@@ -121,12 +474,12 @@ class BaseView(Resource):
         user_count = User.query.filter(User.absolute_uid == absolute_uid).all()
         user_count = len(user_count)
         if user_count == 1:
-            current_app.logger.info('User exists in database: {0} [API]'
-                                    .format(absolute_uid))
+            logger.info('User exists in database: {0} [API]', absolute_uid,
+                        sample=True)
             return True
         elif user_count == 0:
-            current_app.logger.warning('User does not exist in database: {0} '
-                                       '[API]'.format(absolute_uid))
+            logger.warning('User does not exist in database: {0} [API]',
+                           absolute_uid)
             return False
 
     @staticmethod
@@ -140,12 +493,19 @@ class BaseView(Resource):
         :return: BibLib service ID
         """
 
-        if not BaseView.helper_user_exists(absolute_uid=absolute_uid):
+        user_exists = BaseView.helper_user_exists(absolute_uid=absolute_uid)
+        if not user_exists and BaseView.helper_use_primary():
+            # The replica may not know of a user that was just created
+            user_exists = BaseView.helper_user_exists(
+                absolute_uid=absolute_uid
+            )
+
+        if not user_exists:
             user = BaseView.helper_create_user(absolute_uid=absolute_uid)
         else:
             user = User.query.filter(User.absolute_uid == absolute_uid).one()
-        current_app.logger.info('User found: {0} -> {1}'
-                                .format(absolute_uid, user.id))
+        logger.info('User found: {0} -> {1}', absolute_uid, user.id,
+                    sample=True)
 
         return user.id
 
@@ -163,14 +523,12 @@ class BaseView(Resource):
                 api=current_app.config['BIBLIB_USER_EMAIL_ADSWS_API_URL'],
                 email=permission_data['email']
             )
-            current_app.logger.info('Obtaining UID of user: {0}'
-                                    .format(permission_data['email']))
+            logger.info('Obtaining UID of user: {0}', permission_data['email'])
             response = client().get(
                 service
             )
         except KeyError as error:
-            current_app.logger.error('No user email provided. [{0}]'
-                                     .format(error))
+            logger.error('No user email provided. [{0}]', error)
             raise
 
         if response.status_code == 200:
@@ -201,10 +559,9 @@ class BaseView(Resource):
             return getattr(permissions, access_type)
 
         except NoResultFound as error:
-            current_app.logger.error('No permissions for '
-                                     'user: {0}, library: {1}, permission: {2}'
-                                     ' [{3}]'.format(service_uid, library_id,
-                                                     access_type, error))
+            logger.error('No permissions for user: {0}, library: {1}, '
+                         'permission: {2} [{3}]', service_uid, library_id,
+                         access_type, error)
             return False
 
     @staticmethod
@@ -238,9 +595,9 @@ class BaseView(Resource):
         _description = library_data.get('description') or \
             DEFAULT_LIBRARY_DESCRIPTION
 
-        current_app.logger.info('Creating library for user_service: {0:d}, '
-                                'with properties: {1}'
-                                .format(service_uid, library_data))
+        logger.info('Creating library for user_service: {0:d}, with name: '
+                    '"{1}", description: "{2}"', service_uid, _name,
+                    _description)
 
         # We want to ensure that the users have unique library names. However,
         # it should be possible that they have access to other libraries from
@@ -252,9 +609,8 @@ class BaseView(Resource):
 
         matches = [name for name in library_names if name == _name]
         if matches:
-            current_app.logger.error('Name supplied for the library already '
-                                     'exists: "{0}" ["{1}"]'.format(_name,
-                                                                    matches))
+            logger.error('Name supplied for the library already exists: '
+                         '"{0}" ["{1}"]', _name, matches)
             raise BackendIntegrityError('Library name already exists.')
 
         if _name == DEFAULT_LIBRARY_NAME_PREFIX:
@@ -11,6 +11,9 @@ from flask.ext.discoverer import advertise
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from http_errors import MISSING_USERNAME_ERROR
+from ..log import get_logger
+
+logger = get_logger(__name__)
 
 
 class HarbourView(BaseView):
@@ -59,20 +62,18 @@ class HarbourView(BaseView):
             # multiple are returned, there is some problem
             if len(lib) == 0:
                 raise NoResultFound
-                current_app.logger.info(
-                    'User does not have a library with this name'
-                )
+                logger.info('User does not have a library with this name')
             elif len(lib) > 1:
-                current_app.logger.warning(
-                    'More than 1 library has the same name,'
-                    ' this should not happen: {}'.format(lib)
-                )
+                logger.warning('More than 1 library has the same name, this '
+                               'should not happen: {0}', lib)
                 raise IntegrityError
 
             # Get the single record returned, as names are considered unique in
             # the workflow of creating libraries
             lib = lib[0]
 
+            BaseView.helper_bump_library_version(library_id=lib.id)
+            lib = BaseView.helper_get_library_for_update(lib.id)
             bibcode_before = len(lib.get_bibcodes())
             lib.add_bibcodes(library['documents'])
             bibcode_added = len(lib.get_bibcodes()) - bibcode_before
@@ -80,8 +81,7 @@ class HarbourView(BaseView):
             db.session.add(lib)
 
         except NoResultFound:
-            current_app.logger.info('Creating library from scratch: {}'
-                                    .format(library))
+            logger.info('Creating library from scratch: {0}', library)
             permission = Permissions(owner=True)
             lib = Library(
                 name=library['name'][0:50],
@@ -143,8 +143,8 @@ class HarbourView(BaseView):
             external_service=current_app.config[self.service_url],
             user_id=user
         )
-        current_app.logger.info('Collecting libraries for user {} from {}'
-                                .format(user, url))
+        logger.info('Collecting libraries for user {0} from {1}',
+                    user, url)
         response = client().get(url)
 
         if response.status_code != 200:
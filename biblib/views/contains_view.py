@@ -0,0 +1,134 @@
+"""
+Contains view
+"""
+
+from ..utils import err, get_post_data, uniquify
+from ..models import db, Library
+from base_view import BaseView
+from flask import request, current_app
+from flask.ext.discoverer import advertise
+from sqlalchemy import text
+from http_errors import MISSING_USERNAME_ERROR, WRONG_TYPE_ERROR, \
+    TOO_MANY_BIBCODES_ERROR
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
+
+class ContainsView(BaseView):
+    """
+    End point to find which of the user's libraries contain a set of bibcodes
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['user']
+    rate_limit = [1000, 60*60*24]
+
+    # For each library the user has any permission for, that contains at least
+    # one of the bibcodes, return the bibcodes it contains. The key exists
+    # operator, ?|, makes use of the GIN index on the library bibcodes.
+    contains_query = text(
+        'SELECT library.id, '
+        '       ARRAY(SELECT requested.bibcode '
+        '             FROM unnest(CAST(:bibcodes AS TEXT[])) '
+        '                  AS requested(bibcode) '
+        '             WHERE library.bibcode ? requested.bibcode) '
+        'FROM library '
+        'JOIN permissions ON permissions.library_id = library.id '
+        'WHERE permissions.user_id = :service_uid '
+        'AND (permissions.read OR permissions.write '
+        '     OR permissions.admin OR permissions.owner) '
+        'AND library.bibcode ?| CAST(:bibcodes AS TEXT[])'
+    )
+
+    @classmethod
+    def get_libraries_containing(cls, service_uid, bibcodes):
+        """
+        Finds the libraries of the user that contain each of the bibcodes, in
+        a single query
+
+        :param service_uid: the user ID within this microservice
+        :param bibcodes: list of bibcodes
+
+        :return: dictionary of bibcode to a list of library IDs
+        """
+        libraries = {bibcode: [] for bibcode in bibcodes}
+        if not bibcodes:
+            return libraries
+
+        result = db.session.execute(
+            cls.contains_query,
+            params=dict(service_uid=service_uid, bibcodes=list(bibcodes)),
+            mapper=Library.__mapper__
+        )
+
+        for library_id, contained in result:
+            # The raw query does not pass through the GUID type of the model
+            library_slug = cls.helper_uuid_to_slug(library_id)
+            for bibcode in contained:
+                libraries[bibcode].append(library_slug)
+
+        return libraries
+
+    def post(self):
+        """
+        HTTP POST request that returns the libraries of the user that contain
+        each of the bibcodes given
+
+        :return: dictionary of bibcode to the IDs of the libraries
+
+        Header:
+        -------
+        Must contain the API forwarded user ID of the user accessing the end
+        point
+
+        Post body:
+        ----------
+        KEYWORD, VALUE
+        bibcode:  <list>    List of bibcodes to look up
+
+        Return data:
+        -----------
+        bibcodes: <dict>    For each bibcode requested, the list of IDs of the
+                            user's libraries that contain it
+
+        Permissions:
+        -----------
+        Only the libraries the user has permissions for are returned:
+          - owner
+          - admin
+          - write
+          - read
+        """
+        # Get the user requesting this from the header
+        try:
+            user = self.helper_get_user_id()
+        except KeyError:
+            return err(MISSING_USERNAME_ERROR)
+
+        service_uid = \
+            self.helper_absolute_uid_to_service_uid(absolute_uid=user)
+
+        try:
+            data = get_post_data(
+                request,
+                types=dict(bibcode=list)
+            )
+        except TypeError as error:
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
+            return err(WRONG_TYPE_ERROR)
+
+        bibcodes = uniquify(data.get('bibcode', []))
+        max_bibcodes = current_app.config.get('BIBLIB_CONTAINS_MAX_BIBCODES',
+                                              5000)
+        if len(bibcodes) > max_bibcodes:
+            logger.error('User: {0} requested {1} bibcodes, more than the '
+                         'limit of {2}', service_uid, len(bibcodes),
+                         max_bibcodes)
+            return err(TOO_MANY_BIBCODES_ERROR)
+
+        libraries = self.get_libraries_containing(service_uid=service_uid,
+                                                  bibcodes=bibcodes)
+
+        return {'bibcodes': libraries}, 200
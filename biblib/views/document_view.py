@@ -2,15 +2,22 @@
 Document view
 """
 
-from ..utils import err, get_post_data
+from ..utils import err, get_post_data, get_line_batches, is_valid_bibcode
 from ..models import db, Library, Permissions
 from base_view import BaseView
 from flask import request, current_app
 from flask.ext.discoverer import advertise
+from sqlalchemy import func, cast, literal
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm.exc import NoResultFound
 from http_errors import MISSING_USERNAME_ERROR, DUPLICATE_LIBRARY_NAME_ERROR, \
-    WRONG_TYPE_ERROR, NO_PERMISSION_ERROR, MISSING_LIBRARY_ERROR
-from ..biblib_exceptions import PermissionDeniedError
+    WRONG_TYPE_ERROR, NO_PERMISSION_ERROR, MISSING_LIBRARY_ERROR, \
+    PRECONDITION_FAILED_ERROR, TOO_MANY_BIBCODES_ERROR
+from ..biblib_exceptions import PermissionDeniedError, \
+    PreconditionFailedError, TooManyBibcodesError
+from ..log import get_logger, Summary
+
+logger = get_logger(__name__)
 
 
 class DocumentView(BaseView):
@@ -26,73 +33,83 @@ class DocumentView(BaseView):
     rate_limit = [1000, 60*60*24]
 
     @classmethod
-    def add_document_to_library(cls, library_id, document_data):
+    def add_document_to_library(cls, library_id, document_data,
+                                if_match=None):
         """
         Adds a document to a user's library
         :param library_id: the library id to update
         :param document_data: the meta data of the document
+        :param if_match: versions the library must be at, None for any
 
         :return: number_added: number of documents successfully added
         """
-        current_app.logger.info('Adding a document: {0} to library_uuid: {1}'
-                                .format(document_data, library_id))
-        # Find the specified library
-        library = Library.query.filter(Library.id == library_id).one()
+        logger.info('Adding {0} documents to library_uuid: {1}',
+                    len(document_data['bibcode']), library_id)
+        cls.helper_bump_library_version(library_id=library_id,
+                                        if_match=if_match)
 
-        start_length = len(library.bibcode)
+        # Find the specified library, locked so concurrent additions cannot
+        # overwrite each other
+        library = cls.helper_get_library_for_update(library_id)
 
-        library.add_bibcodes(document_data['bibcode'])
+        number_added = library.add_bibcodes(document_data['bibcode'])
 
         db.session.add(library)
         db.session.commit()
 
-        current_app.logger.info('Added: {0} is now {1}'.format(
-            document_data['bibcode'],
-            library.bibcode)
-        )
+        logger.info('Added {0} documents, library_uuid: {1} now has {2} '
+                    'documents', number_added, library_id,
+                    len(library.bibcode))
 
-        end_length = len(library.bibcode)
-
-        return end_length - start_length
+        return number_added
 
     @classmethod
-    def remove_documents_from_library(cls, library_id, document_data):
+    def remove_documents_from_library(cls, library_id, document_data,
+                                      if_match=None):
         """
         Remove a given document from a specific library
 
         :param library_id: the unique ID of the library
         :param document_data: the meta data of the document
+        :param if_match: versions the library must be at, None for any
 
         :return: number_removed: number of documents successfully removed
         """
-        current_app.logger.info('Removing a document: {0} from library_uuid: '
-                                '{1}'.format(document_data, library_id))
-        library = Library.query.filter(Library.id == library_id).one()
+        logger.info('Removing documents: {0} from library_uuid: {1}',
+                    Summary(document_data['bibcode']), library_id)
+        cls.helper_bump_library_version(library_id=library_id,
+                                        if_match=if_match)
+
+        library = cls.helper_get_library_for_update(library_id)
         start_length = len(library.bibcode)
 
         library.remove_bibcodes(document_data['bibcode'])
 
         db.session.add(library)
         db.session.commit()
-        current_app.logger.info('Removed document successfully: {0}'
-                                .format(library.bibcode))
+        logger.info('Removed documents successfully, library_uuid: {0} now '
+                    'has {1}', library_id, Summary(library.bibcode))
         end_length = len(library.bibcode)
 
         return start_length - end_length
 
-    @staticmethod
-    def update_library(library_id, library_data):
+    @classmethod
+    def update_library(cls, library_id, library_data, if_match=None):
         """
         Update the meta data of the library
         :param library_id: the unique ID of the library
         :param library_data: dictionary containing the updateable values
+        :param if_match: versions the library must be at, None for any
 
         :return: values updated
         """
         updateable = ['name', 'description', 'public']
         updated = {}
 
-        library = Library.query.filter(Library.id == library_id).one()
+        cls.helper_bump_library_version(library_id=library_id,
+                                        if_match=if_match)
+
+        library = cls.helper_get_library_for_update(library_id)
 
         for key in library_data:
             if key not in updateable:
@@ -105,14 +122,18 @@ class DocumentView(BaseView):
 
         return updated
 
-    @staticmethod
-    def delete_library(library_id):
+    @classmethod
+    def delete_library(cls, library_id, if_match=None):
         """
         Delete the entire library from the database
         :param library_id: the unique ID of the library
+        :param if_match: versions the library must be at, None for any
 
         :return: no return
         """
+        if if_match is not None:
+            cls.helper_bump_library_version(library_id=library_id,
+                                            if_match=if_match)
 
         library = Library.query.filter(Library.id == library_id).one()
         db.session.delete(library)
@@ -190,8 +211,8 @@ class DocumentView(BaseView):
                                       Permissions.owner == True).all()]
 
         if library_name in library_names:
-            current_app.logger.error('Name supplied for the library already '
-                                     'exists: "{0}"'.format(library_name))
+            logger.error('Name supplied for the library already exists: "{0}"',
+                         library_name)
 
             return True
         else:
@@ -209,6 +230,10 @@ class DocumentView(BaseView):
         Must contain the API forwarded user ID of the user accessing the end
         point
 
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
         Post body:
         ----------
         KEYWORD, VALUE
@@ -252,36 +277,44 @@ class DocumentView(BaseView):
                 types=dict(bibcode=list, action=unicode)
             )
         except TypeError as error:
-            current_app.logger.error('Wrong type passed for POST: {0} [{1}]'
-                                     .format(request.data, error))
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
             return err(WRONG_TYPE_ERROR)
 
         if data['action'] == 'add':
-            current_app.logger.info('User requested to add a document')
-            number_added = self.add_document_to_library(
-                library_id=library,
-                document_data=data
-            )
-            current_app.logger.info(
-                'Successfully added {0} documents to {1} by {2}'
-                .format(number_added, library, user_editing_uid)
-            )
-            return {'number_added': number_added}, 200
+            logger.info('User requested to add a document')
+            try:
+                number_added = self.add_document_to_library(
+                    library_id=library,
+                    document_data=data,
+                    if_match=self.helper_get_if_match()
+                )
+            except PreconditionFailedError:
+                db.session.rollback()
+                return err(PRECONDITION_FAILED_ERROR)
+            logger.info('Successfully added {0} documents to {1} by {2}',
+                        number_added, library, user_editing_uid)
+            return {'number_added': number_added}, 200, \
+                self.helper_version_headers(library)
 
         elif data['action'] == 'remove':
-            current_app.logger.info('User requested to remove a document')
-            number_removed = self.remove_documents_from_library(
-                library_id=library,
-                document_data=data
-            )
-            current_app.logger.info(
-                'Successfully removed {0} documents to {1} by {2}'
-                .format(number_removed, library, user_editing_uid)
+            logger.info('User requested to remove a document')
+            try:
+                number_removed = self.remove_documents_from_library(
+                    library_id=library,
+                    document_data=data,
+                    if_match=self.helper_get_if_match()
                 )
-            return {'number_removed': number_removed}, 200
+            except PreconditionFailedError:
+                db.session.rollback()
+                return err(PRECONDITION_FAILED_ERROR)
+            logger.info('Successfully removed {0} documents to {1} by {2}',
+                        number_removed, library, user_editing_uid)
+            return {'number_removed': number_removed}, 200, \
+                self.helper_version_headers(library)
 
         else:
-            current_app.logger.info('User requested a non-standard action')
+            logger.info('User requested a non-standard action')
             return {}, 400
 
     def put(self, library):
@@ -296,6 +329,10 @@ class DocumentView(BaseView):
         Must contain the API forwarded user ID of the user accessing the end
         point
 
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
         Post-body:
         ---------
         name: name of the library
@@ -347,15 +384,14 @@ class DocumentView(BaseView):
                 )
             )
         except TypeError as error:
-            current_app.logger.error('Wrong type passed for POST: {0} [{1}]'
-                                     .format(request.data, error))
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
             return err(WRONG_TYPE_ERROR)
 
         # Remove content that is empty
         for key in library_data.keys():
             if library_data[key] == ''.strip(' '):
-                current_app.logger.warning('Removing key: {0} as its empty.'
-                                           .format(key))
+                logger.warning('Removing key: {0} as its empty.', key)
                 library_data.pop(key)
 
         # Check for duplicate namaes
@@ -365,10 +401,15 @@ class DocumentView(BaseView):
 
                 return err(DUPLICATE_LIBRARY_NAME_ERROR)
 
-        response = self.update_library(library_id=library,
-                                       library_data=library_data)
+        try:
+            response = self.update_library(library_id=library,
+                                           library_data=library_data,
+                                           if_match=self.helper_get_if_match())
+        except PreconditionFailedError:
+            db.session.rollback()
+            return err(PRECONDITION_FAILED_ERROR)
 
-        return response, 200
+        return response, 200, self.helper_version_headers(library)
 
     def delete(self, library):
         """
@@ -382,6 +423,10 @@ class DocumentView(BaseView):
         Must contain the API forwarded user ID of the user accessing the end
         point
 
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
         Post-body:
         ----------
         No post content accepted.
@@ -413,29 +458,224 @@ class DocumentView(BaseView):
             self.helper_absolute_uid_to_service_uid(absolute_uid=user)
 
         try:
-            current_app.logger.info('user_API: {0:d} '
-                                    'requesting to delete library: {1}'
-                                    .format(user_deleting_uid, library))
+            logger.info('user_API: {0:d} requesting to delete library: {1}',
+                        user_deleting_uid, library)
 
             if self.delete_access(service_uid=user_deleting_uid,
                                   library_id=library):
-                self.delete_library(library_id=library)
-                current_app.logger.info('User: {0} deleted library: {1}.'
-                                        .format(user_deleting_uid,
-                                                library))
+                self.delete_library(library_id=library,
+                                    if_match=self.helper_get_if_match())
+                logger.info('User: {0} deleted library: {1}.',
+                            user_deleting_uid, library)
             else:
-                current_app.logger.error('User: {0} has incorrect permissions '
-                                         'to delete: {1}.'
-                                         .format(user_deleting_uid,
-                                                 library))
+                logger.error('User: {0} has incorrect permissions to delete: '
+                             '{1}.', user_deleting_uid, library)
                 raise PermissionDeniedError('Incorrect permissions')
 
         except NoResultFound as error:
-            current_app.logger.info('Failed to delete: {0}'.format(error))
+            logger.info('Failed to delete: {0}', error)
             return err(MISSING_LIBRARY_ERROR)
 
         except PermissionDeniedError as error:
-            current_app.logger.info('Failed to delete: {0}'.format(error))
+            logger.info('Failed to delete: {0}', error)
+            return err(NO_PERMISSION_ERROR)
+
+        except PreconditionFailedError as error:
+            db.session.rollback()
+            logger.info('Failed to delete: {0}', error)
+            return err(PRECONDITION_FAILED_ERROR)
+
+        return {}, 200
+
+class DocumentBulkView(DocumentView):
+    """
+    End point to add a very large number of documents to a library. The
+    bibcodes are streamed from the request body, one per line, rather than
+    being parsed as a single JSON list.
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['user']
+    rate_limit = [1000, 60*60*24]
+
+    @classmethod
+    def read_bulk_bibcodes(cls, stream, batch_size, max_bibcodes=None):
+        """
+        Reads and validates the bibcodes of a stream, before the library is
+        locked, so that a slow client does not hold the lock of the library.
+
+        :param stream: file-like object with one bibcode per line
+        :param batch_size: number of lines to read at once
+        :param max_bibcodes: maximum number of distinct bibcodes, None for any
+
+        :return: set of the distinct valid bibcodes, and dictionary of the
+                 counts of the duplicate and invalid lines
+        """
+        bibcodes = set()
+        counts = dict(number_duplicate=0, number_invalid=0)
+
+        for batch in get_line_batches(stream, batch_size):
+            for line in batch:
+                try:
+                    bibcode = line.decode('utf-8')
+                except UnicodeDecodeError:
+                    bibcode = None
+
+                if bibcode is None or not is_valid_bibcode(bibcode):
+                    counts['number_invalid'] += 1
+                elif bibcode in bibcodes:
+                    counts['number_duplicate'] += 1
+                else:
+                    bibcodes.add(bibcode)
+
+            if max_bibcodes is not None and len(bibcodes) > max_bibcodes:
+                raise TooManyBibcodesError(
+                    'More than {0} bibcodes'.format(max_bibcodes)
+                )
+
+        return bibcodes, counts
+
+    @staticmethod
+    def merge_bibcodes(library_id, bibcodes):
+        """
+        Adds bibcodes to a library in one statement, without loading the
+        library. The bibcodes already in the library keep their value. The
+        library must be locked by the current transaction.
+
+        :param library_id: the library id to update
+        :param bibcodes: set of bibcodes
+
+        :return: number of bibcodes that were not already in the library
+        """
+        if not bibcodes:
+            return 0
+
+        bibcodes = list(bibcodes)
+        number_existing = db.session.execute(
+            'SELECT count(*) FROM library, jsonb_object_keys(library.bibcode) '
+            'AS key WHERE library.id = :id AND key = ANY(:bibcodes)',
+            {'id': str(library_id), 'bibcodes': bibcodes},
+            mapper=Library.__mapper__
+        ).scalar()
+
+        # The right hand side of || wins, so existing bibcodes are kept as
+        # they are
+        table = Library.__table__
+        new_bibcodes = literal(dict((bibcode, {}) for bibcode in bibcodes),
+                               JSONB)
+        existing = func.coalesce(table.c.bibcode, cast('{}', JSONB))
+        db.session.execute(
+            table.update()
+            .where(table.c.id == library_id)
+            .values(bibcode=new_bibcodes.op('||')(existing)),
+            mapper=Library.__mapper__
+        )
+
+        return len(bibcodes) - number_existing
+
+    @classmethod
+    def bulk_add_documents_to_library(cls, library_id, stream, batch_size,
+                                      if_match=None, max_bibcodes=None):
+        """
+        Adds the bibcodes read from a stream to a user's library. The stream is
+        read and validated in full first, and only then is the library locked,
+        and the new bibcodes merged in one update.
+
+        :param library_id: the library id to update
+        :param stream: file-like object with one bibcode per line
+        :param batch_size: number of lines to read at once
+        :param if_match: versions the library must be at, None for any
+        :param max_bibcodes: maximum number of distinct bibcodes, None for any
+
+        :return: dictionary of the counts of the documents
+                 number_added: number of documents successfully added
+                 number_duplicate: number of documents already in the library
+                 number_invalid: number of lines that are not bibcodes
+        """
+        bibcodes, counts = cls.read_bulk_bibcodes(stream, batch_size,
+                                                  max_bibcodes)
+
+        cls.helper_bump_library_version(library_id=library_id,
+                                        if_match=if_match)
+        counts['number_added'] = cls.merge_bibcodes(library_id, bibcodes)
+        counts['number_duplicate'] += len(bibcodes) - counts['number_added']
+        db.session.commit()
+
+        logger.info('Bulk added to library_uuid: {0}: {1}', library_id, counts)
+
+        return counts
+
+    def post(self, library):
+        """
+        HTTP POST request that adds a large number of documents to a library
+        for a given user
+        :param library: library ID
+
+        :return: the counts of the documents added
+
+        Header:
+        -------
+        Must contain the API forwarded user ID of the user accessing the end
+        point
+
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
+        Post body:
+        ----------
+        Plain text, one bibcode per line. Empty lines are ignored. At most
+        BIBLIB_BULK_MAX_BIBCODES distinct bibcodes are accepted at once.
+
+        Return data:
+        -----------
+        number_added: number of documents added
+        number_duplicate: number of documents that were already in the library
+                          or repeated in the request
+        number_invalid: number of lines that were not valid bibcodes
+
+        Permissions:
+        -----------
+        The following type of user can add documents:
+          - owner
+          - admin
+          - write
+        """
+        # Get the user requesting this from the header
+        try:
+            user_editing = self.helper_get_user_id()
+        except KeyError:
+            return err(MISSING_USERNAME_ERROR)
+
+        # URL safe base64 string to UUID
+        library = self.helper_slug_to_uuid(library)
+
+        user_editing_uid = \
+            self.helper_absolute_uid_to_service_uid(absolute_uid=user_editing)
+
+        # Check the permissions of the user
+        if not self.write_access(service_uid=user_editing_uid,
+                                 library_id=library):
             return err(NO_PERMISSION_ERROR)
 
-        return {}, 200
\ No newline at end of file
+        try:
+            counts = self.bulk_add_documents_to_library(
+                library_id=library,
+                stream=request.stream,
+                batch_size=current_app.config.get('BIBLIB_BULK_BATCH_SIZE',
+                                                  1000),
+                if_match=self.helper_get_if_match(),
+                max_bibcodes=current_app.config.get('BIBLIB_BULK_MAX_BIBCODES',
+                                                    100000)
+            )
+        except PreconditionFailedError:
+            db.session.rollback()
+            return err(PRECONDITION_FAILED_ERROR)
+        except TooManyBibcodesError as error:
+            logger.error('User: {0} sent too many bibcodes to {1}: {2}',
+                         user_editing_uid, library, error)
+            return err(TOO_MANY_BIBCODES_ERROR)
+        logger.info('Successfully bulk added {0} documents to {1} by {2}',
+                    counts['number_added'], library, user_editing_uid)
+
+        return counts, 200, self.helper_version_headers(library)
@@ -46,7 +46,27 @@ SOLR_RESPONSE_MISMATCH_ERROR = dict(
          'request.',
     number=404
 )
+SOLR_UNAVAILABLE_ERROR = dict(
+    body='Solr is unavailable, the documents are listed without their Solr '
+         'content.',
+    number=503
+)
 NO_CLASSIC_ACCOUNT = dict(
     body='This user has not setup an ADS Classic account',
     number=400
 )
+PRECONDITION_FAILED_ERROR = dict(
+    body='The library has been modified since the version given in If-Match.',
+    number=412
+)
+WRONG_OPERATION_ERROR = dict(
+    body='The operation requested does not exist or was given the wrong '
+         'number of libraries. See the API documentation: {0}'
+         .format(API_HELP),
+    number=400
+)
+TOO_MANY_BIBCODES_ERROR = dict(
+    body='Too many bibcodes were requested at once. See the API '
+         'documentation: {0}'.format(API_HELP),
+    number=400
+)
@@ -1,15 +1,32 @@
 """
 Library view
 """
+import zlib
+from .. import metrics
 from ..views import USER_ID_KEYWORD
-from ..utils import err
+from ..utils import err, is_not_modified
 from ..models import db, User, Library, Permissions
-from ..client import client
-from base_view import BaseView
+from ..client import client, CircuitBreaker, SingleFlight
+from base_view import BaseView, read_from_replica
 from flask import request, current_app
 from flask.ext.discoverer import advertise
+from sqlalchemy.orm.exc import NoResultFound
+from ..biblib_exceptions import CircuitOpenError
 from http_errors import MISSING_USERNAME_ERROR, SOLR_RESPONSE_MISMATCH_ERROR, \
-    MISSING_LIBRARY_ERROR, NO_PERMISSION_ERROR
+    MISSING_LIBRARY_ERROR, NO_PERMISSION_ERROR, SOLR_UNAVAILABLE_ERROR
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
+
+# Shared by all the requests of a worker
+SOLR_BIG_QUERY_BREAKER = CircuitBreaker(
+    name='bigquery',
+    config_key='BIBLIB_SOLR_BIG_QUERY_BREAKER'
+)
+
+# Identical reads of a library that arrive together share one bigquery call
+LIBRARY_CONTENT_FLIGHT = SingleFlight(name='library_content')
 
 
 class LibraryView(BaseView):
@@ -21,6 +38,7 @@ class LibraryView(BaseView):
     must be scopeless, whereas the others will have scope.
     """
     decorators = [advertise('scopes', 'rate_limit')]
+    method_decorators = [read_from_replica]
     scopes = []
     rate_limit = [1000, 60*60*24]
 
@@ -49,8 +67,8 @@ class LibraryView(BaseView):
             api=current_app.config['BIBLIB_USER_EMAIL_ADSWS_API_URL'],
             uid=owner.absolute_uid
         )
-        current_app.logger.info('Obtaining email of user: {0} [API UID]'
-                                .format(owner.absolute_uid))
+        logger.info('Obtaining email of user: {0} [API UID]',
+                    owner.absolute_uid, sample=True)
         response = client().get(
             service
         )
@@ -61,8 +79,8 @@ class LibraryView(BaseView):
         ).all()
 
         if response.status_code != 200:
-            current_app.logger.error('Could not find user in the API'
-                                     'database: {0}.'.format(service))
+            logger.error('Could not find user in the API database: {0}.',
+                         service)
             owner = 'Not available'
         else:
             owner = response.json()['email'].split('@')[0]
@@ -105,6 +123,7 @@ class LibraryView(BaseView):
             num_documents=len(library.bibcode),
             date_created=library.date_created.isoformat(),
             date_last_modified=library.date_last_modified.isoformat(),
+            version=library.version,
             permission=main_permission,
             public=library.public,
             num_users=num_users,
@@ -113,6 +132,47 @@ class LibraryView(BaseView):
 
         return library, metadata
 
+    @classmethod
+    def get_library_validators(cls, library_id, service_uid):
+        """
+        Retrieve what is needed to answer a conditional request for a library,
+        without loading the library content. The entity tag is the version of
+        the library, the same one that is sent back by modifications and is
+        expected in If-Match. Every change of the content, the users or their
+        permissions increments the version. The permission of the user
+        requesting it is also part of the response, so responses vary with the
+        user.
+
+        :param library_id: the unique ID of the library
+        :param service_uid: the user ID within this microservice
+
+        :return: dictionary with the following
+                 public: if the library is public
+                 readable: if the user can read the library
+                 etag: unquoted entity tag
+                 last_modified: date the library was last modified
+        """
+        public, version, date_last_modified = db.session.query(
+            Library.public,
+            Library.version,
+            Library.date_last_modified
+        ).filter(Library.id == library_id).one()
+
+        permission = None
+        if service_uid:
+            permission = Permissions.query.filter(
+                Permissions.user_id == service_uid,
+                Permissions.library_id == library_id
+            ).first()
+        main_permission = cls.helper_main_permission(permission)
+
+        return dict(
+            public=public,
+            readable=bool(public) or main_permission != 'none',
+            etag='{0}'.format(version),
+            last_modified=date_last_modified
+        )
+
     @classmethod
     def read_access(cls, service_uid, library_id):
         """
@@ -133,6 +193,78 @@ class LibraryView(BaseView):
 
         return False
 
+    @staticmethod
+    def plan_big_query(bibcodes, start=0, rows=20, sort='date desc'):
+        """
+        Decide which bibcodes have to be sent to Solr bigquery for a page of a
+        library. When the sort order only depends on the bibcodes, the page is
+        selected locally and only its bibcodes are sent, to be filled in with
+        the fields asked for. Otherwise Solr has to sort the whole library.
+
+        Bibcodes that Solr does not know of are left out of its response, so a
+        locally selected page can have fewer documents than rows.
+
+        :param bibcodes: bibcodes of the library
+        :param start: start index
+        :param rows: number of rows
+        :param sort: how the response should be sorted
+
+        :return: dictionary with the following
+                 local: True if the page was selected locally
+                 bibcodes: bibcodes to send
+                 start: start index to send
+                 rows: number of rows to send
+        """
+        sort_field = sort.strip().split()
+        if len(sort_field) != 2 or sort_field[0] != 'bibcode' or \
+                sort_field[1] not in ('asc', 'desc'):
+            return dict(local=False, bibcodes=bibcodes, start=start,
+                        rows=rows)
+
+        page = sorted(bibcodes, reverse=sort_field[1] == 'desc')
+        page = page[start:start+min(rows, 100)]
+        return dict(local=True, bibcodes=page, start=0, rows=len(page))
+
+    @staticmethod
+    def solr_big_query_body(bibcodes):
+        """
+        Body of a Solr bigquery request: a bibcode header line followed by one
+        bibcode per line. If the end point accepts it, bodies over
+        BIBLIB_SOLR_BIG_QUERY_GZIP_THRESHOLD bytes are gzip compressed as
+        they are built, without building the uncompressed body first.
+
+        :param bibcodes: bibcodes
+        :type bibcodes: list
+
+        :return: body, and the headers that describe it
+        """
+        config = current_app.config
+        bibcodes = list(bibcodes)
+        headers = {'Content-Type': 'big-query/csv'}
+
+        # The bibcode header, and one separator plus bibcode per bibcode
+        size = len('bibcode') + sum(len(bibcode) + 1 for bibcode in bibcodes)
+        if not config.get('BIBLIB_SOLR_BIG_QUERY_GZIP') or \
+                size < config.get('BIBLIB_SOLR_BIG_QUERY_GZIP_THRESHOLD', 0):
+            return 'bibcode\n' + '\n'.join(bibcodes), headers
+
+        # 16 + MAX_WBITS gives a gzip header and trailer, rather than zlib
+        compressor = zlib.compressobj(
+            config.get('BIBLIB_SOLR_BIG_QUERY_GZIP_LEVEL', 6),
+            zlib.DEFLATED,
+            16 + zlib.MAX_WBITS
+        )
+        chunks = [compressor.compress('bibcode')]
+        for i in range(0, len(bibcodes), 1000):
+            chunk = '\n' + '\n'.join(bibcodes[i:i+1000])
+            chunks.append(compressor.compress(chunk.encode('utf-8')))
+        chunks.append(compressor.flush())
+        body = ''.join(chunks)
+
+        metrics.incr('bigquery.upload_bytes_saved', size - len(body))
+        headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
     @staticmethod
     def solr_big_query(
             bibcodes,
@@ -142,7 +274,9 @@ class LibraryView(BaseView):
             fl='bibcode'
     ):
         """
-        A thin wrapper for the solr bigquery service.
+        A thin wrapper for the solr bigquery service. The call times out after
+        BIBLIB_SOLR_BIG_QUERY_TIMEOUT, and is not attempted at all while the
+        circuit breaker is open, in which case CircuitOpenError is raised.
 
         :param bibcodes: bibcodes
         :type bibcodes: list
@@ -164,8 +298,6 @@ class LibraryView(BaseView):
 
         rows = min(rows, 100)
 
-        bibcodes_string = 'bibcode\n' + '\n'.join(bibcodes)
-
         # We need atleast bibcode and alternate bibcode for other methods
         # to work properly
         if fl == '':
@@ -186,27 +318,41 @@ class LibraryView(BaseView):
             'sort': sort
         }
 
-        headers = {
-            'Content-Type': 'big-query/csv',
-        }
-        current_app.logger.info('Querying Solr bigquery microservice: {0}, {1}'
-                                .format(params,
-                                        bibcodes_string.replace('\n', ',')))
-        response = client().post(
-            url=current_app.config['BIBLIB_SOLR_BIG_QUERY_URL'],
-            params=params,
-            data=bibcodes_string,
-            headers=headers
-        )
+        data, headers = LibraryView.solr_big_query_body(bibcodes)
+        metrics.incr('bigquery.upload_bytes', len(data))
+        logger.info('Querying Solr bigquery microservice: {0}, {1} bibcodes '
+                    'in {2} bytes', params, len(bibcodes), len(data))
+        generation = SOLR_BIG_QUERY_BREAKER.before_call()
+        try:
+            response = client().post(
+                url=current_app.config['BIBLIB_SOLR_BIG_QUERY_URL'],
+                params=params,
+                data=data,
+                headers=headers,
+                timeout=current_app.config.get(
+                    'BIBLIB_SOLR_BIG_QUERY_TIMEOUT'
+                )
+            )
+        except Exception:
+            SOLR_BIG_QUERY_BREAKER.after_call(success=False,
+                                              generation=generation)
+            raise
+
+        SOLR_BIG_QUERY_BREAKER.after_call(success=response.status_code < 500,
+                                          generation=generation)
 
         return response
 
     @staticmethod
-    def solr_update_library(library, solr_docs):
+    def solr_update_library(library, solr_docs, locked=False):
         """
-        Updates the library based on the solr canonical bibcodes response
+        Updates the library based on the solr canonical bibcodes response. If
+        anything needs changing, the library is locked and re-read before the
+        changes are recomputed, so that documents added in the mean time are
+        not lost.
         :param library: library to update
         :param solr_docs: solr docs from the bigquery response
+        :param locked: the library is already locked for update
 
         :return: dictionary with details of files modified
                  num_updated: number of documents modified
@@ -258,8 +404,19 @@ class LibraryView(BaseView):
                     bibcode not in alternate_bibcodes.keys():
                 new_bibcode[bibcode] = library.bibcode[bibcode]
 
+        if update and not locked:
+            # Writes, and the reads they depend on, go to the primary
+            BaseView.helper_use_primary()
+            library = BaseView.helper_get_library_for_update(library.id)
+            return LibraryView.solr_update_library(
+                library=library,
+                solr_docs=solr_docs,
+                locked=True
+            )
+
         if update:
-            # Update the database
+            # Update the database, as a new version of the library
+            BaseView.helper_bump_library_version(library.id)
             library.bibcode = new_bibcode
             db.session.add(library)
             db.session.commit()
@@ -272,6 +429,89 @@ class LibraryView(BaseView):
 
         return updates
 
+    @classmethod
+    def get_library_content(cls, library, start, rows, sort, fl):
+        """
+        Retrieve a page of the library documents from Solr bigquery, updating
+        the library with the canonical bibcodes returned. If Solr cannot be
+        used, the page is made of the bibcodes stored in the library.
+        :param library: library
+        :param start: start row
+        :param rows: number of rows
+        :param sort: Solr sort
+        :param fl: Solr field list
+
+        :return: dictionary with the following
+                 documents: bibcodes of the page
+                 solr: Solr response, or an error message
+                 updates: details of the canonical bibcode update
+                 degraded: if Solr was not used
+        """
+        # pay attention to any functions that try to mutate the list
+        # this will alter expected returns later
+        degraded = False
+        plan = cls.plan_big_query(
+            bibcodes=library.bibcode,
+            start=start,
+            rows=rows,
+            sort=sort
+        )
+        try:
+            # The documents are decoded in full, as their bibcodes are needed
+            # for the page and the canonical bibcode updates
+            solr = cls.solr_big_query(
+                bibcodes=plan['bibcodes'],
+                start=plan['start'],
+                rows=plan['rows'],
+                sort=sort,
+                fl=fl
+            ).json()
+
+            # Solr only saw the page, but it should describe the library
+            if plan['local'] and solr.get('response'):
+                solr['response'].update(
+                    numFound=len(library.bibcode),
+                    start=start
+                )
+        except CircuitOpenError:
+            logger.warning('Solr bigquery circuit is open, serving library: '
+                           '{0} degraded', library.id)
+            degraded = True
+            solr = {}
+        except Exception as error:
+            logger.warning('Could not parse solr data: {0}', error)
+            solr = {'error': 'Could not parse solr data'}
+
+        # Now check if we can update the library database based on the
+        # returned canonical bibcodes
+        if solr.get('response'):
+            # Update bibcodes based on solrs response
+            updates = cls.solr_update_library(
+                library=library,
+                solr_docs=solr['response']['docs']
+            )
+
+            documents = [i['bibcode'] for i in solr['response']['docs']]
+        else:
+            # Some problem occurred, we will just ignore it, but will
+            # definitely log it.
+            if degraded:
+                solr = SOLR_UNAVAILABLE_ERROR['body']
+            else:
+                solr = SOLR_RESPONSE_MISMATCH_ERROR['body']
+                logger.warning('Problem with solr response: {0}', solr)
+            updates = {}
+            documents = library.get_bibcodes()
+            documents.sort()
+            documents = documents[start:start+rows]
+
+        return dict(
+            documents=documents,
+            solr=solr,
+            updates=updates,
+            degraded=degraded
+        )
+
     # Methods
     def get(self, library):
         """
@@ -294,6 +534,9 @@ class LibraryView(BaseView):
         -----------
         documents:    <list>   Currently, a list containing the bibcodes.
         solr:         <dict>   The response from the solr bigquery end point
+        degraded:     <boolean> True if Solr was not queried because it failed
+                                too often recently. The documents are then
+                                listed in bibcode order, without Solr content.
         metadata:     <dict>   contains the following:
 
           name:                 <string>  Name of the library
@@ -302,6 +545,8 @@ class LibraryView(BaseView):
           num_documents:        <int>     Number of documents in the library
           date_created:         <string>  ISO date library was created
           date_last_modified:   <string>  ISO date library was last modified
+          version:              <int>     Version of the library, incremented
+                                          by every modification
           permission:           <sting>   Permission type, can be: 'read',
                                           'write', 'admin', or 'owner'
           public:               <boolean> True means it is public
@@ -337,11 +582,17 @@ class LibraryView(BaseView):
         - sort: 'date desc'
         - fl: 'bibcode'
 
+        Conditional Requests:
+        -----------
+        The response has an ETag and Last-Modified header. If-None-Match and
+        If-Modified-Since are answered with 304 Not Modified if the library has
+        not changed. Public libraries can be stored by shared caches.
+
         """
         try:
             user = int(request.headers[USER_ID_KEYWORD])
         except KeyError:
-            current_app.logger.error('No username passed')
+            logger.error('No username passed')
             return err(MISSING_USERNAME_ERROR)
 
         # Parameters to be forwarded to Solr: pagination, and fields
@@ -353,16 +604,14 @@ class LibraryView(BaseView):
             rows = 20
         sort = request.args.get('sort', 'date desc')
         fl = request.args.get('fl', 'bibcode')
-        current_app.logger.info('User gave pagination parameters:'
-                                'start: {}, '
-                                'rows: {}, '
-                                'sort: "{}", '
-                                'fl: "{}"'.format(start, rows, sort, fl))
+        logger.info('User gave pagination parameters: start: {0}, rows: '
+                    '{1}, sort: "{2}", fl: "{3}"', start, rows,
+                    sort, fl, sample=True)
 
         library = self.helper_slug_to_uuid(library)
 
-        current_app.logger.info('User: {0} requested library: {1}'
-                                .format(user, library))
+        logger.info('User: {0} requested library: {1}', user, library,
+                    sample=True)
 
         user_exists = self.helper_user_exists(absolute_uid=user)
         if user_exists:
@@ -371,6 +620,28 @@ class LibraryView(BaseView):
         else:
             service_uid = None
 
+        # Conditional requests are answered with only a permission and
+        # modification date query, before any of the content is built
+        try:
+            validators = self.get_library_validators(library_id=library,
+                                                     service_uid=service_uid)
+        except NoResultFound:
+            logger.warning('Library: {0} does not exist', library)
+            return err(MISSING_LIBRARY_ERROR)
+
+        if validators['readable'] and \
+                is_not_modified(request,
+                                etag=validators['etag'],
+                                last_modified=validators['last_modified']):
+            logger.info('Library: {0} not modified', library, sample=True)
+            return self.helper_not_modified(
+                self.helper_cache_headers(
+                    etag=validators['etag'],
+                    last_modified=validators['last_modified'],
+                    public=validators['public']
+                )
+            )
+
         # If the library is public, allow access
         try:
             # Try to load the dictionary and obtain the solr content
@@ -378,65 +649,46 @@ class LibraryView(BaseView):
                 library_id=library,
                 service_uid=service_uid
             )
-            # pay attention to any functions that try to mutate the list
-            # this will alter expected returns later
-            try:
-                solr = self.solr_big_query(
-                    bibcodes=library.bibcode,
+            content = LIBRARY_CONTENT_FLIGHT.do(
+                key=(library.id, library.version,
+                     library.date_last_modified, start, rows, sort, fl),
+                function=lambda: self.get_library_content(
+                    library=library,
                     start=start,
                     rows=rows,
                     sort=sort,
                     fl=fl
-                ).json()
-            except Exception as error:
-                current_app.logger.warning('Could not parse solr data: {0}'
-                                           .format(error))
-                solr = {'error': 'Could not parse solr data'}
-
-            # Now check if we can update the library database based on the
-            # returned canonical bibcodes
-            if solr.get('response'):
-                # Update bibcodes based on solrs response
-                updates = self.solr_update_library(
-                    library=library,
-                    solr_docs=solr['response']['docs']
+                ),
+                timeout=current_app.config.get(
+                    'BIBLIB_LIBRARY_SINGLE_FLIGHT_TIMEOUT', 15
                 )
-
-                documents = [i['bibcode'] for i in solr['response']['docs']]
-            else:
-                # Some problem occurred, we will just ignore it, but will
-                # definitely log it.
-                solr = SOLR_RESPONSE_MISMATCH_ERROR['body']
-                current_app.logger.warning('Problem with solr response: {0}'
-                                           .format(solr))
-                updates = {}
-                documents = library.get_bibcodes()
-                documents.sort()
-                documents = documents[start:start+rows]
+            )
+            updates = content['updates']
 
             # Make the response dictionary
-            response = dict(
-                documents=documents,
-                solr=solr,
-                metadata=metadata,
-                updates=updates
-            )
+            response = dict(content, metadata=metadata)
 
         except Exception as error:
-            current_app.logger.warning(
-                'Library missing or solr endpoint failed: {0}'
-                .format(error)
-            )
+            logger.warning('Library missing or solr endpoint failed: {0}',
+                           error)
             return err(MISSING_LIBRARY_ERROR)
 
+        # The canonical bibcode update modifies the library
+        if updates.get('num_updated'):
+            validators = self.get_library_validators(library_id=library.id,
+                                                     service_uid=service_uid)
+        headers = self.helper_cache_headers(
+            etag=validators['etag'],
+            last_modified=validators['last_modified'],
+            public=validators['public']
+        )
+
         # Skip anymore logic if the library is public
         if library.public:
-            current_app.logger.info('Library: {0} is public'
-                                    .format(library.id))
-            return response, 200
+            logger.info('Library: {0} is public', library.id, sample=True)
+            return response, 200, headers
         else:
-            current_app.logger.warning('Library: {0} is private'
-                                       .format(library.id))
+            logger.warning('Library: {0} is private', library.id)
 
         # If the user does not exist then there are no associated permissions
         # If the user exists, they will have permissions
@@ -444,25 +696,21 @@ class LibraryView(BaseView):
             service_uid = \
                 self.helper_absolute_uid_to_service_uid(absolute_uid=user)
         else:
-            current_app.logger.error('User:{0} does not exist in the database.'
-                                     ' Therefore will not have extra '
-                                     'privileges to view the library: {1}'
-                                     .format(user, library.id))
+            logger.error('User:{0} does not exist in the database. Therefore '
+                         'will not have extra privileges to view the '
+                         'library: {1}', user, library.id)
 
             return err(NO_PERMISSION_ERROR)
 
         # If they do not have access, exit
         if not self.read_access(service_uid=service_uid,
                                 library_id=library.id):
-            current_app.logger.error(
-                'User: {0} does not have access to library: {1}. DENIED'
-                .format(service_uid, library.id)
-            )
+            logger.error('User: {0} does not have access to library: {1}. '
+                         'DENIED', service_uid, library.id)
             return err(NO_PERMISSION_ERROR)
 
         # If they have access, let them obtain the requested content
-        current_app.logger.info('User: {0} has access to library: {1}. '
-                                'ALLOWED'
-                                .format(user, library.id))
+        logger.info('User: {0} has access to library: {1}. ALLOWED', user,
+                    library.id)
 
-        return response, 200
+        return response, 200, headers
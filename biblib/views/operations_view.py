@@ -0,0 +1,281 @@
+"""
+Operations view
+"""
+
+from ..utils import err, get_post_data
+from ..models import db, Library
+from base_view import BaseView
+from user_view import UserView
+from library_view import LibraryView
+from document_view import DocumentView
+from flask import request
+from flask.ext.discoverer import advertise
+from sqlalchemy.orm.exc import NoResultFound
+from http_errors import MISSING_USERNAME_ERROR, DUPLICATE_LIBRARY_NAME_ERROR, \
+    WRONG_TYPE_ERROR, NO_PERMISSION_ERROR, MISSING_LIBRARY_ERROR, \
+    WRONG_OPERATION_ERROR, PRECONDITION_FAILED_ERROR
+from ..biblib_exceptions import BackendIntegrityError, PreconditionFailedError
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
+
+class OperationsView(BaseView):
+    """
+    End point to build libraries from the set operations of other libraries.
+    The set operations are carried out within the service on the bibcodes of
+    the libraries, so the documents never need to be paged out to the user.
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['user']
+    rate_limit = [1000, 60*60*24]
+
+    # Operations that create a new library, and those that write in to an
+    # existing library
+    new_library_operations = ['union', 'intersection', 'difference']
+    existing_library_operations = ['copy']
+
+    @staticmethod
+    def get_bibcode_set(library_id):
+        """
+        Get the bibcodes of a library as a set, loading only the bibcode
+        column of the library
+
+        :param library_id: the unique ID of the library
+
+        :return: set of bibcodes
+        """
+        bibcode = db.session.query(Library.bibcode)\
+            .filter(Library.id == library_id)\
+            .one()[0]
+
+        return set(bibcode or {})
+
+    @staticmethod
+    def read_access(service_uid, library_id):
+        """
+        Defines which type of user can use a library as the input of an
+        operation. This is anyone who can read the library, or anyone at all
+        if the library is public.
+
+        :param service_uid: the user ID within this microservice
+        :param library_id: the unique ID of the library
+
+        :return: boolean, access (True), no access (False)
+        """
+        public = db.session.query(Library.public)\
+            .filter(Library.id == library_id)\
+            .one()[0]
+
+        if public:
+            return True
+
+        return LibraryView.read_access(service_uid=service_uid,
+                                       library_id=library_id)
+
+    @classmethod
+    def valid_operation(cls, action, secondaries):
+        """
+        Checks that the operation exists and has been given the number of
+        secondary libraries that it needs
+
+        :param action: name of the operation
+        :param secondaries: list of the secondary library IDs
+
+        :return: valid (True), not valid (False)
+        """
+        if action in cls.new_library_operations:
+            return len(secondaries) > 0
+        elif action in cls.existing_library_operations:
+            return len(secondaries) == 1
+        else:
+            return False
+
+    @staticmethod
+    def compute_operation(action, primary, secondaries):
+        """
+        Carry out the set operation on the bibcodes of the libraries
+
+        :param action: union, intersection, difference, or copy
+        :param primary: set of bibcodes of the primary library
+        :param secondaries: list of sets of bibcodes of the other libraries
+
+        :return: set of bibcodes
+        """
+        if action == 'union':
+            return primary.union(*secondaries)
+        elif action == 'intersection':
+            return primary.intersection(*secondaries)
+        elif action == 'difference':
+            return primary.difference(*secondaries)
+        elif action == 'copy':
+            return primary
+        else:
+            raise ValueError('Unknown operation: {0}'.format(action))
+
+    @classmethod
+    def copy_to_library(cls, library_id, bibcodes, if_match=None):
+        """
+        Add the result of an operation to an existing library
+
+        :param library_id: the unique ID of the library to write to
+        :param bibcodes: set of bibcodes to add
+        :param if_match: versions the library must be at, None for any
+
+        :return: library, number of documents added
+        """
+        cls.helper_bump_library_version(library_id=library_id,
+                                        if_match=if_match)
+        library = cls.helper_get_library_for_update(library_id)
+        number_added = library.add_bibcodes(bibcodes)
+
+        db.session.add(library)
+        db.session.commit()
+
+        return library, number_added
+
+    def post(self, library):
+        """
+        HTTP POST request that carries out a set operation on the documents of
+        a library and those of other libraries
+        :param library: library ID of the primary library
+
+        :return: details of the library the result was written to
+
+        Header:
+        -------
+        Must contain the API forwarded user ID of the user accessing the end
+        point
+
+        For copy, can contain If-Match with the version of the library copied
+        in to. 412 is returned if the library is at another version.
+
+        Post body:
+        ----------
+        KEYWORD, VALUE
+        action:       <string>  union, intersection, difference, or copy
+        libraries:    <list>    IDs of the secondary libraries. For copy, this
+                                must be exactly one library, the library that
+                                the documents are copied in to
+        name:         <string>  name of the new library (not used by copy)
+        description:  <string>  description of the new library (not used by
+                                copy)
+        public:       <boolean> is the new library public (not used by copy)
+
+        Return data:
+        -----------
+        name:           <string>    Name of the library written to
+        id:             <string>    ID of the library written to
+        description:    <string>    Description of the library written to
+        num_documents:  <int>       Number of documents in the library
+        number_added:   <int>       Number of documents added to the library
+        version:        <int>       Version of the library
+
+        Permissions:
+        -----------
+        The following type of user can carry out an operation:
+          - read access, or public, for the primary and secondary libraries
+          - write access for the library written to by copy
+          - any user for the new library made by union, intersection and
+            difference
+        """
+        # Get the user requesting this from the header
+        try:
+            user = self.helper_get_user_id()
+        except KeyError:
+            return err(MISSING_USERNAME_ERROR)
+
+        service_uid = \
+            self.helper_absolute_uid_to_service_uid(absolute_uid=user)
+
+        try:
+            data = get_post_data(
+                request,
+                types=dict(
+                    action=unicode,
+                    libraries=list,
+                    name=unicode,
+                    description=unicode,
+                    public=bool
+                )
+            )
+        except TypeError as error:
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
+            return err(WRONG_TYPE_ERROR)
+
+        action = data.get('action')
+        secondaries = data.get('libraries', [])
+        if not self.valid_operation(action=action, secondaries=secondaries):
+            logger.error('User requested operation: {0} with {1} libraries',
+                         action, len(secondaries))
+            return err(WRONG_OPERATION_ERROR)
+
+        # URL safe base64 string to UUID
+        primary = self.helper_slug_to_uuid(library)
+        secondaries = [self.helper_slug_to_uuid(i) for i in secondaries]
+
+        try:
+            for library_id in [primary] + secondaries:
+                if not self.read_access(service_uid=service_uid,
+                                        library_id=library_id):
+                    logger.error('User: {0} cannot read library: {1}',
+                                 service_uid, library_id)
+                    return err(NO_PERMISSION_ERROR)
+
+            if action in self.existing_library_operations and \
+                    not DocumentView.write_access(service_uid=service_uid,
+                                                  library_id=secondaries[0]):
+                logger.error('User: {0} cannot write to library: {1}',
+                             service_uid, secondaries[0])
+                return err(NO_PERMISSION_ERROR)
+
+            bibcodes = self.compute_operation(
+                action=action,
+                primary=self.get_bibcode_set(primary),
+                secondaries=[self.get_bibcode_set(i) for i in secondaries]
+            )
+        except NoResultFound as error:
+            logger.error('Library for operation does not exist: {0}', error)
+            return err(MISSING_LIBRARY_ERROR)
+
+        logger.info('Operation: {0} on library: {1} with {2} libraries '
+                    'resulted in {3} documents', action, primary,
+                    len(secondaries), len(bibcodes))
+
+        if action in self.existing_library_operations:
+            try:
+                library, number_added = self.copy_to_library(
+                    library_id=secondaries[0],
+                    bibcodes=bibcodes,
+                    if_match=self.helper_get_if_match()
+                )
+            except PreconditionFailedError:
+                db.session.rollback()
+                return err(PRECONDITION_FAILED_ERROR)
+        else:
+            library_data = dict(
+                name=data.get('name'),
+                description=data.get('description'),
+                public=data.get('public', False),
+                bibcode=list(bibcodes)
+            )
+            try:
+                library = UserView.create_library(
+                    service_uid=service_uid,
+                    library_data=library_data
+                )
+            except BackendIntegrityError as error:
+                logger.error('{0}', error)
+                return err(DUPLICATE_LIBRARY_NAME_ERROR)
+            number_added = len(library.bibcode)
+
+        return {
+            'name': library.name,
+            'id': '{0}'.format(self.helper_uuid_to_slug(library.id)),
+            'description': library.description,
+            'num_documents': len(library.bibcode),
+            'number_added': number_added,
+            'version': library.version
+        }, 200
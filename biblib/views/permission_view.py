@@ -6,12 +6,16 @@ from flask import request, current_app
 from flask.ext.discoverer import advertise
 from ..models import db, User, Library, Permissions
 from ..client import client
-from base_view import BaseView
+from base_view import BaseView, read_from_replica
 from sqlalchemy.orm.exc import NoResultFound
 from ..utils import get_post_data, err
 from http_errors import MISSING_USERNAME_ERROR, NO_PERMISSION_ERROR, \
-    WRONG_TYPE_ERROR, API_MISSING_USER_EMAIL
-from ..biblib_exceptions import PermissionDeniedError
+    WRONG_TYPE_ERROR, API_MISSING_USER_EMAIL, PRECONDITION_FAILED_ERROR
+from ..biblib_exceptions import PermissionDeniedError, PreconditionFailedError
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
 
 class PermissionView(BaseView):
     """
@@ -21,6 +25,7 @@ class PermissionView(BaseView):
     # TODO:   - send invitation?
 
     decorators = [advertise('scopes', 'rate_limit')]
+    method_decorators = [read_from_replica]
     scopes = ['user']
     rate_limit = [1000, 60*60*24]
 
@@ -42,18 +47,13 @@ class PermissionView(BaseView):
         """
 
         if service_uid_editor == service_uid_modify:
-            current_app.logger.error('Editing user: {0} and user to edit: {1}'
-                                     ' are the same. This is not allowed.'
-                                     .format(service_uid_modify,
-                                             service_uid_editor))
+            logger.error('Editing user: {0} and user to edit: {1} are the '
+                         'same. This is not allowed.', service_uid_modify,
+                         service_uid_editor)
             return False
 
-        current_app.logger.info('Checking if user: {0}, can edit the '
-                                'permissions of user: {1}'
-                                .format(
-                                    service_uid_editor,
-                                    service_uid_modify
-                                ))
+        logger.info('Checking if user: {0}, can edit the permissions of '
+                    'user: {1}', service_uid_editor, service_uid_modify)
 
         # Check if the editor has permissions
         try:
@@ -62,16 +62,13 @@ class PermissionView(BaseView):
                 Permissions.library_id == library_id
             ).one()
         except NoResultFound as error:
-            current_app.logger.error(
-                'User: {0} has no permissions for this library: {1}'
-                .format(service_uid_editor, error)
-            )
+            logger.error('User: {0} has no permissions for this library: {1}',
+                         service_uid_editor, error)
             return False
 
         if editor_permissions.owner:
-            current_app.logger.info('User: {0} is owner, so is allowed to '
-                                    'change permissions'
-                                    .format(service_uid_editor))
+            logger.info('User: {0} is owner, so is allowed to change '
+                        'permissions', service_uid_editor)
             return True
 
         # Check if the user to be modified has permissions
@@ -97,13 +94,15 @@ class PermissionView(BaseView):
             return False
 
     @staticmethod
-    def add_permission(service_uid, library_id, permission, value):
+    def add_permission(service_uid, library_id, permission, value,
+                       if_match=None):
         """
         Adds a permission for a user to a specific library
         :param service_uid: the user ID within this microservice
         :param library_id: the library id to update
         :param permission: the permission to be added
         :param value: boolean that accompanies the permission
+        :param if_match: versions the library must be at, None for any
 
         :return: no return
         """
@@ -111,6 +110,9 @@ class PermissionView(BaseView):
         if permission not in ['read', 'write', 'admin']:
             raise PermissionDeniedError('Permission Error')
 
+        BaseView.helper_bump_library_version(library_id=library_id,
+                                             if_match=if_match)
+
         try:
             # If the user has permissions for this already
             new_permission = Permissions.query.filter(
@@ -118,16 +120,10 @@ class PermissionView(BaseView):
                 Permissions.library_id == library_id
             ).one()
 
-            current_app.logger.info(
-                'User: {0} has permissions already for '
-                'library: {1}. Modifying: "{2}" from [{3}] '
-                'to [{4}]'
-                .format(service_uid,
-                        library_id,
-                        permission,
-                        getattr(new_permission, permission),
-                        value)
-            )
+            logger.info('User: {0} has permissions already for library: {1}. '
+                        'Modifying: "{2}" from [{3}] to [{4}]', service_uid,
+                        library_id, permission,
+                        getattr(new_permission, permission), value)
 
             setattr(new_permission, permission, value)
 
@@ -137,12 +133,9 @@ class PermissionView(BaseView):
                     new_permission.admin |
                     new_permission.owner):
 
-                current_app.logger.info('Deleting permissions for {0} and '
-                                        'library {1} as all permissions are '
-                                        'False. {2}'
-                                        .format(service_uid,
-                                                library_id,
-                                                new_permission))
+                logger.info('Deleting permissions for {0} and library {1} as '
+                            'all permissions are False. {2}', service_uid,
+                            library_id, new_permission)
 
                 db.session.delete(new_permission)
             else:
@@ -150,13 +143,10 @@ class PermissionView(BaseView):
 
         except NoResultFound:
             # If no permissions set yet for user and library
-            current_app.logger.info('No permissions yet set for user: {0} for '
-                                    'library: {1}. Using defaults for setup'
-                                    ' and allocating "{2}" to [{3}]'
-                                    .format(service_uid,
-                                            library_id,
-                                            permission,
-                                            value))
+            logger.info('No permissions yet set for user: {0} for library: '
+                        '{1}. Using defaults for setup and allocating "{2}" '
+                        'to [{3}]', service_uid, library_id, permission,
+                        value)
 
             user = User.query.filter(User.id == service_uid).one()
             library = Library.query.filter(Library.id == library_id).one()
@@ -192,8 +182,7 @@ class PermissionView(BaseView):
                 api=current_app.config['BIBLIB_USER_EMAIL_ADSWS_API_URL'],
                 uid=user_info
             )
-            current_app.logger.info('Obtaining e-mail of user: {0} [API UID]'
-                                    .format(user_info))
+            logger.info('Obtaining e-mail of user: {0} [API UID]', user_info)
 
             response = client().get(
                 service
@@ -298,11 +287,9 @@ class PermissionView(BaseView):
         # Check permissions
         if not self.read_access(service_uid=service_uid,
                                 library_id=library):
-            current_app.logger.error(
-                'User {0} has the wrong permissions to get the '
-                'permission list for library {1}'
-                .format(service_uid, library)
-            )
+            logger.error('User {0} has the wrong permissions to get the '
+                         'permission list for library {1}', service_uid,
+                         library)
             return err(NO_PERMISSION_ERROR)
 
         # Get permissions
@@ -323,6 +310,10 @@ class PermissionView(BaseView):
         Must contain the API forwarded user ID of the user accessing the end
         point
 
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
         Post data:
         ----------
         KEYWORD, VALUE
@@ -379,55 +370,51 @@ class PermissionView(BaseView):
                 )
             )
         except TypeError as error:
-            current_app.logger.error('Wrong type passed for POST: {0} [{1}]'
-                                     .format(request.data, error))
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
             return err(WRONG_TYPE_ERROR)
 
-        current_app.logger.info('Requested permission changes for user {0}:'
-                                ' {1} for library {2}, by user: {3}'
-                                .format(permission_data['email'],
-                                        permission_data,
-                                        library,
-                                        user_editing_uid)
-                                )
+        logger.info('Requested permission changes for user {0}: {1} for '
+                    'library {2}, by user: {3}', permission_data['email'],
+                    permission_data, library, user_editing_uid)
 
         try:
             secondary_user = self.helper_email_to_api_uid(permission_data)
-            current_app.logger.info('User: {0} corresponds to: {1}'
-                                    .format(permission_data['email'],
-                                            secondary_user))
+            logger.info('User: {0} corresponds to: {1}',
+                        permission_data['email'], secondary_user)
         except NoResultFound:
             return err(API_MISSING_USER_EMAIL)
 
         secondary_service_uid = \
             self.helper_absolute_uid_to_service_uid(
                 absolute_uid=secondary_user)
-        current_app.logger.info('User: {0} is internally: {1}'
-                                .format(secondary_user, secondary_service_uid))
+        logger.info('User: {0} is internally: {1}', secondary_user,
+                    secondary_service_uid)
 
-        current_app.logger.info('Modifying permissions STARTING....')
+        logger.info('Modifying permissions STARTING....')
 
         if not self.has_permission(service_uid_editor=user_editing_uid,
                                    service_uid_modify=secondary_service_uid,
                                    library_id=library):
 
-            current_app.logger.error(
-                'User: {0} does not have permissions to edit: {1}'
-                .format(user_editing_uid, library)
-            )
+            logger.error('User: {0} does not have permissions to edit: {1}',
+                         user_editing_uid, library)
             return err(NO_PERMISSION_ERROR)
 
         try:
             self.add_permission(service_uid=secondary_service_uid,
                                 library_id=library,
                                 permission=permission_data['permission'],
-                                value=permission_data['value'])
+                                value=permission_data['value'],
+                                if_match=self.helper_get_if_match())
         except PermissionDeniedError:
-            current_app.logger.error('User: {0} does not have permissions to '
-                                     'modify the value of: {1}'
-                                     .format(user_editing_uid,
-                                             permission_data['permission']))
+            logger.error('User: {0} does not have permissions to modify the '
+                         'value of: {1}', user_editing_uid,
+                         permission_data['permission'])
             return err(NO_PERMISSION_ERROR)
+        except PreconditionFailedError:
+            db.session.rollback()
+            return err(PRECONDITION_FAILED_ERROR)
 
-        current_app.logger.info('...SUCCESS.')
-        return {}, 200
+        logger.info('...SUCCESS.')
+        return {}, 200, self.helper_version_headers(library)
@@ -4,11 +4,16 @@ Transfer view
 from ..utils import err, get_post_data
 from ..models import db, Permissions
 from base_view import BaseView
-from flask import request, current_app
+from flask import request
 from flask.ext.discoverer import advertise
 from http_errors import MISSING_USERNAME_ERROR, WRONG_TYPE_ERROR, \
-    API_MISSING_USER_EMAIL, NO_PERMISSION_ERROR
+    API_MISSING_USER_EMAIL, NO_PERMISSION_ERROR, PRECONDITION_FAILED_ERROR
 from sqlalchemy.orm.exc import NoResultFound
+from ..biblib_exceptions import PreconditionFailedError
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
 
 class TransferView(BaseView):
     """
@@ -42,7 +47,8 @@ class TransferView(BaseView):
         return False
 
     @staticmethod
-    def transfer_ownership(current_owner_uid, new_owner_uid, library_id):
+    def transfer_ownership(current_owner_uid, new_owner_uid, library_id,
+                           if_match=None):
         """
         Transfers the ownership of a library from the current owner to the
         new owner. The previous owner has all permissions for that library
@@ -51,16 +57,17 @@ class TransferView(BaseView):
         :param current_owner_uid: the user ID within this microservice
         :param new_owner_uid: the user ID within this microservice
         :param library_id: the unique ID of the library
+        :param if_match: versions the library must be at, None for any
 
         :return: no return
         """
+        BaseView.helper_bump_library_version(library_id=library_id,
+                                             if_match=if_match)
 
         # Find the current permissions of the user
-        current_app.logger.info('User {0} has requested to transfer ownership '
-                                'of library {1} to user {2}'
-                                .format(current_owner_uid,
-                                        library_id,
-                                        new_owner_uid))
+        logger.info('User {0} has requested to transfer ownership of library '
+                    '{1} to user {2}', current_owner_uid, library_id,
+                    new_owner_uid)
 
         current_permission = Permissions.query.filter(
             Permissions.user_id == current_owner_uid
@@ -77,19 +84,15 @@ class TransferView(BaseView):
                 Permissions.library_id == library_id
             ).one()
 
-            current_app.logger.info('User: {0} already has permissions for '
-                                    'library {1}: {2}'
-                                    .format(current_owner_uid,
-                                            library_id,
-                                            new_permission))
+            logger.info('User: {0} already has permissions for library {1}: '
+                        '{2}', current_owner_uid, library_id, new_permission)
 
             new_permission.owner = True
 
         except NoResultFound:
             # User does not have a permission with the library
-            current_app.logger.info('User {0} does not have permissions, for '
-                                    'library {1} creating fresh ones.'
-                                    .format(new_owner_uid, library_id))
+            logger.info('User {0} does not have permissions, for library {1} '
+                        'creating fresh ones.', new_owner_uid, library_id)
 
             new_permission = Permissions(user_id=new_owner_uid,
                                          library_id=library_id,
@@ -99,13 +102,8 @@ class TransferView(BaseView):
         db.session.add(new_permission)
         db.session.commit()
 
-        current_app.logger.info(
-            'Library {0} had ownership transferred '
-            'from user: {1} to user: {2}'
-            .format(library_id,
-                    current_owner_uid,
-                    new_owner_uid)
-        )
+        logger.info('Library {0} had ownership transferred from user: {1} to '
+                    'user: {2}', library_id, current_owner_uid, new_owner_uid)
 
     def post(self, library):
         """
@@ -120,6 +118,10 @@ class TransferView(BaseView):
         Must contain the API forwarded user ID of the user accessing the end
         point
 
+        Can contain If-Match with the version of the library being modified,
+        as returned in the ETag of a previous modification or the metadata of
+        the library. 412 is returned if the library is at another version.
+
         Post body:
         ----------
         KEYWORD, VALUE
@@ -161,45 +163,47 @@ class TransferView(BaseView):
                 )
             )
         except TypeError as error:
-            current_app.logger.error('Wrong type passed for POST: {0} [{1}]'
-                                     .format(request.data, error))
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
             return err(WRONG_TYPE_ERROR)
 
         # Look up the user in the API database
         try:
             new_owner_api = self.helper_email_to_api_uid(transfer_data)
-            current_app.logger.info('User: {0} corresponds to: {1}'
-                                    .format(transfer_data['email'],
-                                            new_owner_api))
+            logger.info('User: {0} corresponds to: {1}',
+                        transfer_data['email'], new_owner_api)
         except NoResultFound:
-            current_app.logger.error('User: {0} not found in the API database'
-                                     .format(transfer_data['email']))
+            logger.error('User: {0} not found in the API database',
+                         transfer_data['email'])
             return err(API_MISSING_USER_EMAIL)
 
         # Convert api user ID to service ID
         new_owner_service_uid = self.helper_absolute_uid_to_service_uid(
             absolute_uid=new_owner_api
         )
-        current_app.logger.info('User: {0} is internally: {1}'
-                                .format(new_owner_api, new_owner_service_uid))
+        logger.info('User: {0} is internally: {1}', new_owner_api,
+                    new_owner_service_uid)
         # Check permissions
         if not self.write_access(service_uid=current_owner_service_uid,
                                  library_id=library):
-            current_app.logger.error(
-                'User {0} has the wrong permissions to transfer the ownership'
-                ' for library {1}'
-                .format(current_owner_service_uid, library)
-            )
+            logger.error('User {0} has the wrong permissions to transfer the '
+                         'ownership for library {1}',
+                         current_owner_service_uid, library)
             return err(NO_PERMISSION_ERROR)
 
-        current_app.logger.info('User: {0} has permissions to transfer '
-                                'library {1} to the user {2}. Attempting '
-                                'transfer...'.format(current_owner_service_uid,
-                                                     library,
-                                                     new_owner_service_uid))
+        logger.info('User: {0} has permissions to transfer library {1} to '
+                    'the user {2}. Attempting transfer...',
+                    current_owner_service_uid, library, new_owner_service_uid)
 
-        self.transfer_ownership(current_owner_uid=current_owner_service_uid,
-                                new_owner_uid=new_owner_service_uid,
-                                library_id=library)
+        try:
+            self.transfer_ownership(
+                current_owner_uid=current_owner_service_uid,
+                new_owner_uid=new_owner_service_uid,
+                library_id=library,
+                if_match=self.helper_get_if_match()
+            )
+        except PreconditionFailedError:
+            db.session.rollback()
+            return err(PRECONDITION_FAILED_ERROR)
 
-        return {}, 200
+        return {}, 200, self.helper_version_headers(library)
@@ -2,16 +2,23 @@
 User view
 """
 
-from ..utils import uniquify, err, get_post_data
+from datetime import datetime
+from ..utils import uniquify, err, get_post_data, get_etag, is_not_modified
 from ..models import db, User, Library, Permissions
 from ..client import client
-from base_view import BaseView
+from base_view import BaseView, read_from_replica
 from flask import request, current_app
 from flask.ext.discoverer import advertise
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 from http_errors import MISSING_USERNAME_ERROR, DUPLICATE_LIBRARY_NAME_ERROR, \
     WRONG_TYPE_ERROR
 from ..biblib_exceptions import BackendIntegrityError
+from ..log import get_logger
+
+logger = get_logger(__name__)
+
 
 class UserView(BaseView):
     """
@@ -19,6 +26,7 @@ class UserView(BaseView):
     """
 
     decorators = [advertise('scopes', 'rate_limit')]
+    method_decorators = [read_from_replica]
     scopes = ['user']
     rate_limit = [1000, 60*60*24]
 
@@ -37,9 +45,8 @@ class UserView(BaseView):
             db.session.commit()
 
         except IntegrityError as error:
-            current_app.logger.error('IntegrityError. User: {0:d} was not'
-                                     'added. Full traceback: {1}'
-                                     .format(absolute_uid, error))
+            logger.error('IntegrityError. User: {0:d} was not added. Full '
+                         'traceback: {1}', absolute_uid, error)
             raise
 
     @staticmethod
@@ -74,12 +81,10 @@ class UserView(BaseView):
 
                 # Ensure unique content
                 _bibcode = uniquify(_bibcode)
-                current_app.logger.info('User supplied bibcodes: {0}'
-                                        .format(_bibcode))
+                logger.info('User supplied {0} bibcodes', len(_bibcode))
                 library.add_bibcodes(_bibcode)
             elif _bibcode:
-                current_app.logger.error('Bibcode supplied not a list: {0}'
-                                         .format(_bibcode))
+                logger.error('Bibcode supplied not a list: {0}', _bibcode)
                 raise TypeError('Bibcode should be a list.')
 
             user = User.query.filter(User.id == service_uid).one()
@@ -99,24 +104,65 @@ class UserView(BaseView):
             db.session.add_all([library, permission, user])
             db.session.commit()
 
-            current_app.logger.info('Library: "{0}" made, user_service: {1:d}'
-                                    .format(library.name, user.id))
+            logger.info('Library: "{0}" made, user_service: {1:d}',
+                        library.name, user.id)
 
             return library
 
         except IntegrityError as error:
             # Roll back the changes
             db.session.rollback()
-            current_app.logger.error('IntegitryError, database has been rolled'
-                                     'back. Caused by user_service: {0:d}.'
-                                     'Full error: {1}'
-                                     .format(user.id, error))
+            logger.error('IntegitryError, database has been rolled back. '
+                         'Caused by user_service: {0:d}. Full error: {1}',
+                         user.id, error)
             # Log here
             raise
         except Exception:
             db.session.rollback()
             raise
 
+    @staticmethod
+    def get_libraries_validators(service_uid):
+        """
+        Retrieve what is needed to answer a conditional request for the list
+        of libraries of a user, without building the list. The entity tag
+        changes whenever any of the libraries, their number of users, or the
+        permissions of the user changes.
+
+        :param service_uid: microservice UID of the user
+
+        :return: dictionary with the following
+                 etag: unquoted entity tag
+                 last_modified: latest date any library was last modified
+        """
+        all_permissions = aliased(Permissions)
+        num_users = db.session.query(func.count(all_permissions.id))\
+            .filter(all_permissions.library_id == Library.id)\
+            .correlate(Library)\
+            .as_scalar()
+
+        result = db.session.query(
+            Library.id,
+            Library.version,
+            Library.date_last_modified,
+            Library.public,
+            Permissions.read,
+            Permissions.write,
+            Permissions.admin,
+            Permissions.owner,
+            num_users
+        ).join(Permissions.library)\
+            .filter(Permissions.user_id == service_uid)\
+            .order_by(Library.id)\
+            .all()
+
+        last_modified = max([row[2] for row in result] or [datetime.utcnow()])
+
+        return dict(
+            etag=get_etag(service_uid, *result),
+            last_modified=last_modified
+        )
+
     @classmethod
     def get_libraries(cls, service_uid, absolute_uid):
         """
@@ -169,15 +215,15 @@ class UserView(BaseView):
                 api=current_app.config['BIBLIB_USER_EMAIL_ADSWS_API_URL'],
                 uid=absolute_uid
             )
-            current_app.logger.info('Obtaining email of user: {0} [API UID]'
-                                    .format(absolute_uid))
+            logger.info('Obtaining email of user: {0} [API UID]',
+                        absolute_uid, sample=True)
             response = client().get(
                 service
             )
 
             if response.status_code != 200:
-                current_app.logger.error('Could not find user in the API'
-                                         'database: {0}.'.format(service))
+                logger.error('Could not find user in the API database: {0}.',
+                             service)
                 owner = 'Not available'
             else:
                 owner = response.json()['email'].split('@')[0]
@@ -189,6 +235,7 @@ class UserView(BaseView):
                 num_documents=num_documents,
                 date_created=library.date_created.isoformat(),
                 date_last_modified=library.date_last_modified.isoformat(),
+                version=library.version,
                 permission=main_permission,
                 public=library.public,
                 num_users=num_users,
@@ -224,6 +271,8 @@ class UserView(BaseView):
         num_documents:        <int>     Number of documents in the library
         date_created:         <string>  ISO date library was created
         date_last_modified:   <string>  ISO date library was last modified
+        version:              <int>     Version of the library, incremented by
+                                        every modification
         permission:           <sting>   Permission type, can be: 'read',
                                         'write', 'admin', or 'owner'
         public:               <boolean> True means it is public
@@ -236,6 +285,12 @@ class UserView(BaseView):
         -----------
         The following type of user can read a library:
           - user scope (authenticated via the API)
+
+        Conditional Requests:
+        -----------
+        The response has an ETag and Last-Modified header. If-None-Match and
+        If-Modified-Since are answered with 304 Not Modified if none of the
+        libraries have changed.
         """
 
         # Check that they pass a user id
@@ -247,9 +302,21 @@ class UserView(BaseView):
         service_uid = \
             self.helper_absolute_uid_to_service_uid(absolute_uid=user)
 
+        validators = self.get_libraries_validators(service_uid=service_uid)
+        headers = self.helper_cache_headers(
+            etag=validators['etag'],
+            last_modified=validators['last_modified']
+        )
+        if is_not_modified(request,
+                           etag=validators['etag'],
+                           last_modified=validators['last_modified']):
+            logger.info('Libraries of user: {0} not modified', service_uid,
+                        sample=True)
+            return self.helper_not_modified(headers)
+
         user_libraries = self.get_libraries(service_uid=service_uid,
                                             absolute_uid=user)
-        return {'libraries': user_libraries}, 200
+        return {'libraries': user_libraries}, 200, headers
 
     def post(self):
         """
@@ -293,21 +360,20 @@ class UserView(BaseView):
             return err(MISSING_USERNAME_ERROR)
 
         # Check if the user exists, if not, generate a user in the database
-        current_app.logger.info('Checking if the user exists')
+        logger.info('Checking if the user exists')
         if not self.helper_user_exists(absolute_uid=user):
-            current_app.logger.info('User: {0:d}, does not exist.'
-                                    .format(user))
+            logger.info('User: {0:d}, does not exist.', user)
 
             self.create_user(absolute_uid=user)
-            current_app.logger.info('User: {0:d}, created.'.format(user))
+            logger.info('User: {0:d}, created.', user)
         else:
-            current_app.logger.info('User already exists.')
+            logger.info('User already exists.')
 
         # Switch to the service UID and not the API UID
         service_uid = \
             self.helper_absolute_uid_to_service_uid(absolute_uid=user)
-        current_app.logger.info('user_API: {0:d} is now user_service: {1:d}'
-                                .format(user, service_uid))
+        logger.info('user_API: {0:d} is now user_service: {1:d}', user,
+                    service_uid)
 
         # Create the library
         try:
@@ -321,17 +387,17 @@ class UserView(BaseView):
                 )
             )
         except TypeError as error:
-            current_app.logger.error('Wrong type passed for POST: {0} [{1}]'
-                                     .format(request.data, error))
+            logger.error('Wrong type passed for POST: {0} [{1}]',
+                         request.data, error)
             return err(WRONG_TYPE_ERROR)
         try:
             library = \
                 self.create_library(service_uid=service_uid, library_data=data)
         except BackendIntegrityError as error:
-            current_app.logger.error(error)
+            logger.error('{0}', error)
             return err(DUPLICATE_LIBRARY_NAME_ERROR)
         except TypeError as error:
-            current_app.logger.error(error)
+            logger.error('{0}', error)
             return err(WRONG_TYPE_ERROR)
 
         return_data = {
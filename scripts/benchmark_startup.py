@@ -0,0 +1,69 @@
+"""
+Measures how long a worker takes to start: the import of biblib.app, and
+create_app(). Each run is made in a new interpreter, so that nothing is
+already imported or configured.
+
+Usage:
+    python scripts/benchmark_startup.py [--runs N]
+
+Set CONSUL_HOST to an unreachable address to measure a start while consul is
+down, which should not take longer than BIBLIB_CONSUL_TIMEOUT more.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Run in the new interpreter, prints the timings as JSON
+MEASURE = """
+import json, time
+start = time.time()
+import biblib.app
+imported = time.time()
+biblib.app.create_app()
+created = time.time()
+print(json.dumps({'import': imported - start,
+                  'create_app': created - imported}))
+"""
+
+
+def measure():
+    """
+    Start a new interpreter and measure its start
+
+    :return: dictionary of durations in seconds
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-c', MEASURE],
+        cwd=ROOT,
+        stderr=open(os.devnull, 'w')
+    )
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarise(values):
+    """
+    Minimum, median and maximum of a list of durations
+
+    :param values: durations in seconds
+    :return: formatted string
+    """
+    values = sorted(values)
+    return 'min {0:.3f}s  median {1:.3f}s  max {2:.3f}s'.format(
+        values[0], values[len(values) // 2], values[-1]
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of starts measured')
+    args = parser.parse_args()
+
+    runs = [measure() for i in range(args.runs)]
+    for key in ['import', 'create_app']:
+        print('{0:<12} {1}'.format(key, summarise([run[key] for run in runs])))
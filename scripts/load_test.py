@@ -0,0 +1,440 @@
+"""
+Drives a mix of biblib traffic at a fixed arrival rate and reports latency.
+
+Requests arrive as a Poisson process at --rate per second, whatever the
+latency of the previous ones (open loop), and their latency is measured from
+the time they were due, so that a slow server is not hidden by fewer requests
+being sent. The mix covers listing libraries, reading a library, adding and
+removing documents, reading permissions and transferring libraries, as the
+users of `manage.py generate`.
+
+For each end point, the report gives the throughput, the p50, p95 and p99
+latencies, the error rate, and the SQL statements and upstream calls per
+request when biblib runs with BIBLIB_REQUEST_STATS. It is checked against the
+SLO, and against a baseline report if one is given, with an exit status of 1
+for any violation or regression.
+
+Usage, with biblib on port 5000 pointing at biblib/tests/stand_ins.py:
+    python scripts/load_test.py --url http://localhost:5000 --rate 50 \\
+        --duration 60 --baseline baseline.json
+    python scripts/load_test.py ... --save-baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import Queue
+import random
+import argparse
+import threading
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+
+from biblib.synthetic import synthetic_bibcode
+from biblib.request_stats import SQL_HEADER, UPSTREAM_HEADER, TIME_HEADER
+from biblib.views import USER_ID_KEYWORD
+
+# Share of the requests made to each end point
+MIX = {
+    'libraries': 40,
+    'library': 30,
+    'documents': 15,
+    'permissions': 10,
+    'transfer': 5
+}
+
+# Default objectives of every end point, latencies in seconds
+SLO = {'p95': 0.5, 'p99': 1.0, 'error_rate': 0.01}
+
+
+class Traffic(object):
+    """
+    The requests of the mix, as the synthetic users, keeping track of which
+    user owns which library
+    """
+
+    def __init__(self, url, users, first_uid, timeout, rng):
+        """
+        Constructor
+        :param url: root URL of biblib
+        :param users: number of users the requests are made as
+        :param first_uid: absolute_uid of the first user
+        :param timeout: timeout of a request, in seconds
+        :param rng: random.Random instance
+        """
+        self.url = url.rstrip('/')
+        self.uids = range(first_uid, first_uid + users)
+        self.timeout = timeout
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.owners = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=256)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, path, uid, body=None):
+        """
+        Make a request as a user
+
+        :param method: HTTP method
+        :param path: path of the end point
+        :param uid: absolute_uid of the user
+        :param body: JSON body
+        :return: requests.Response
+        """
+        return self.session.request(
+            method, self.url + path, json=body, timeout=self.timeout,
+            headers={USER_ID_KEYWORD: str(uid)}
+        )
+
+    def setup(self):
+        """
+        Find the libraries of the users, creating one for those without
+
+        :return: number of libraries
+        """
+        for uid in self.uids:
+            response = self.request('GET', '/libraries', uid)
+            response.raise_for_status()
+            libraries = [library['id'] for library in
+                         response.json()['libraries']
+                         if library.get('permission') == 'owner']
+            if not libraries:
+                response = self.request('POST', '/libraries', uid, {
+                    'name': 'Load test {0:d}'.format(uid),
+                    'description': 'Library of the load test',
+                    'public': False,
+                    'bibcode': [synthetic_bibcode(self.rng)
+                                for _ in range(20)]
+                })
+                response.raise_for_status()
+                libraries = [response.json()['id']]
+            for library in libraries:
+                self.owners[library] = uid
+        return len(self.owners)
+
+    def library(self):
+        """
+        A library and its owner, picked at random
+
+        :return: library id and absolute_uid
+        """
+        with self.lock:
+            library = self.rng.choice(self.owners.keys())
+            return library, self.owners[library]
+
+    def libraries(self):
+        uid = self.rng.choice(self.uids)
+        return self.request('GET', '/libraries', uid)
+
+    def library_content(self):
+        library, uid = self.library()
+        return self.request('GET', '/libraries/{0}'.format(library), uid)
+
+    def documents(self):
+        library, uid = self.library()
+        return self.request('POST', '/documents/{0}'.format(library), uid, {
+            'bibcode': [synthetic_bibcode(self.rng)],
+            'action': self.rng.choice(['add', 'remove'])
+        })
+
+    def permissions(self):
+        library, uid = self.library()
+        return self.request('GET', '/permissions/{0}'.format(library), uid)
+
+    def transfer(self):
+        library, uid = self.library()
+        new_owner = self.rng.choice(self.uids)
+        response = self.request('POST', '/transfer/{0}'.format(library), uid,
+                                {'email': 'user{0:d}@example.com'
+                                 .format(new_owner)})
+        if response.status_code == 200:
+            with self.lock:
+                self.owners[library] = new_owner
+        return response
+
+    def scenarios(self):
+        """
+        Function making the request of each end point of the mix
+
+        :return: dictionary
+        """
+        return {
+            'libraries': self.libraries,
+            'library': self.library_content,
+            'documents': self.documents,
+            'permissions': self.permissions,
+            'transfer': self.transfer
+        }
+
+
+def run(traffic, mix, rate, duration, concurrency, rng):
+    """
+    Send the requests of the mix at the arrival rate, for the duration
+
+    :param traffic: Traffic instance
+    :param mix: dictionary of the weight of each end point
+    :param rate: requests per second
+    :param duration: seconds
+    :param concurrency: number of requests in flight at most
+    :param rng: random.Random instance
+    :return: list of results, and the duration of the run
+    """
+    scenarios = traffic.scenarios()
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    due = Queue.Queue()
+    results = []
+
+    def worker():
+        while True:
+            item = due.get()
+            if item is None:
+                return
+            name, due_time = item
+            result = {'endpoint': name, 'lag': time.time() - due_time}
+            try:
+                response = scenarios[name]()
+                result['status'] = response.status_code
+                result['sql'] = response.headers.get(SQL_HEADER)
+                result['upstream'] = response.headers.get(UPSTREAM_HEADER)
+                result['server_time'] = response.headers.get(TIME_HEADER)
+            except requests.RequestException as error:
+                result['status'] = None
+                result['error'] = type(error).__name__
+            result['latency'] = time.time() - due_time
+            results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = time.time()
+    due_time = start
+    while True:
+        due_time += rng.expovariate(rate)
+        if due_time > start + duration:
+            break
+        time.sleep(max(due_time - time.time(), 0))
+        name = weighted_choice(names, weights, rng)
+        due.put((name, due_time))
+
+    for _ in threads:
+        due.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.time() - start
+
+
+def weighted_choice(names, weights, rng):
+    """
+    A name picked with the probability of its weight
+
+    :param names: list of names
+    :param weights: list of weights
+    :param rng: random.Random instance
+    :return: name
+    """
+    value = rng.random() * sum(weights)
+    for name, weight in zip(names, weights):
+        if value < weight:
+            return name
+        value -= weight
+    return names[-1]
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile
+
+    :param values: sorted list of values
+    :param fraction: 0 to 1
+    :return: value, or None without values
+    """
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def mean(values):
+    """
+    Mean of the values that are not None
+
+    :param values: list of values
+    :return: float, or None without values
+    """
+    values = [float(value) for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def summarise(results, elapsed):
+    """
+    Statistics of each end point
+
+    :param results: list of results
+    :param elapsed: duration of the run in seconds
+    :return: dictionary of end point to statistics
+    """
+    report = {}
+    for endpoint in sorted(set(result['endpoint'] for result in results)):
+        endpoint_results = [result for result in results
+                            if result['endpoint'] == endpoint]
+        latencies = sorted(result['latency'] for result in endpoint_results)
+        errors = [result for result in endpoint_results
+                  if result['status'] is None or result['status'] >= 400]
+        report[endpoint] = {
+            'requests': len(endpoint_results),
+            'throughput': len(endpoint_results) / elapsed,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+            'error_rate': float(len(errors)) / len(endpoint_results),
+            'lag_max': max(result['lag'] for result in endpoint_results),
+            'server_time': mean(result.get('server_time')
+                                for result in endpoint_results),
+            'sql': mean(result.get('sql') for result in endpoint_results),
+            'upstream': mean(result.get('upstream')
+                             for result in endpoint_results)
+        }
+    return report
+
+
+def check(report, slo, baseline=None, tolerance=0.2):
+    """
+    SLO violations, and regressions against the baseline
+
+    :param report: dictionary of end point to statistics
+    :param slo: dictionary of p95, p99 and error_rate objectives
+    :param baseline: report of the baseline run, or None
+    :param tolerance: relative increase of a latency or of the SQL statements
+                      that is not a regression
+    :return: list of messages
+    """
+    problems = []
+    for endpoint, stats in sorted(report.items()):
+        for key, objective in sorted(slo.items()):
+            if stats[key] is not None and stats[key] > objective:
+                problems.append('SLO {0} {1}: {2:.3f} > {3:.3f}'.format(
+                    endpoint, key, stats[key], objective
+                ))
+
+        before = (baseline or {}).get(endpoint)
+        if not before:
+            continue
+        for key in ['p50', 'p95', 'p99', 'sql', 'upstream']:
+            if before.get(key) is not None and stats[key] is not None and \
+                    stats[key] > before[key] * (1 + tolerance) + 0.001:
+                problems.append(
+                    'Regression {0} {1}: {2:.3f} > {3:.3f} in the baseline'
+                    .format(endpoint, key, stats[key], before[key])
+                )
+        if stats['error_rate'] > before['error_rate'] + 0.01:
+            problems.append(
+                'Regression {0} error_rate: {1:.3f} > {2:.3f} in the baseline'
+                .format(endpoint, stats['error_rate'], before['error_rate'])
+            )
+    return problems
+
+
+def format_report(report):
+    """
+    Table of the report
+
+    :param report: dictionary of end point to statistics
+    :return: string
+    """
+    def ms(value):
+        return '-' if value is None else '{0:.1f}'.format(value * 1000)
+
+    def number(value):
+        return '-' if value is None else '{0:.1f}'.format(value)
+
+    lines = ['{0:<12} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>7} {7:>6} '
+             '{8:>8}'.format('endpoint', 'requests', 'req/s', 'p50 ms',
+                             'p95 ms', 'p99 ms', 'errors', 'sql',
+                             'upstream')]
+    for endpoint, stats in sorted(report.items()):
+        lines.append(
+            '{0:<12} {1:>8d} {2:>8.1f} {3:>8} {4:>8} {5:>8} {6:>6.2f}% '
+            '{7:>6} {8:>8}'.format(
+                endpoint, stats['requests'], stats['throughput'],
+                ms(stats['p50']), ms(stats['p95']), ms(stats['p99']),
+                stats['error_rate'] * 100, number(stats['sql']),
+                number(stats['upstream'])
+            )
+        )
+    return '\n'.join(lines)
+
+
+def parse_pairs(value, cast=float):
+    """
+    Parse name=value,name=value
+
+    :param value: string
+    :param cast: type of the values
+    :return: dictionary
+    """
+    pairs = {}
+    for pair in value.split(','):
+        name, _, number = pair.partition('=')
+        pairs[name.strip()] = cast(number)
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://localhost:5000',
+                        help='root URL of biblib')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests per second')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds of traffic')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='requests in flight at most')
+    parser.add_argument('--users', type=int, default=100,
+                        help='number of users the requests are made as')
+    parser.add_argument('--first-uid', type=int, default=1,
+                        help='absolute_uid of the first user')
+    parser.add_argument('--mix', type=lambda value: parse_pairs(value, int),
+                        default=MIX,
+                        help='weights, eg., libraries=40,library=30,'
+                             'documents=15,permissions=10,transfer=5')
+    parser.add_argument('--slo', type=parse_pairs, default=SLO,
+                        help='objectives, eg., p95=0.5,p99=1,error_rate=0.01')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='timeout of a request in seconds')
+    parser.add_argument('--baseline', help='report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase that is not a regression')
+    parser.add_argument('--save-baseline', help='write the report there')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    traffic = Traffic(args.url, args.users, args.first_uid, args.timeout, rng)
+    print('Using {0:d} libraries'.format(traffic.setup()))
+
+    results, elapsed = run(traffic, args.mix, args.rate, args.duration,
+                           args.concurrency, rng)
+    report = summarise(results, elapsed)
+    print(format_report(report))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+
+    problems = check(report, args.slo, baseline, args.tolerance)
+    for problem in problems:
+        print(problem)
+    sys.exit(1 if problems else 0)
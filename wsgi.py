@@ -9,9 +9,15 @@
 from werkzeug.serving import run_simple
 from werkzeug.wsgi import DispatcherMiddleware
 from biblib import app
+from biblib.models import db
 
 application = app.create_app()
 
+# Each process only uses the connections it opened itself. If gunicorn is run
+# with --preload, the connections opened here belong to the master, and the
+# workers open their own on first use.
+db.warm_up(application)
+
 if __name__ == "__main__":
 
     run_simple(